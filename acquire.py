@@ -1,23 +1,16 @@
 import pandas as pd
 import os
+import json
 from env import get_db_url
 
-def get_access_data():
-    '''
-    Acquires curriculum dataframe based on the SQL query found below
-    Note: Checked against text file 'anonymized_curriculum_access.txt' and it's identical, so using the query instead
-    '''
-    
-    # Filename for the cached csv
-    filename = 'curriculum_access_data.csv'
+# Filenames for the cached data: the typed columnar cache is preferred, the csv is the fallback
+csv_filename = 'curriculum_access_data.csv'
+parquet_filename = 'curriculum_access_data.parquet'
 
-    # If the file exists already (cached), load it.  Otherwise create using env function
-    if os.path.isfile(filename):
-        return pd.read_csv(filename, index_col=0)
-    else:
-        df = pd.read_sql(
-            '''
-            SELECT 
+
+# Every access joined to its cohort (a WHERE clause is added for incremental pulls)
+access_query = '''
+            SELECT
                logs.date,
                logs.time,
                logs.path,
@@ -30,12 +23,254 @@ def get_access_data():
             FROM
                 logs
             LEFT JOIN
-                cohorts ON logs.cohort_id = cohorts.id;
+                cohorts ON logs.cohort_id = cohorts.id
+            '''
+
+def get_access_data(cache='parquet', columns=None, refresh=False, con=None, chunksize=100000):
+    '''
+    Acquires curriculum dataframe based on the SQL query found below
+    Note: Checked against text file 'anonymized_curriculum_access.txt' and it's identical, so using the query instead
+    cache = 'parquet' keeps a typed, columnar copy of the query (requires pyarrow); cache = 'csv' keeps the original
+    untyped csv.  If pyarrow is not installed the parquet cache falls back to the csv.
+    columns = optional list of columns to load (only those columns are read from the parquet cache)
+    refresh = if True and a cache exists, first pulls only the log rows newer than the cache watermark
+    con = database connection or url (defaults to the curriculum_logs url from env), e.g. a sqlite3 connection
+    {Returns : df}
+    '''
+
+    # Fall back to the csv cache if there is no parquet engine available
+    if cache == 'parquet' and not parquet_available():
+        cache = 'csv'
+
+    if refresh:
+        refresh_access_data(cache=cache, con=con, chunksize=chunksize)
+
+    # If the typed file exists already (cached), load only the requested columns
+    if cache == 'parquet' and os.path.isfile(parquet_filename):
+        return pd.read_parquet(parquet_filename, columns=columns, memory_map=True)
+
+    # If the csv exists already (cached), load it.  Otherwise create using env function
+    if os.path.isfile(csv_filename):
+        df = pd.read_csv(csv_filename, index_col=0)
+    else:
+        if con is None:
+            con = get_db_url('curriculum_logs')
+        df = pd.read_sql(access_query, con)
+
+        if cache == 'csv':
+            df.to_csv(csv_filename)
+            write_watermark(df, csv_filename, replace=True)
+
+    # Write the typed cache so the next load skips the csv parse entirely
+    if cache == 'parquet':
+        df = set_access_dtypes(df)
+        df.to_parquet(parquet_filename)
+        write_watermark(df, parquet_filename, replace=True)
+
+    if columns is not None:
+        df = df[columns]
+
+    return df
+
+def iter_access_data(chunksize=250000, cache='parquet', columns=None):
+    '''
+    Reads the cached access data in chunks of chunksize rows, so that logs larger than memory can be processed
+    batch by batch.  The parquet cache is read if asked for and there, the csv otherwise; without either, the query
+    is pulled into the csv chunksize rows at a time (see pull_access_csv).  The whole log is never loaded.  The
+    chunks keep the row labels of the full dataframe.
+    {Yields : df chunk}
+    '''
+
+    # Fall back to the csv cache if there is no parquet engine available, or no parquet cache to stream from
+    # (building it with get_access_data would load the whole log)
+    if cache == 'parquet' and (not parquet_available() or not os.path.isfile(parquet_filename)):
+        cache = 'csv'
+
+    # Make sure there is a cache to stream from
+    filename = parquet_filename if cache == 'parquet' else csv_filename
+    if not os.path.isfile(filename):
+        pull_access_csv(chunksize)
+
+    if cache == 'csv':
+        usecols = None if columns is None else lambda c: c in columns or c.startswith('Unnamed')
+        for chunk in pd.read_csv(filename, index_col=0, usecols=usecols, chunksize=chunksize):
+            yield chunk
+        return
+
+    import pyarrow.parquet as pq
+    parquet_file = pq.ParquetFile(filename)
+    index = parquet_file.schema_arrow.pandas_metadata['index_columns']
+
+    # A RangeIndex is only stored as metadata, so the labels are rebuilt from the row position
+    range_index = index[0] if len(index) == 1 and isinstance(index[0], dict) else None
+    if columns is not None and range_index is None:
+        columns = list(columns) + [i for i in index if isinstance(i, str)]
+
+    rows = 0
+    for batch in parquet_file.iter_batches(batch_size=chunksize, columns=columns):
+        chunk = batch.to_pandas()
+        if range_index is not None:
+            start = range_index['start'] + rows * range_index['step']
+            chunk.index = pd.RangeIndex(start, start + len(chunk) * range_index['step'], range_index['step'])
+        rows += len(chunk)
+        yield chunk
+
+def pull_access_csv(chunksize=250000, con=None):
+    '''
+    Pulls the whole query into the csv cache chunksize rows at a time, appending each chunk as it arrives, and
+    records its watermark
+    {Returns : number of rows}
+    '''
+    if con is None:
+        con = get_db_url('curriculum_logs')
+
+    rows = 0
+    for chunk in pd.read_sql(access_query, con, chunksize=chunksize):
+        chunk.index = pd.RangeIndex(rows, rows + len(chunk))
+        chunk.to_csv(csv_filename, mode='a' if rows else 'w', header=rows == 0)
+        write_watermark(chunk, csv_filename, replace=rows == 0)
+        rows += len(chunk)
+
+    return rows
+
+def refresh_access_data(cache='parquet', con=None, chunksize=100000):
+    '''
+    Pulls only the log rows recorded after the cache watermark, in chunks of chunksize rows, and appends them to
+    the cache (a true append for the csv; the parquet file is rewritten locally, the database only sends the new rows).
+    Rows logged in the same second as the watermark but inserted after the last pull are not picked up.
+    If there is no cache yet, nothing is pulled: get_access_data will do the full pull.
+    {Returns : number of new rows}
+    '''
+
+    # Fall back to the csv cache if there is no parquet engine available
+    if cache == 'parquet' and not parquet_available():
+        cache = 'csv'
+    filename = parquet_filename if cache == 'parquet' else csv_filename
+    if not os.path.isfile(filename):
+        return 0
+
+    # Read the existing cache (the date and time columns are enough when only the watermark is needed)
+    if cache == 'parquet':
+        df = pd.read_parquet(filename)
+    else:
+        df = pd.read_csv(filename, index_col=0, usecols=[0, 1, 2])
+
+    watermark = read_watermark(filename)
+    if watermark is None:
+        watermark = get_watermark(df)
+    if watermark is None:
+        return 0
+
+    # Only the rows after the watermark, oldest first (the values come from our own cache, not from user input)
+    date, time = watermark.split(' ')
+    query = access_query + f'''
+            WHERE
+                logs.date > '{date}' OR (logs.date = '{date}' AND logs.time > '{time}')
+            ORDER BY
+                logs.date, logs.time
             '''
-            ,
-            get_db_url('curriculum_logs')
-        )
+    if con is None:
+        con = get_db_url('curriculum_logs')
+
+    # Index the new rows after the existing ones so positional references into the cache stay the same
+    start = df.index.max() + 1 if len(df) > 0 else 0
+    new_chunks = []
+    new_rows = 0
+    for chunk in pd.read_sql(query, con, chunksize=chunksize):
+        chunk.index = pd.RangeIndex(start + new_rows, start + new_rows + len(chunk))
+        new_rows += len(chunk)
+        if cache == 'csv':
+            chunk.to_csv(filename, mode='a', header=False)
+            chunk = chunk[['date','time']]
+        new_chunks.append(chunk)
 
-        df.to_csv(filename)
+    if new_rows == 0:
+        return 0
+
+    if cache == 'parquet':
+        df = set_access_dtypes(pd.concat([df] + new_chunks))
+        df.to_parquet(filename)
+        write_watermark(df, filename)
+    else:
+        write_watermark(pd.concat(new_chunks), filename)
+
+    return new_rows
+
+def set_access_dtypes(df):
+    '''
+    Sets compact dtypes on the raw access data: datetimes for the dates, a timedelta for the time of day,
+    categoricals for the repeated strings and integer user ids.  program_id stays a float because the
+    LEFT JOIN leaves it null for users without a cohort.
+    {Returns : df}
+    '''
+    df = df.copy()
+
+    df['date'] = pd.to_datetime(df.date)
+    df['time'] = pd.to_timedelta(df.time.astype(str))
+    df['start_date'] = pd.to_datetime(df.start_date)
+    df['end_date'] = pd.to_datetime(df.end_date)
+    df = df.astype({'path':'category', 'ip':'category', 'name':'category', 'user_id':'int32', 'program_id':'float'})
+
+    return df
+
+def get_watermark(df):
+    '''
+    Finds the latest access (date + time) in a raw or typed access dataframe
+    {Returns : watermark as a 'YYYY-MM-DD HH:MM:SS' string, or None if df is empty}
+    '''
+    if len(df) == 0:
+        return None
+
+    if pd.api.types.is_datetime64_any_dtype(df['date']):
+        accessed = df['date'] + pd.to_timedelta(df['time'])
+    else:
+        accessed = pd.to_datetime(df['date'].astype(str) + ' ' + df['time'].astype(str))
+
+    return accessed.max().strftime('%Y-%m-%d %H:%M:%S')
+
+def watermark_filename(filename):
+    '''
+    Names the sidecar file holding the high-water mark (latest date + time) of the rows in the cache file filename,
+    so the csv and parquet caches each keep their own
+    {Returns : filename}
+    '''
+    return f'{filename}.watermark.json'
+
+def read_watermark(filename):
+    '''
+    Reads the high-water mark stored alongside the cache file filename
+    {Returns : watermark string, or None if it has not been recorded}
+    '''
+    if not os.path.isfile(watermark_filename(filename)):
+        return None
+
+    with open(watermark_filename(filename)) as f:
+        return json.load(f)['accessed']
+
+def write_watermark(df, filename, replace=False):
+    '''
+    Records the latest access in df as the high-water mark of the cache file filename: a newly written cache
+    (replace = True) sets it, an append keeps the later of the stored and new marks
+    {Returns : watermark string}
+    '''
+    watermark = get_watermark(df)
+    stored = None if replace else read_watermark(filename)
+    if watermark is None or (stored is not None and stored > watermark):
+        watermark = stored
+
+    with open(watermark_filename(filename), 'w') as f:
+        json.dump({'accessed': watermark}, f)
+
+    return watermark
+
+def parquet_available():
+    '''
+    Checks whether pandas has an engine for reading/writing the parquet cache
+    {Returns : bool}
+    '''
+    try:
+        import pyarrow
+    except ImportError:
+        return False
 
-        return df
\ No newline at end of file
+    return True
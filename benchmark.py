@@ -0,0 +1,472 @@
+'''
+Contains benchmarks comparing wrangle/explore functions against the implementations they replaced, and the
+benchmark suite timing and memory-profiling every full_wrangle stage and explore function on synthetic logs at
+several scales, with a json report per run for comparing performance across commits
+'''
+
+import io
+import os
+import json
+import time
+import platform
+import contextlib
+import subprocess
+import tracemalloc
+import pandas as pd
+import numpy as np
+import wrangle
+import explore
+
+def scale_access_data(df, scale, relabel=()):
+    '''
+    Tiles df scale times, shifting the user_ids of each copy so the log grows in users as well as rows
+    (the gap of one user_id keeps copies from being each other's neighbors).  The string columns in relabel get
+    the copy number appended, so e.g. relabel=['cohort'] grows the number of cohorts too.
+    {Returns : df}
+    '''
+    offset = df.user_id.max() + 2
+    copies = [df.assign(user_id=df.user_id + k * offset, **{col: df[col].astype(str) + f'_{k}' for col in relabel})
+              for k in range(scale)]
+
+    return pd.concat(copies, ignore_index=True)
+
+def pre_impute_data():
+    '''
+    Runs the wrangle up to impute_cohorts on the cached access data
+    {Returns : df}
+    '''
+    df = wrangle.get_access_data()
+    df = wrangle.initial_drops(df)
+    df = wrangle.add_and_set_columns(df)
+    df = wrangle.split_path(df)
+    df, df_staff = wrangle.remove_staff(df)
+
+    return df
+
+def loop_suggest_cohorts(df):
+    '''
+    The per-user loop impute_cohorts used to run: five full scans of df for every user without a cohort
+    {Returns : series of suggested cohorts indexed by user_id}
+    '''
+    no_cohort_list = df[df['cohort'].isnull() == True].user_id.unique()
+    df_X = df.copy()
+    df_X['cohort'] = np.where(df_X.cohort.isnull() == True, 'X', df_X.cohort)
+
+    user_list = []
+    for user in no_cohort_list:
+        inlist = {}
+        inlist['prev_user_cohort'] = df_X[df_X.user_id == (user-1)].cohort.max()
+        inlist['prev_user_program'] = df_X[df_X.user_id == (user-1)].program_id.max()
+        inlist['user_id'] = user
+        inlist['next_user_cohort'] = df_X[df_X.user_id == (user+1)].cohort.max()
+        inlist['next_user_program'] = df_X[df_X.user_id == (user+1)].program_id.max()
+        inlist['total_accesses'] = df_X[df_X.user_id == user].accessed.count()
+        user_list.append(inlist)
+    df_no_cohort_user = pd.DataFrame(user_list).set_index('user_id')
+
+    df_no_cohort_user['suggested_cohort'] = np.where(df_no_cohort_user.prev_user_cohort != df_no_cohort_user.next_user_cohort,'Cannot Impute',
+                                                np.where(df_no_cohort_user.prev_user_cohort == 'X', 'Cannot Impute' ,df_no_cohort_user.prev_user_cohort))
+    suggested = df_no_cohort_user.suggested_cohort
+
+    return suggested[suggested != 'Cannot Impute'].sort_index()
+
+def summary_suggest_cohorts(df):
+    '''
+    The same suggestions from one user_summary groupby and neighbor lookups (what impute_cohorts runs now)
+    {Returns : series of suggested cohorts indexed by user_id}
+    '''
+    cohort_info = df.groupby('cohort').agg(start_date=('start_date', 'min'), end_date=('end_date', 'max'),
+                                           program_id=('program_id', 'mean'))
+    suggested = wrangle.suggest_cohorts(wrangle.user_summary(df), cohort_info).suggested_cohort
+
+    return suggested.sort_index()
+
+def impute_benchmark(df=None, scales=(1, 10, 100), loop_max_rows=2000000):
+    '''
+    Times the old per-user loop against the user_summary lookups on df (the data going into impute_cohorts; built
+    from the cache if not given) tiled to each scale, and checks both suggest the same cohorts.  Only the suggestions
+    are compared, not the imputed frames (the loop only ever produced the suggestions).  The loop is skipped above
+    loop_max_rows rows, since it grows with users x rows.
+    {Returns : dataframe with rows, seconds for each implementation, speedup and whether the suggestions match}
+    '''
+    if df is None:
+        df = pre_impute_data()
+
+    results = []
+    for scale in scales:
+        scaled = scale_access_data(df, scale)
+        row = {'scale': scale, 'rows': scaled.shape[0]}
+
+        start = time.perf_counter()
+        suggested = summary_suggest_cohorts(scaled)
+        row['summary_seconds'] = time.perf_counter() - start
+
+        if scaled.shape[0] <= loop_max_rows:
+            start = time.perf_counter()
+            loop_suggested = loop_suggest_cohorts(scaled)
+            row['loop_seconds'] = time.perf_counter() - start
+            row['speedup'] = row['loop_seconds'] / row['summary_seconds']
+            row['same_suggestions'] = suggested.to_dict() == loop_suggested.to_dict()
+
+        results.append(row)
+
+    return pd.DataFrame(results).set_index('scale')
+
+def loop_top_three(df, col='lesson'):
+    '''
+    The MultiIndex walk lesson_top_three/unit_top_three used to run (it never appends the last cohort)
+    {Returns : dataframe with Cohort, #1 col, #1 col count, ... for each cohort but the last}
+    '''
+    df_grouped = df.groupby('cohort')[col].value_counts()
+
+    top_three = []
+    counter = 0
+    name = df_grouped.index[0][0]
+    result_row = {}
+    for c in df_grouped.index:
+        if c[0] != name:
+            top_three.append(result_row)
+            counter = 0
+            result_row={}
+        if counter < 3:
+            if c[1] != 'Not Lesson':
+                result_row['Cohort'] = c[0]
+                result_row[f'#{counter+1} {col}'] = c[1]
+                result_row[f'#{counter+1} {col} count'] = df_grouped[c]
+                counter += 1
+                name = c[0]
+        else:
+            name = c[0]
+
+    return pd.DataFrame(top_three).dropna().reset_index().drop(columns='index')
+
+def top_n_benchmark(df=None, scales=(1, 10, 100), col='lesson', loop_max_groups=50000):
+    '''
+    Times the old index walk against top_n_per_group on the wrangled df (from full_wrangle if not given) tiled to
+    each scale with the cohorts relabeled per copy, so the number of (cohort, value) groups grows with the scale.
+    The results are compared on the cohorts the walk returns, by their counts (the walk breaks ties in value_counts
+    order); the walk is skipped above loop_max_groups groups.
+    {Returns : dataframe with rows, groups, seconds for each implementation, speedup and whether the counts are identical}
+    '''
+    if df is None:
+        df = wrangle.full_wrangle()[0]
+
+    results = []
+    for scale in scales:
+        scaled = scale_access_data(df[['user_id', 'cohort', col]], scale, relabel=['cohort'])
+        row = {'scale': scale, 'rows': scaled.shape[0], 'groups': scaled.groupby(['cohort', col]).ngroups}
+
+        start = time.perf_counter()
+        top = explore.top_n_table(explore.top_n_per_group(scaled, 'cohort', col, 3, exclude=['Not Lesson']), col, 3)
+        row['top_n_seconds'] = time.perf_counter() - start
+
+        if row['groups'] <= loop_max_groups:
+            start = time.perf_counter()
+            loop_top = loop_top_three(scaled, col)
+            row['loop_seconds'] = time.perf_counter() - start
+            row['speedup'] = row['loop_seconds'] / row['top_n_seconds']
+
+            counts = [f'#{rank} {col} count' for rank in range(1, 4)]
+            top = top[top.Cohort.isin(loop_top.Cohort)].reset_index(drop=True)
+            row['identical'] = (top.Cohort.tolist() == loop_top.Cohort.tolist()
+                                and np.array_equal(top[counts].values.astype(float), loop_top[counts].values.astype(float)))
+
+        results.append(row)
+
+    return pd.DataFrame(results).set_index('scale')
+
+# --------------------------------------------------
+# Synthetic logs and the stage / explore profiling suite
+# --------------------------------------------------
+
+# Units of the synthetic curriculum per program_id (Data Science content has 'science' in a unit name, Web
+# Development content 'java', like the paths explore.cross_curriculum_access looks for)
+synthetic_units = {3: ['data-science', 'classification', 'regression', 'clustering', 'anomaly-detection',
+                       'timeseries', 'nlp', 'stats', 'storytelling', 'python', 'sql'],
+                   1: ['java-i', 'java-ii', 'java-iii', 'javascript-i', 'javascript-ii', 'mysql', 'spring',
+                       'html-css', 'jquery', 'content'],
+                   2: ['java-i', 'java-ii', 'java-iii', 'javascript-i', 'javascript-ii', 'mysql', 'spring',
+                       'html-css', 'jquery', 'content']}
+
+# Paths that are not curriculum (home page, table of contents, images, json, appendix)
+synthetic_non_curriculum = ['/', 'toc', 'search/search_index.json', 'img/logo.jpg', 'appendix', 'appendix/cli']
+
+def synthetic_paths(n_paths):
+    '''
+    Builds n_paths distinct paths: the non-curriculum ones, then unit/lessonN and unit/lessonN/sub paths cycling
+    through the units
+    {Returns : dataframe of path and program_id (of the unit; NaN for non-curriculum and shared paths)}
+    '''
+    units = sorted(set(unit for program_units in synthetic_units.values() for unit in program_units))
+    program_of = {unit: program_id for program_id, program_units in synthetic_units.items() for unit in program_units}
+
+    paths, programs = list(synthetic_non_curriculum), [np.nan] * len(synthetic_non_curriculum)
+    lesson = 0
+    while len(paths) < n_paths:
+        for unit in units:
+            for path in [f'{unit}/lesson{lesson}', f'{unit}/lesson{lesson}/sub']:
+                paths.append(path)
+                programs.append(3.0 if program_of[unit] == 3 else 2.0)
+        lesson += 1
+
+    return pd.DataFrame({'path': paths[:n_paths], 'program_id': programs[:n_paths]})
+
+def generate_access_data(users=1000, cohorts=20, paths=400, hits=500000, staff_fraction=0.03,
+                         null_cohort_fraction=0.05, scraper_fraction=0.01, start='2018-01-26', days=900,
+                         typed=True, seed=0):
+    '''
+    Generates a synthetic curriculum access log shaped like get_access_data's output, for benchmarks at any scale:
+    users spread over cohorts in consecutive user_id blocks (so the imputation finds neighbors), a staff_fraction of
+    staff users (at least one), a null_cohort_fraction of users without a cohort, skewed activity per user and per
+    path, accesses before, during and after each cohort's dates, and a scraper_fraction of users crawling every path
+    in order seconds apart.  typed = True gives the dtypes of the parquet cache, False the strings of the csv cache.
+    {Returns : df}
+    '''
+    rng = np.random.default_rng(seed)
+    log_start = pd.Timestamp(start)
+
+    # Cohorts over the span of the log, plus Staff
+    cohort_starts = log_start - pd.Timedelta(days=180) + pd.to_timedelta(np.sort(rng.integers(0, days, cohorts)), unit='D')
+    cohort_table = pd.DataFrame({'name': [f'Cohort{i:04}' for i in range(cohorts)] + ['Staff'],
+                                 'start_date': list(cohort_starts) + [pd.Timestamp('2014-02-04')],
+                                 'program_id': list(rng.choice([1.0, 2.0, 3.0], cohorts, p=[.2, .5, .3])) + [2.0]})
+    cohort_table['end_date'] = cohort_table.start_date + pd.to_timedelta(np.where(cohort_table.program_id == 3, 140, 150), unit='D')
+
+    # Users in cohort blocks, some staff, some without a cohort
+    user_cohort = np.sort(rng.integers(0, cohorts, users)).astype(float)
+    kind = rng.random(users)
+    user_cohort[kind < staff_fraction] = cohorts
+    user_cohort[(kind >= staff_fraction) & (kind < staff_fraction + null_cohort_fraction)] = np.nan
+
+    # At least one staff user at any scale, as the wrangle expects some Staff rows
+    user_cohort[np.argmin(kind)] = cohorts
+
+    # Hits per user from a skewed activity level
+    activity = rng.lognormal(0, 1, users)
+    user_idx = rng.choice(users, hits, p=activity / activity.sum())
+    hit_cohort = user_cohort[user_idx]
+    has_cohort = ~np.isnan(hit_cohort)
+    cohort_idx = np.where(has_cohort, hit_cohort, 0).astype(int)
+    program = np.where(has_cohort, cohort_table.program_id.values[cohort_idx], 2.0)
+
+    # Paths: mostly the user's own program with a Zipf-like popularity, 5% anywhere
+    path_table = synthetic_paths(paths)
+    path_idx = np.empty(hits, dtype=int)
+    for program_id in [2.0, 3.0]:
+        pool = rng.permutation(np.flatnonzero((path_table.program_id == program_id) | path_table.program_id.isnull()))
+        popularity = 1 / np.arange(1, len(pool) + 1)
+        mask = (program == 3.0) == (program_id == 3.0)
+        path_idx[mask] = pool[rng.choice(len(pool), mask.sum(), p=popularity / popularity.sum())]
+    anywhere = rng.random(hits) < .05
+    path_idx[anywhere] = rng.integers(0, len(path_table), anywhere.sum())
+
+    # Times: 10% in the month before the cohort, 60% during it, 30% in the year after; uniform without a cohort
+    starts = cohort_table.start_date.values[cohort_idx].astype('datetime64[s]').astype('int64')
+    ends = cohort_table.end_date.values[cohort_idx].astype('datetime64[s]').astype('int64')
+    phase = rng.random(hits)
+    seconds = np.where(phase < .1, starts - rng.integers(0, 30 * 86400, hits),
+                       np.where(phase < .7, starts + (rng.random(hits) * (ends - starts)).astype('int64'),
+                                ends + rng.integers(0, 365 * 86400, hits)))
+    log_seconds = log_start.value // 10 ** 9 + rng.integers(0, days * 86400, hits)
+    seconds = np.where(has_cohort & (hit_cohort != cohorts), seconds, log_seconds)
+
+    # One usual ip per user, a second one for 20% of the hits
+    ip_idx = np.where(rng.random(hits) < .2, user_idx + users, user_idx)
+
+    # Scrapers: students crawling every path in order, 1-3 seconds apart, from a random time
+    students = np.flatnonzero(~np.isnan(user_cohort) & (user_cohort != cohorts))
+    scrapers = rng.choice(students, min(int(round(users * scraper_fraction)), len(students)), replace=False)
+    for user in scrapers:
+        crawl_seconds = log_start.value // 10 ** 9 + rng.integers(0, days * 86400) + np.cumsum(rng.integers(1, 4, len(path_table)))
+        user_idx = np.append(user_idx, np.full(len(path_table), user))
+        path_idx = np.append(path_idx, np.arange(len(path_table)))
+        seconds = np.append(seconds, crawl_seconds)
+        ip_idx = np.append(ip_idx, np.full(len(path_table), user))
+
+    # In log order
+    order = np.argsort(seconds, kind='stable')
+    user_idx, path_idx, seconds, ip_idx = user_idx[order], path_idx[order], seconds[order], ip_idx[order]
+    accessed = pd.to_datetime(seconds, unit='s')
+    cohort_rows = cohort_table.reindex(user_cohort[user_idx]).reset_index(drop=True)
+
+    ip_pool = np.array([f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}' for i in range(2 * users)])
+    df = pd.DataFrame({'date': accessed.normalize(), 'time': accessed - accessed.normalize(),
+                       'path': pd.Categorical.from_codes(path_idx, path_table.path),
+                       'user_id': (user_idx + 1).astype('int32'),
+                       'ip': pd.Categorical.from_codes(ip_idx, ip_pool),
+                       'name': pd.Categorical(cohort_rows.name.values),
+                       'start_date': cohort_rows.start_date.values, 'end_date': cohort_rows.end_date.values,
+                       'program_id': cohort_rows.program_id.values})
+
+    if not typed:
+        df = df.astype({'path': str, 'ip': str, 'name': object})
+        df['name'] = df.name.where(cohort_rows.name.notnull().values, None)
+        df['time'] = (pd.Timestamp(0) + df.time).dt.strftime('%H:%M:%S')
+        for col in ['date', 'start_date', 'end_date']:
+            df[col] = df[col].dt.strftime('%Y-%m-%d')
+
+    return df
+
+def profile_call(func, args=(), memory=True):
+    '''
+    Times one call of func(*args) (printed output suppressed) and, if memory, measures the peak memory traced by
+    tracemalloc during a second call (tracing slows the call down, so it is kept out of the timing)
+    {Returns : result, seconds, peak_mb (None without memory)}
+    '''
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        result = func(*args)
+        seconds = time.perf_counter() - start
+
+    return result, seconds, traced_peak_mb(func, args) if memory else None
+
+def traced_peak_mb(func, args=()):
+    '''
+    Measures the peak memory traced by tracemalloc during a call of func(*args) (printed output suppressed)
+    {Returns : MB}
+    '''
+    with contextlib.redirect_stdout(io.StringIO()):
+        tracemalloc.start()
+        func(*args)
+        peak_mb = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+        tracemalloc.stop()
+
+    return peak_mb
+
+def stage_benchmark(raw, memory=True):
+    '''
+    Runs full_wrangle's stages one at a time on the raw access data (wrangle.stage_names, then the window tags and
+    wrangle_schema dtypes) with wrangle.run_stage, adding the peak memory traced by a second call of each
+    {Returns : list of result dicts (kind, name, rows_in, rows_out, seconds, peak_mb), the six wrangled dataframes}
+    '''
+    records, peaks = [], []
+
+    def stage(name, func, args):
+        output = wrangle.run_stage(name, func, args, records)
+        peaks.append(traced_peak_mb(func, args) if memory else None)
+        return output
+
+    # Every stage passes df on; some split off other frames too
+    df, side = raw, []
+    for name in wrangle.stage_names:
+        output = stage(name, getattr(wrangle, name), (df,))
+        if isinstance(output, tuple):
+            df, side = output[0], side + list(output[1:])
+        else:
+            df = output
+    df_staff, df_multicohort, df_unimputed, df_non_curriculum, df_outliers = side
+
+    df, df_multicohort, df_outliers = stage('tag_active_window', wrangle.tag_frames, ([df, df_multicohort, df_outliers],))
+    frames = stage('set_wrangle_dtypes', wrangle.set_wrangle_dtypes,
+                   ([df, df_staff, df_multicohort, df_unimputed, df_non_curriculum, df_outliers],))
+
+    results = [{'kind': 'stage', 'name': record['stage'], 'rows_in': record['rows_in'], 'rows_out': record['rows_out'],
+                'seconds': record['seconds'], 'peak_mb': peak_mb} for record, peak_mb in zip(records, peaks)]
+
+    return results, frames
+
+def explore_benchmark(frames, memory=True):
+    '''
+    Profiles the explore functions (all but the plots) on the six wrangled dataframes, plus building the cubes
+    {Returns : list of result dicts (kind, name, rows_in, rows_out, seconds, peak_mb)}
+    '''
+    from cube import build_cubes
+
+    df, df_staff, df_multicohort, df_unimputed, df_non_curriculum, df_outliers = frames
+    ds = df[df.program_type == 'Data Science']
+
+    # Name, function and arguments; unit_top_three adds a unit column, so it gets its own copy
+    calls = [('lesson_top_three', explore.lesson_top_three, (df,)),
+             ('unit_top_three', lambda df: explore.unit_top_three(df.copy()), (df,)),
+             ('common_lesson_minimum_access', explore.common_lesson_minimum_access, (ds, df)),
+             ('cross_curriculum_access', explore.cross_curriculum_access, (df, df_outliers)),
+             ('alumni_top_lessons', explore.alumni_top_lessons, (df, df_outliers)),
+             ('wd_ds_groups', explore.wd_ds_groups, (df,)),
+             ('wd_lowest_access_counts', explore.wd_lowest_access_counts, (df,)),
+             ('ds_lowest_access_counts', explore.ds_lowest_access_counts, (df,)),
+             ('build_cubes', build_cubes, (df,))]
+
+    results = []
+    for name, func, args in calls:
+        output, seconds, peak_mb = profile_call(func, args, memory)
+        results.append({'kind': 'explore', 'name': name, 'rows_in': df.shape[0], 'rows_out': wrangle.n_rows(output),
+                        'seconds': seconds, 'peak_mb': peak_mb})
+
+    return results
+
+def git_commit():
+    '''
+    Finds the commit of this checkout the benchmark runs on, marked dirty when the working tree has changes
+    {Returns : commit string, or None outside a git checkout}
+    '''
+    repo = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repo, capture_output=True,
+                               text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    return commit + ('-dirty' if dirty else '')
+
+def benchmark_suite(scales=(1, 10, 100), users=1000, cohorts=50, hits=500000, memory=True,
+                    report='benchmark_report.json', **generator_options):
+    '''
+    Generates a synthetic access log at each scale (users, cohorts and hits all multiplied by the scale, so 1 is
+    about the size of the real log; fractions such as 0.1 make quick runs, and any other generate_access_data
+    option, e.g. paths or scraper_fraction, is passed through), then profiles every full_wrangle stage and explore
+    function on it.  The results and the run's commit, time and versions are written to report as
+    json (None to skip) for compare_reports.
+    {Returns : dataframe of scale, kind, name, rows_in, rows_out, seconds, peak_mb}
+    '''
+    results = []
+    for scale in scales:
+        raw = generate_access_data(users=int(users * scale), cohorts=max(int(cohorts * scale), 1),
+                                   hits=int(hits * scale), **generator_options)
+
+        stage_results, frames = stage_benchmark(raw, memory)
+        del raw
+        explore_results = explore_benchmark(frames, memory)
+        del frames
+
+        results += [dict(scale=scale, **row) for row in stage_results + explore_results]
+
+    if report is not None:
+        meta = {'commit': git_commit(), 'timestamp': pd.Timestamp.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(), 'pandas': pd.__version__, 'numpy': np.__version__,
+                'platform': platform.platform(), 'cpus': os.cpu_count(),
+                'options': dict(users=users, cohorts=cohorts, hits=hits, memory=memory, **generator_options)}
+        with open(report, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=1)
+
+    return pd.DataFrame(results)
+
+def read_report(report):
+    '''
+    Loads a benchmark_suite report
+    {Returns : meta dict, results dataframe}
+    '''
+    with open(report) as f:
+        contents = json.load(f)
+
+    return contents['meta'], pd.DataFrame(contents['results'])
+
+def compare_reports(old, new):
+    '''
+    Lines up two benchmark_suite reports (e.g. from two commits) by scale, kind and name, with the ratio new / old of
+    the time and peak memory of each (below 1 is an improvement)
+    {Returns : dataframe indexed by scale, kind and name}
+    '''
+    old_meta, old_results = read_report(old)
+    new_meta, new_results = read_report(new)
+
+    keys = ['scale', 'kind', 'name']
+    merged = old_results.merge(new_results, on=keys, how='outer', suffixes=('_old', '_new'))
+    merged['seconds_ratio'] = merged.seconds_new / merged.seconds_old
+    merged['peak_mb_ratio'] = merged.peak_mb_new / merged.peak_mb_old
+    merged.attrs['commits'] = (old_meta['commit'], new_meta['commit'])
+
+    columns = ['seconds_old', 'seconds_new', 'seconds_ratio', 'peak_mb_old', 'peak_mb_new', 'peak_mb_ratio',
+               'rows_out_old', 'rows_out_new']
+    return merged.set_index(keys)[columns]
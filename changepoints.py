@@ -0,0 +1,243 @@
+'''
+Contains the changepoint engine for daily access series (question 5: when cross-curriculum access was shut off):
+segment costs from prefix sums, so any segment's cost is O(1), searched by PELT or binary segmentation, with a
+likelihood-ratio statistic and a confidence interval for the date of every change.  Series are daily counts,
+optionally over an exposure (e.g. all accesses of the program that day) so the change is in the access rate.
+'''
+
+import numpy as np
+import pandas as pd
+import scipy.stats as stats
+
+def prefix_arrays(counts, exposure=None, cost='poisson'):
+    '''
+    Builds the prefix sums the segment costs are computed from: counts and exposure for cost = 'poisson' (a rate
+    per unit of exposure, scaled by the overdispersion of the series so noisy counts do not split everywhere);
+    the rate and its square for cost = 'normal' (a change in mean, scaled by the noise variance estimated from the
+    day-to-day differences)
+    {Returns : dict of prefix arrays and the cost}
+    '''
+    counts = np.asarray(counts, dtype=np.float64)
+    exposure = np.ones(len(counts)) if exposure is None else np.asarray(exposure, dtype=np.float64)
+    prefix = {'cost': cost, 'n': len(counts),
+              'x': np.concatenate([[0], np.cumsum(counts)]), 'e': np.concatenate([[0], np.cumsum(exposure)])}
+
+    if cost == 'poisson':
+        # Dispersion from consecutive days: a constant Poisson rate gives E[(x1 - x0)^2] = E[x1 + x0]
+        diffs = np.diff(counts)
+        sums = counts[1:] + counts[:-1]
+        prefix['scale'] = max(1.0, (diffs ** 2).sum() / sums.sum()) if sums.sum() > 0 else 1.0
+    elif cost == 'normal':
+        rate = np.divide(counts, exposure, out=np.zeros(len(counts)), where=exposure > 0)
+        prefix['y'] = np.concatenate([[0], np.cumsum(rate)])
+        prefix['yy'] = np.concatenate([[0], np.cumsum(rate ** 2)])
+
+        # Noise variance from the median absolute day-to-day difference (robust to the changes themselves)
+        diffs = np.abs(np.diff(rate))
+        sigma = np.median(diffs) / (0.6745 * np.sqrt(2)) if len(diffs) else 0
+        if sigma == 0:
+            sigma = np.sqrt((diffs ** 2).mean() / 2) if len(diffs) and diffs.any() else 1.0
+        prefix['scale'] = 2 * sigma ** 2
+    else:
+        raise ValueError(f"Unknown cost '{cost}' (use 'poisson' or 'normal')")
+
+    return prefix
+
+def segment_cost(prefix, lo, hi):
+    '''
+    Negative log-likelihood (up to a constant) of the days lo to hi - 1 as one segment with its own rate, for
+    arrays of lo and hi at once
+    {Returns : array of costs}
+    '''
+    if prefix['cost'] == 'poisson':
+        x = prefix['x'][hi] - prefix['x'][lo]
+        e = prefix['e'][hi] - prefix['e'][lo]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cost = np.where(x > 0, x - x * np.log(np.where(x > 0, x, 1) / np.where(e > 0, e, 1)), 0)
+    else:
+        n = np.asarray(hi - lo, dtype=np.float64)
+        y = prefix['y'][hi] - prefix['y'][lo]
+        cost = prefix['yy'][hi] - prefix['yy'][lo] - np.divide(y ** 2, n, out=np.zeros_like(y), where=n > 0)
+
+    return cost / prefix['scale']
+
+def pelt(prefix, penalty, min_size=7):
+    '''
+    Finds the changepoints minimizing the total segment cost plus penalty per changepoint exactly, by pruned exact
+    linear time search: each day is one vectorized step over the candidate last changepoints, and candidates that
+    can no longer be optimal are dropped.  The work is about linear when changes keep occurring along the series,
+    but up to quadratic for long series with few changes, where binary_segmentation is the faster search.
+    {Returns : sorted list of changepoints (the first day of each new segment)}
+    '''
+    n = prefix['n']
+    best = np.full(n + 1, np.inf)
+    best[0] = -penalty
+    last = np.zeros(n + 1, dtype=np.int64)
+    candidates = np.array([0])
+
+    for t in range(min_size, n + 1):
+        costs = best[candidates] + segment_cost(prefix, candidates, t)
+        i = np.argmin(costs)
+        best[t] = costs[i] + penalty
+        last[t] = candidates[i]
+
+        # Candidates already worse than the best split at t stay worse, then the next day becomes eligible
+        candidates = candidates[costs <= best[t]]
+        if t + 1 - min_size >= min_size:
+            candidates = np.append(candidates, t + 1 - min_size)
+
+    points = []
+    t = n
+    while t > 0:
+        t = last[t]
+        if t > 0:
+            points.append(int(t))
+
+    return sorted(points)
+
+def binary_segmentation(prefix, penalty, min_size=7):
+    '''
+    Finds changepoints by splitting each segment at its best point (every split of a segment costed at once from
+    the prefix sums) while the split lowers the cost by more than penalty; O(n log n) for balanced splits
+    {Returns : sorted list of changepoints}
+    '''
+    points = []
+    segments = [(0, prefix['n'])]
+    while segments:
+        lo, hi = segments.pop()
+        if hi - lo < 2 * min_size:
+            continue
+
+        splits = np.arange(lo + min_size, hi - min_size + 1)
+        gains = segment_cost(prefix, np.array([lo]), np.array([hi])) - segment_cost(prefix, lo, splits) - segment_cost(prefix, splits, hi)
+        i = np.argmax(gains)
+        if gains[i] > penalty:
+            points.append(int(splits[i]))
+            segments += [(lo, int(splits[i])), (int(splits[i]), hi)]
+
+    return sorted(points)
+
+def changepoints(counts, exposure=None, dates=None, method='binseg', cost='poisson', penalty=None, min_size=7,
+                 level=0.95):
+    '''
+    Finds the days a daily series changed level (method = 'binseg' or the exact but slower 'pelt', see
+    binary_segmentation and pelt; cost see prefix_arrays).  penalty defaults to 2 log(n) (BIC for the new level and the date of each change).
+    For each change, lr_stat is twice the log-likelihood gain of splitting the segment between its neighboring
+    changes there, and the confidence interval holds the days whose split is within the level chi-square quantile
+    of the best one (profile likelihood).
+    {Returns : dataframe of date, date_low, date_high, rate_before, rate_after, ratio and lr_stat, one row per change}
+    '''
+    counts = np.asarray(counts, dtype=np.float64)
+    n = len(counts)
+    dates = pd.RangeIndex(n) if dates is None else pd.Index(dates)
+    prefix = prefix_arrays(counts, exposure, cost)
+    if penalty is None:
+        penalty = 2 * np.log(max(n, 2))
+
+    if method == 'pelt':
+        points = pelt(prefix, penalty, min_size)
+    elif method == 'binseg':
+        points = binary_segmentation(prefix, penalty, min_size)
+    else:
+        raise ValueError(f"Unknown method '{method}' (use 'pelt' or 'binseg')")
+
+    bounds = [0] + points + [n]
+    threshold = stats.chi2.ppf(level, 1) / 2
+    results = []
+    for lo, point, hi in zip(bounds[:-2], bounds[1:-1], bounds[2:]):
+        # Gain of every split between the neighboring changes, and the days within the threshold of the best
+        splits = np.arange(lo + 1, hi)
+        gains = segment_cost(prefix, np.array([lo]), np.array([hi])) - segment_cost(prefix, lo, splits) - segment_cost(prefix, splits, hi)
+        gain = gains[point - lo - 1]
+        close = splits[gains >= gain - threshold]
+
+        before = (prefix['x'][point] - prefix['x'][lo]) / (prefix['e'][point] - prefix['e'][lo])
+        after = (prefix['x'][hi] - prefix['x'][point]) / (prefix['e'][hi] - prefix['e'][point])
+        results.append({'date': dates[point], 'date_low': dates[close.min()], 'date_high': dates[close.max()],
+                        'rate_before': before, 'rate_after': after, 'ratio': after / before if before > 0 else np.inf,
+                        'lr_stat': 2 * gain})
+
+    return pd.DataFrame(results, columns=['date', 'date_low', 'date_high', 'rate_before', 'rate_after', 'ratio', 'lr_stat'])
+
+def daily_counts(df, mask=None, days=None):
+    '''
+    Counts the accesses of df (only those in mask, if given) per day over days (the first to last access day of df
+    by default), days without accesses included as zeros
+    {Returns : series of counts indexed by day}
+    '''
+    day = pd.to_datetime(df.accessed).dt.normalize()
+    if days is None:
+        days = pd.date_range(day.min(), day.max(), freq='D')
+    if mask is not None:
+        day = day[np.asarray(mask)]
+
+    return day.value_counts().reindex(days, fill_value=0).sort_index()
+
+def path_changepoints(df, pattern, program_type, rate=True, **options):
+    '''
+    Finds the changes in the daily accesses of program_type users to paths matching the regex pattern (e.g.
+    'science' for Web Development students on Data Science content), as a share of all of their accesses if rate is
+    True.  options go to changepoints.
+    {Returns : dataframe of changes (see changepoints)}
+    '''
+    from wrangle import path_program_flags
+
+    users = df[df.program_type == program_type]
+    matches = path_program_flags(users.path, [('match', pattern)]).match.values
+    exposure = daily_counts(users)
+
+    counts = daily_counts(users, matches, exposure.index)
+    return changepoints(counts.values, exposure.values if rate else None, counts.index, **options)
+
+def cross_curriculum_changepoints(df, df_outliers=None, rate=True, **options):
+    '''
+    Finds the changes in the daily cross-curriculum series of explore.cross_curriculum_access (Web Development users
+    on Data Science content, and Data Science users on Web Development content; user 782 left out), as a share of
+    all accesses of the program's users that day if rate is True.  options go to changepoints.
+    {Returns : dataframe of changes with a direction column}
+    '''
+    from explore import cross_curriculum_access
+
+    if df_outliers is None:
+        df_outliers = df.iloc[:0]
+    daily_wd_to_ds, daily_ds_to_wd = cross_curriculum_access(df, df_outliers)[:2]
+    joint = pd.concat([df, df_outliers])
+    joint = joint[joint.user_id != 782]
+
+    results = []
+    for direction, daily, program_type in [('wd_to_ds', daily_wd_to_ds, 'Web Development'),
+                                           ('ds_to_wd', daily_ds_to_wd, 'Data Science')]:
+        exposure = daily_counts(joint[joint.program_type == program_type])
+        counts = daily.accessed.reindex(exposure.index, fill_value=0)
+        found = changepoints(counts.values, exposure.values if rate else None, counts.index, **options)
+        results.append(found.assign(direction=direction))
+
+    return pd.concat(results, ignore_index=True)[['direction'] + list(found.columns)]
+
+def changepoint_sweep(df, entity='lesson', by='program_type', min_total=100, rate=True, **options):
+    '''
+    Runs changepoints over the daily series of every value of entity within every value of by (e.g. each lesson
+    for each program) with at least min_total accesses, as a share of all accesses of the by group if rate is True.
+    The series come from one count matrix per group (see spikes.daily_matrix) over the same days.
+    {Returns : dataframe of by, entity and the changes of each series (see changepoints)}
+    '''
+    from spikes import daily_matrix
+
+    day = pd.to_datetime(df.accessed)
+    start, end = day.min(), day.max()
+
+    results = []
+    for group, frame in df.groupby(by, observed=True):
+        matrix, entities, days = daily_matrix(frame, entity, start, end)
+        exposure = daily_counts(frame, days=days).values if rate else None
+
+        for i in np.flatnonzero(matrix.sum(axis=1) >= min_total):
+            found = changepoints(matrix[i], exposure, days, **options)
+            if len(found):
+                results.append(found.assign(**{by: group, entity: entities[i]}))
+
+    columns = [by, entity, 'date', 'date_low', 'date_high', 'rate_before', 'rate_after', 'ratio', 'lr_stat']
+    if not results:
+        return pd.DataFrame(columns=columns)
+
+    return pd.concat(results, ignore_index=True)[columns].sort_values('lr_stat', ascending=False).reset_index(drop=True)
@@ -0,0 +1,172 @@
+'''
+Contains the cohort-vs-peers lesson test (question 2: a cohort that referred to a lesson significantly more than
+other cohorts): one sparse cohort x lesson count matrix from the wrangled df, every cell tested against the other
+cohorts of its program at once with array math, and the p-values corrected for the number of cells tested
+'''
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sparse
+import scipy.stats as stats
+
+def cohort_exposure(df):
+    '''
+    Measures how much each cohort was on the curriculum: users, days with any access and user-days (distinct
+    user and day pairs), the exposure the lesson counts are normalized by
+    {Returns : dataframe indexed by cohort with users, active_days and user_days}
+    '''
+    frame = pd.DataFrame({'cohort': df.cohort.values, 'user_id': df.user_id.values,
+                          'day': pd.to_datetime(df.accessed).values.astype('datetime64[D]')})
+    frame = frame[frame.cohort.notnull()]
+
+    return pd.DataFrame({'users': frame.drop_duplicates(['cohort', 'user_id']).groupby('cohort', observed=True).size(),
+                         'active_days': frame.drop_duplicates(['cohort', 'day']).groupby('cohort', observed=True).size(),
+                         'user_days': frame.drop_duplicates().groupby('cohort', observed=True).size()})
+
+def cohort_lesson_matrix(df, exclude=('Not Lesson',), active_only=False):
+    '''
+    Counts the accesses of each cohort to each lesson (leaving out the lessons in exclude) in a sparse matrix,
+    from the category codes of the two columns.  active_only = True counts only the accesses made while the cohort
+    was in session (see wrangle.active_mask).
+    {Returns : csr matrix of cohorts x lessons, cohorts index, lessons index, cohort_exposure of the cohorts}
+    '''
+    if active_only:
+        from wrangle import active_mask
+        df = df[active_mask(df)]
+
+    keep = df.cohort.notnull() & df.lesson.notnull() & ~df.lesson.isin(exclude)
+    cohort = df.cohort[keep].astype('category').cat.remove_unused_categories()
+    lesson = df.lesson[keep].astype('category').cat.remove_unused_categories()
+    rows, cols = cohort.cat.codes.values, lesson.cat.codes.values
+
+    # Duplicate (row, col) entries are summed into the counts
+    shape = (len(cohort.cat.categories), len(lesson.cat.categories))
+    matrix = sparse.coo_matrix((np.ones(len(rows), dtype=np.int64), (rows, cols)), shape=shape).tocsr()
+
+    exposure = cohort_exposure(df).reindex(cohort.cat.categories.astype(object))
+
+    return matrix, pd.Index(cohort.cat.categories.astype(object), name='cohort'), pd.Index(lesson.cat.categories.astype(object), name='lesson'), exposure
+
+def adjust_pvalues(p_values, method='fdr_bh', m=None):
+    '''
+    Corrects p-values for multiple testing over m tests (len(p_values) if not given; cells not passed in count as
+    p = 1): method = 'fdr_bh' gives Benjamini-Hochberg q-values (false discovery rate), 'bonferroni' the
+    family-wise Bonferroni bound
+    {Returns : array of adjusted p-values}
+    '''
+    p_values = np.asarray(p_values, dtype=float)
+    m = len(p_values) if m is None else m
+    if len(p_values) == 0:
+        return p_values
+
+    if method == 'bonferroni':
+        return np.minimum(p_values * m, 1)
+    if method != 'fdr_bh':
+        raise ValueError(f"Unknown correction '{method}' (use 'fdr_bh' or 'bonferroni')")
+
+    # p * m / rank, made monotone from the largest p down
+    order = np.argsort(p_values)
+    ranked = p_values[order] * m / np.arange(1, len(p_values) + 1)
+    ranked = np.minimum.accumulate(ranked[::-1])[::-1]
+    adjusted = np.empty_like(ranked)
+    adjusted[order] = np.minimum(ranked, 1)
+
+    return adjusted
+
+def lesson_overreference(df, method='poisson', by='program_type', correction='fdr_bh', alpha=0.05, min_count=5,
+                         min_peers=5, exclude=('Not Lesson',), active_only=False):
+    '''
+    Tests every cohort x lesson cell of the wrangled df for over-reference against the cohort's peers (the other
+    cohorts with the same value of by, e.g. the same program; None compares with all cohorts), leaving the cell's
+    own cohort out of the peer figures.  Only cells with a count (at least min_count) can be over-referenced, so
+    only the nonzero entries of the sparse matrix are computed, all at once:
+    method = 'poisson' tests the count against the peers' accesses per user-day times the cohort's user-days;
+    method = 'binomial' tests the lesson's share of the cohort's lesson accesses against its share among the peers;
+    method = 'zscore' is the leave-one-out z-score of the cohort's accesses per user-day among the peers' rates
+    (peer_rate is then their mean; cells of cohorts with fewer than min_peers peers are not tested).
+    Cells of lessons the peers never accessed have nothing to compare with (an expected count of 0), so they get
+    no p-value or q-value and are never significant.  The p-values are corrected (see adjust_pvalues) over every
+    cell a cohort's peers accessed.
+    {Returns : dataframe ranked by q_value then ratio, with cohort, by, lesson, count, expected, ratio, users,
+               user_days, rate and peer_rate (per user-day), statistic, p_value, q_value and significant (q < alpha)}
+    '''
+    matrix, cohorts, lessons, exposure = cohort_lesson_matrix(df, exclude, active_only)
+
+    # Peer group of each cohort, and a group x cohort indicator to sum cohorts into their groups
+    if by is None:
+        groups = pd.Series('all', index=cohorts)
+    else:
+        groups = df[df.cohort.notnull()].groupby('cohort', observed=True)[by].first().astype(object).reindex(cohorts)
+    group_codes, group_names = pd.factorize(groups.values)
+    indicator = sparse.csr_matrix((np.ones(len(cohorts)), (group_codes, np.arange(len(cohorts)))),
+                                  shape=(len(group_names), len(cohorts)))
+
+    cells = matrix.tocoo()
+    rows, cols, counts = cells.row, cells.col, cells.data.astype(float)
+    g = group_codes[rows]
+
+    user_days = exposure.user_days.values.astype(float)
+    cohort_totals = np.asarray(matrix.sum(axis=1)).ravel().astype(float)
+    group_lesson = (indicator @ matrix).toarray().astype(float)
+    group_user_days = indicator @ user_days
+    group_totals = indicator @ cohort_totals
+    group_cohorts = indicator @ np.ones(len(cohorts))
+
+    # Peer figures: the group's minus the cell's own cohort
+    peer_counts = group_lesson[g, cols] - counts
+    rate = counts / user_days[rows]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        peer_rate = peer_counts / (group_user_days[g] - user_days[rows])
+
+        if method == 'poisson':
+            expected = peer_rate * user_days[rows]
+            statistic = (counts - expected) / np.sqrt(expected)
+            p_values = stats.poisson.sf(counts - 1, expected)
+        elif method == 'binomial':
+            peer_share = peer_counts / (group_totals[g] - cohort_totals[rows])
+            expected = peer_share * cohort_totals[rows]
+            statistic = (counts - expected) / np.sqrt(expected * (1 - peer_share))
+            p_values = stats.binom.sf(counts - 1, cohort_totals[rows], peer_share)
+        elif method == 'zscore':
+            # Sums of the rates and squared rates of every cohort in the group (zero cells add nothing)
+            rate_sums = np.zeros(group_lesson.shape)
+            square_sums = np.zeros(group_lesson.shape)
+            np.add.at(rate_sums, (g, cols), rate)
+            np.add.at(square_sums, (g, cols), rate ** 2)
+            n_peers = group_cohorts[g] - 1
+            peer_mean = (rate_sums[g, cols] - rate) / n_peers
+            peer_var = (square_sums[g, cols] - rate ** 2 - n_peers * peer_mean ** 2) / (n_peers - 1)
+            expected = peer_mean * user_days[rows]
+            peer_rate = peer_mean
+            statistic = (rate - peer_mean) / np.sqrt(peer_var)
+            p_values = np.where(n_peers >= min_peers, stats.norm.sf(statistic), np.nan)
+        else:
+            raise ValueError(f"Unknown method '{method}' (use 'poisson', 'binomial' or 'zscore')")
+        ratio = counts / expected
+
+    # Cells the peers never accessed, or with too few peers for a spread, cannot be tested
+    p_values = np.where(expected > 0, p_values, np.nan)
+    ratio = np.where(expected > 0, ratio, np.nan)
+
+    # Every cell whose lesson the cohort's peers accessed counts as a test, zero cells included (p = 1): all the
+    # cohorts of a group for each lesson it accessed, but the cohort when it is the only one that accessed it
+    accessed_by = (indicator @ (matrix > 0).astype(float)).toarray()
+    tests = (group_lesson > 0) * group_cohorts[:, None] - (accessed_by == 1)
+    if method == 'zscore':
+        tests = tests * (group_cohorts[:, None] - 1 >= min_peers)
+    m = int(tests.sum())
+    tested = counts >= min_count
+    testable = ~np.isnan(p_values[tested])
+    q_values = np.full(tested.sum(), np.nan)
+    q_values[testable] = adjust_pvalues(p_values[tested][testable], correction, m)
+
+    results = pd.DataFrame({'cohort': cohorts.values[rows], by or 'group': groups.values[rows],
+                            'lesson': lessons.values[cols], 'count': counts.astype(int), 'expected': expected,
+                            'ratio': ratio, 'users': exposure.users.values[rows], 'user_days': user_days[rows].astype(int),
+                            'rate': rate, 'peer_rate': peer_rate, 'statistic': statistic, 'p_value': p_values})[tested]
+    results['q_value'] = q_values
+    results['significant'] = results.q_value < alpha
+
+    results = results.sort_values(['q_value', 'ratio', 'cohort', 'lesson'], ascending=[True, False, True, True])
+
+    return results.reset_index(drop=True)
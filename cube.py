@@ -0,0 +1,213 @@
+'''
+Contains the aggregate cubes the explore functions can answer from instead of re-scanning the access frame:
+access counts by (cohort, program_type, lesson, unit, day, is_active), plus per-user counts by
+(user_id, cohort, program_type, is_active) for the lowest access helpers.  Built once from the wrangled df,
+persisted next to the access cache and updated by adding the counts of new rows (rebuilt instead when the
+wrangle of the new rows changed the earlier ones).
+'''
+
+import os
+import json
+import pandas as pd
+from acquire import parquet_available
+from wrangle import join_path_table, active_mask
+
+# Filenames of the persisted cubes (.parquet, or .pkl without pyarrow); their high-water mark is kept next to the
+# lesson cube (see cube_watermark_filename)
+cube_filename = 'access_cube'
+user_cube_filename = 'access_user_cube'
+
+# Dimensions of each cube; every combination that occurs gets a row with its access count
+cube_dimensions = ['cohort', 'program_type', 'lesson', 'unit', 'day', 'is_active']
+user_cube_dimensions = ['user_id', 'cohort', 'program_type', 'is_active']
+
+def cube_columns(df):
+    '''
+    Adds the derived dimensions to the wrangled df: unit (from the parsed distinct paths), day of the access and
+    is_active (accessed within the cohort's start and end dates, from the window tag when df has one)
+    {Returns : df}
+    '''
+    return df.assign(unit=join_path_table(df.path, ['unit']).unit,
+                     day=pd.to_datetime(df.accessed).dt.normalize(),
+                     is_active=active_mask(df))
+
+def build_cube(df, dimensions=cube_dimensions):
+    '''
+    Counts the accesses in the wrangled df for every combination of dimensions (nulls kept as their own value)
+    {Returns : dataframe of dimensions and count}
+    '''
+    # Derive the extra dimensions unless they are there already
+    if not set(['unit', 'day', 'is_active']).issubset(df.columns):
+        df = cube_columns(df)
+
+    cube = df.groupby(dimensions, dropna=False, observed=True).size().rename('count').reset_index()
+
+    return set_cube_dtypes(cube)
+
+def build_cubes(df):
+    '''
+    Builds the lesson cube and the user cube from the wrangled df, deriving the extra dimensions once
+    {Returns : cube, user_cube}
+    '''
+    df = cube_columns(df)
+
+    return build_cube(df, cube_dimensions), build_cube(df, user_cube_dimensions)
+
+def merge_cubes(cube, new_cube):
+    '''
+    Adds the counts of new_cube to cube (both with the same dimensions)
+    {Returns : cube}
+    '''
+    dimensions = [col for col in cube.columns if col != 'count']
+    merged = pd.concat([cube, new_cube[cube.columns]], ignore_index=True)
+
+    merged = merged.groupby(dimensions, dropna=False, observed=True)['count'].sum().reset_index()
+
+    return set_cube_dtypes(merged)
+
+def set_cube_dtypes(cube):
+    '''
+    Stores the string dimensions of a cube as categoricals, so its groupbys run on codes
+    {Returns : cube}
+    '''
+    strings = [col for col in cube.columns if cube[col].dtype == object]
+
+    return cube.astype({col: 'category' for col in strings})
+
+def is_cube(df):
+    '''
+    Tells a cube (or a slice of one) from an access dataframe
+    {Returns : bool}
+    '''
+    return 'count' in df.columns and 'accessed' not in df.columns
+
+def access_counts(df, by):
+    '''
+    Counts accesses by the column(s) in by, from either the wrangled df or a cube holding those columns
+    {Returns : series indexed by by}
+    '''
+    if is_cube(df):
+        return df.groupby(by, observed=True)['count'].sum()
+
+    return df.groupby(by, observed=True).size()
+
+def active_accesses(df):
+    '''
+    Keeps the accesses made while the user's cohort was in session, from either the wrangled df or a cube
+    {Returns : df}
+    '''
+    if is_cube(df):
+        return df[df.is_active == True]
+
+    return df[active_mask(df)]
+
+def get_cubes(df=None, refresh=False, filename=cube_filename, user_filename=user_cube_filename):
+    '''
+    Builds the cubes from the wrangled df and persists them (with df's latest access as their watermark).  Without
+    a df, loads the persisted cubes, or builds them from full_wrangle when they do not exist yet or refresh is True.
+    {Returns : cube, user_cube}
+    '''
+    extension = '.parquet' if parquet_available() else '.pkl'
+    filenames = [filename + extension, user_filename + extension]
+
+    # If the cubes exist already (cached) and no df is given, load them
+    if df is None and not refresh and all(os.path.isfile(f) for f in filenames):
+        return tuple(pd.read_parquet(f) if extension == '.parquet' else pd.read_pickle(f) for f in filenames)
+
+    if df is None:
+        from wrangle import full_wrangle
+        df = full_wrangle()[0]
+
+    cube, user_cube = build_cubes(df)
+    save_cubes(cube, user_cube, filenames)
+    write_cube_watermark(df.accessed.max(), filename, replace=True)
+
+    return cube, user_cube
+
+def update_cubes(df, cube=None, user_cube=None, filename=cube_filename, user_filename=user_cube_filename):
+    '''
+    Adds the accesses of the wrangled df (the full frame, wrangled after a refresh of the access cache) that are
+    newer than the cube watermark to the persisted cubes, without rebuilding them from the full frame.  New rows can
+    change how earlier ones were wrangled (an imputed cohort, a user becoming an outlier); the user cube of the
+    earlier rows of df is checked against the persisted one, and the cubes are rebuilt from df when they differ.
+    {Returns : cube, user_cube}
+    '''
+    watermark = read_cube_watermark(filename)
+    if watermark is None:
+        return get_cubes(df, filename=filename, user_filename=user_filename)
+    if cube is None or user_cube is None:
+        cube, user_cube = get_cubes(filename=filename, user_filename=user_filename)
+
+    accessed = pd.to_datetime(df.accessed)
+    old = accessed <= pd.Timestamp(watermark)
+    if not same_counts(build_cube(df[old], user_cube_dimensions), user_cube):
+        return get_cubes(df, filename=filename, user_filename=user_filename)
+
+    new = df[~old]
+    if new.shape[0] == 0:
+        return cube, user_cube
+
+    new_cube, new_user_cube = build_cubes(new)
+    cube, user_cube = merge_cubes(cube, new_cube), merge_cubes(user_cube, new_user_cube)
+
+    extension = '.parquet' if parquet_available() else '.pkl'
+    save_cubes(cube, user_cube, [filename + extension, user_filename + extension])
+    write_cube_watermark(new.accessed.max(), filename)
+
+    return cube, user_cube
+
+def same_counts(cube, other):
+    '''
+    Checks whether two cubes with the same dimensions hold the same counts (whatever their row order and categories)
+    {Returns : bool}
+    '''
+    dimensions = [col for col in cube.columns if col != 'count']
+    counts = [frame.astype({col: object for col in dimensions if frame[col].dtype == 'category'})
+                   .groupby(dimensions, dropna=False)['count'].sum().sort_index()
+              for frame in [cube, other]]
+
+    return counts[0].equals(counts[1])
+
+def save_cubes(cube, user_cube, filenames):
+    '''
+    Writes the cubes to the given filenames (parquet or pickle by extension)
+    '''
+    for frame, f in zip([cube, user_cube], filenames):
+        if f.endswith('.parquet'):
+            frame.to_parquet(f)
+        else:
+            frame.to_pickle(f)
+
+def cube_watermark_filename(filename=cube_filename):
+    '''
+    Names the high-water mark file of the cubes persisted under filename, so each set of cubes has its own
+    {Returns : filename}
+    '''
+    return f'{filename}_watermark.json'
+
+def read_cube_watermark(filename=cube_filename):
+    '''
+    Reads the latest access counted in the cubes persisted under filename
+    {Returns : watermark string, or None if it has not been recorded}
+    '''
+    if not os.path.isfile(cube_watermark_filename(filename)):
+        return None
+
+    with open(cube_watermark_filename(filename)) as f:
+        return json.load(f)['accessed']
+
+def write_cube_watermark(accessed, filename=cube_filename, replace=False):
+    '''
+    Records accessed as the high-water mark of the cubes persisted under filename: a rebuild (replace = True) sets
+    it, an update keeps the later of the stored and new marks
+    {Returns : watermark string}
+    '''
+    watermark = pd.Timestamp(accessed).strftime('%Y-%m-%d %H:%M:%S')
+    stored = read_cube_watermark(filename)
+    if not replace and stored is not None and stored > watermark:
+        watermark = stored
+
+    with open(cube_watermark_filename(filename), 'w') as f:
+        json.dump({'accessed': watermark}, f)
+
+    return watermark
@@ -7,82 +7,88 @@ import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
 import math
+from wrangle import join_path_table, active_mask, path_program_flags
+from cube import is_cube, access_counts, active_accesses
 
 # --------------------------------------------------
 # Top Lesson and Unit Analysis Functions
 # --------------------------------------------------
 
+def top_n_per_group(df, group_cols, item_col, n=3, exclude=None):
+    '''
+    Finds the n most accessed values of item_col within each group of group_cols (a column name or a list, e.g.
+    'program_type', ['cohort'] or ['cohort', 'month'] after adding a month column), leaving out the values in
+    exclude.  One groupby count, one stable sort of the counts and a cumcount rank; ties go to the first value in
+    sorted order.  df can also be the aggregate cube, or a slice of it, built in cube.py.
+    {Returns : dataframe of group_cols, rank (1 to n), item_col and count, groups in sorted order}
+    '''
+    if isinstance(group_cols, str):
+        group_cols = [group_cols]
+
+    counts = access_counts(df, group_cols + [item_col]).rename('count').reset_index()
+    if exclude is not None:
+        counts = counts[~counts[item_col].isin(exclude)]
+
+    # Most accessed first within each group (ties by value), then number the rows of each group
+    counts = counts.sort_values(group_cols + ['count', item_col], ascending=[True] * len(group_cols) + [False, True])
+    counts['rank'] = counts.groupby(group_cols, observed=True).cumcount() + 1
+    top = counts[counts['rank'] <= n]
+
+    return top[group_cols + ['rank', item_col, 'count']].reset_index(drop=True)
+
+def top_n_table(top, item_col, n=3, label=None):
+    '''
+    Lays out the result of top_n_per_group as one row per group: the group columns (capitalized), then
+    '#1 <label>', '#1 <label> count', ... for each rank.  Groups with fewer than n values are left out.
+    {Returns : dataframe}
+    '''
+    if label is None:
+        label = item_col
+    group_cols = [col for col in top.columns if col not in ['rank', item_col, 'count']]
+
+    # Only groups with all n ranks filled
+    full = top.groupby(group_cols, observed=True)['rank'].transform('max') == n
+    wide = top[full].set_index(group_cols + ['rank'])[[item_col, 'count']].unstack('rank')
+
+    columns = {}
+    for rank in range(1, n + 1):
+        columns[f'#{rank} {label}'] = wide[(item_col, rank)]
+        columns[f'#{rank} {label} count'] = wide[('count', rank)]
+    table = pd.DataFrame(columns, index=wide.index).reset_index()
+
+    return table.rename(columns={col: col.capitalize() for col in group_cols})
+
 def lesson_top_three(df):
     '''
     Emits a dataframe that shows the top three lessons per program, along with counts
+    (df can also be the aggregate cube, or a slice of it, built in cube.py)
     '''
 
     # Prints out the top ten lessons for entire program
-    print(f'Top ten lessons:\n----------\n{df.lesson.value_counts().nlargest(10)}')
-    
-    # Creates a groupby dataframe to pull from
-    df_grouped = df.groupby('cohort').lesson.value_counts()
-    
-    # Initialize a list for a df, initialize a counter to limit loops to top three results
-    top_three = []
-    counter = 0
-
-    # Initializes the start point and first dict needed for loop
-    name = df_grouped.index[0][0]
-    result_row = {}
-    for c in df_grouped.index:
-        if c[0] != name:
-            top_three.append(result_row)
-            counter = 0 
-            result_row={}
-        if counter < 3:
-            if c[1] != 'Not Lesson':
-                result_row['Cohort'] = c[0]
-                result_row[f'#{counter+1} lesson'] = c[1]
-                result_row[f'#{counter+1} lesson count'] = df_grouped[c]
-                counter += 1
-                name = c[0]
-        else:
-            name = c[0]
-    
-    return pd.DataFrame(top_three).dropna().reset_index().drop(columns='index')
+    print(f'Top ten lessons:\n----------\n{access_counts(df, "lesson").nlargest(10)}')
+
+    # Top three lessons of each cohort, skipping the paths that are not lessons
+    top_three = top_n_per_group(df, 'cohort', 'lesson', 3, exclude=['Not Lesson'])
+
+    return top_n_table(top_three, 'lesson', 3)
 
 def unit_top_three(df):
     '''
     Emits a dataframe that shows the top three Units per program, along with counts
+    (df can also be the aggregate cube, or a slice of it, built in cube.py)
     '''
 
-    # Creates the Unit feature by spliting, delimiting on the '/'
-    df['unit'] = df.path.str.split('/', expand=True)[0]
+    # Creates the Unit feature from the parsed distinct paths (the cube has it already)
+    if not is_cube(df):
+        df['unit'] = join_path_table(df.path, ['unit']).unit
 
     # Prints out the top ten lessons for entire program
-    print(f'Top ten units:\n----------\n{df.unit.value_counts().nlargest(10)}')
+    print(f'Top ten units:\n----------\n{access_counts(df, "unit").nlargest(10)}')
 
-    # Creates a groupby dataframe to pull from
-    df_grouped = df.groupby('cohort').unit.value_counts()
-    
-    # Initialize a list for a df, initialize a counter to limit loops to top three results
-    top_three = []
-    counter = 0
-    
-    # Initializes the start point and first dict needed for loop
-    name = df_grouped.index[0][0]
-    result_row = {}
-    for c in df_grouped.index:
-        if c[0] != name:
-            top_three.append(result_row)
-            counter = 0 
-            result_row={}
-        if counter < 3:
-            result_row['Cohort'] = c[0]
-            result_row[f'#{counter+1} unit'] = c[1]
-            result_row[f'#{counter+1} unit count'] = df_grouped[c]
-            counter += 1
-            name = c[0]
-        else:
-            name = c[0]
-    
-    return pd.DataFrame(top_three).dropna().reset_index().drop(columns='index')
+    # Top three units of each cohort
+    top_three = top_n_per_group(df, 'cohort', 'unit', 3)
+
+    return top_n_table(top_three, 'unit', 3)
 
 # --------------------------------------------------
 # Bottom Lessons
@@ -91,25 +97,17 @@ def unit_top_three(df):
 def common_lesson_minimum_access(ds, df):
     '''
     Compares unique lessons for each cohort to determine lessons common to all, then assesses the lowest
+    (ds and df can also be the aggregate cube, or slices of it, built in cube.py)
     '''
     
-    # Create a list of DS cohorts
-    ds_cohorts = ds.groupby('cohort').lesson.nunique().index
-
-    # Now compare the lessons accessed in each cohort to see which have been accessed by all
-    setter = ds[ds.cohort == "Bayes"].lesson.unique()
-    for i in ds_cohorts:
-        unit_list = ds[ds.cohort == i].lesson.unique()
-        setter = list(set(setter).intersection(unit_list)) 
-
-    # Create a dataframe to display the least accessed 'common' lessons
-    qw = []
-    for n in setter:
-        row = {}
-        row['Lesson'] = n
-        row['Count'] = df[df.lesson == n].accessed.count()
-        qw.append(row)
-    qw = pd.DataFrame(qw).set_index('Lesson').Count
+    # Lessons accessed in every cohort of ds: those seen by as many cohorts as there are
+    cohort_lessons = access_counts(ds, ['cohort', 'lesson']).reset_index()
+    cohorts_per_lesson = cohort_lessons.groupby('lesson', observed=True).cohort.nunique()
+    setter = cohorts_per_lesson[cohorts_per_lesson == cohort_lessons.cohort.nunique()].index
+
+    # Create a series to display the least accessed 'common' lessons, counted in one pass over df
+    qw = access_counts(df, 'lesson').reindex(setter, fill_value=0)
+    qw = qw.rename_axis('Lesson').rename('Count')
     qw = qw[qw > 25].nsmallest(10)
 
     return qw
@@ -118,19 +116,33 @@ def common_lesson_minimum_access(ds, df):
 # Alumni access and plots
 # --------------------------------------------------
 
-def cross_curriculum_access(df, df_outliers):
+def cross_curriculum_access(df=None, df_outliers=None, out_dir=None):
+    '''
+    Finds the accesses of Web Development users to Data Science content and of Data Science users to Web
+    Development content, overall, daily and after 2019.  Without df, they are read from the month-partitioned store
+    in out_dir (store.store_dir by default, written by store.write_store(df, df_outliers)), which has the content
+    flags precomputed and the rows in time order; with df (and df_outliers) given they are computed from the frames.
+    {Returns : daily_wd_to_ds_access_df, daily_ds_to_wd_access_df, after_2019, ds_after_2019, wd_to_ds_access_df,
+               ds_to_wd_access_df}
+    '''
+    if df is None:
+        return store_cross_curriculum_access(out_dir)
+
     # join df and outliers as one dataframe
     joint = pd.concat([df, df_outliers])
 
     # removed user 782 since they are incorrectly identified as a DS student
     joint = joint[joint.user_id != 782]
 
-    # create web development and datas science dataframes
-    wd_df = joint[joint.program_type=='Web Development']
-    ds_df = joint[joint.program_type=='Data Science']
+    # flag data science (science) and web development (java) content once per distinct path
+    flags = path_program_flags(joint.path)
+
+    # create web development and datas science masks
+    wd = (joint.program_type=='Web Development').values
+    ds = (joint.program_type=='Data Science').values
 
     # determine what a data science course is using science
-    wd_to_ds_access_df = wd_df[wd_df.path.str.contains('science')]
+    wd_to_ds_access_df = joint[wd & flags.ds_content.values]
     wd_to_ds_access_df = wd_to_ds_access_df.set_index(wd_to_ds_access_df.accessed)
 
     # view daily cross-acess in web development to data science
@@ -140,7 +152,7 @@ def cross_curriculum_access(df, df_outliers):
     after_2019 = wd_to_ds_access_df['2019-12-31':]
 
     # determine what a web development course is using java
-    ds_to_wd_access_df=ds_df[ds_df.path.str.contains('java')]
+    ds_to_wd_access_df=joint[ds & flags.wd_content.values]
 
     # set index to datetime for resampling
     ds_to_wd_access_df=ds_to_wd_access_df.set_index(ds_to_wd_access_df.accessed)
@@ -153,8 +165,49 @@ def cross_curriculum_access(df, df_outliers):
 
     return daily_wd_to_ds_access_df, daily_ds_to_wd_access_df, after_2019, ds_after_2019, wd_to_ds_access_df, ds_to_wd_access_df
 
+def store_cross_curriculum_access(out_dir=None):
+    '''
+    cross_curriculum_access over the month-partitioned store: the store is read once and the cross-program
+    accesses are kept with store.cross_curriculum_rows, which filters on the stored flags instead of searching the
+    paths
+    {Returns : the six frames of cross_curriculum_access, rows in time order}
+    '''
+    from store import store_dir, store_months, read_store, cross_curriculum_rows
+
+    if out_dir is None:
+        out_dir = store_dir
+    if len(store_months(out_dir)) == 0:
+        raise ValueError(f'No access store in {out_dir}: run store.write_store(df, df_outliers) or pass df and df_outliers')
+
+    # The frames hold the wrangled columns, indexed by accessed, like the ones computed from df
+    accesses = read_store(out_dir=out_dir)
+    store_columns = ['outlier', 'ds_content', 'wd_content']
+    wd_to_ds_access_df, ds_to_wd_access_df = [
+        cross_curriculum_rows(accesses, program_type).drop(columns=store_columns).rename_axis('accessed')
+        for program_type in ['Web Development', 'Data Science']]
+
+    # view daily cross-acess in each direction, and the accesses after 2019
+    daily_wd_to_ds_access_df = wd_to_ds_access_df.resample('D').count()
+    daily_ds_to_wd_access_df = ds_to_wd_access_df.resample('D').count()
+    after_2019 = wd_to_ds_access_df['2019-12-31':]
+    ds_after_2019 = ds_to_wd_access_df['2019-12-31':]
+
+    return daily_wd_to_ds_access_df, daily_ds_to_wd_access_df, after_2019, ds_after_2019, wd_to_ds_access_df, ds_to_wd_access_df
+
 
 
+def alumni_top_lessons(df, df_outliers=None, n=3, min_days=0):
+    '''
+    Finds the n lessons each program's graduates access most, from the accesses tagged 'post-graduation' at least
+    min_days after their cohort ended (see wrangle.tag_active_window); df_outliers is included if given
+    {Returns : dataframe of program_type, rank, lesson and count}
+    '''
+    joint = df if df_outliers is None else pd.concat([df, df_outliers])
+
+    alumni = joint[(joint.window == 'post-graduation') & (joint.days_since_end >= min_days)]
+
+    return top_n_per_group(alumni, 'program_type', 'lesson', n, exclude=['Not Lesson'])
+
 def wd_ds_groups(df):
     '''
     This function splits webdev and ds students into two groups and then assigns users activity in each group
@@ -166,26 +219,25 @@ def wd_ds_groups(df):
     ds = df[df.program_type == 'Data Science']
 
     # Filter dataframe for the time when student were 'active' for each program
-    active_wd = wd.loc[(wd.accessed >= wd.start_date) & (wd.accessed <= wd.end_date)]
-    active_ds = ds.loc[(ds.accessed >= ds.start_date) & (ds.accessed <= ds.end_date)]
+    active_wd = wd[active_mask(wd)]
+    active_ds = ds[active_mask(ds)]
 
     #prints number of active wb students compared to ds students:
-    print(f'Number of active WebDev students during their cohort dates:', active_wd.value_counts().sum())
-    print(f'Number of active DataScience students during their cohort dates:', active_ds.value_counts().sum())
+    print(f'Number of active WebDev students during their cohort dates:', active_wd.shape[0])
+    print(f'Number of active DataScience students during their cohort dates:', active_ds.shape[0])
 
 def wd_lowest_access_counts(df):
     '''
     This function pulls the lowest access counts from WebDev students
+    (df can also be the user cube built in cube.py)
     '''
 
     # Filter dataframe for the time when student were 'active' for each program
     wd = df[df.program_type != 'Data Science']
-    ds = df[df.program_type == 'Data Science']
-    active_wd = wd.loc[(wd.accessed >= wd.start_date) & (wd.accessed <= wd.end_date)]
-    active_ds = ds.loc[(ds.accessed >= ds.start_date) & (ds.accessed <= ds.end_date)]
+    active_wd = active_accesses(wd)
 
     #sorting wd students into group of 20 lowest accessed counts:
-    hardly_access_wd = active_wd.groupby('user_id').size().sort_values().head(20)
+    hardly_access_wd = access_counts(active_wd, 'user_id').sort_values().head(20)
 
     return hardly_access_wd
 
@@ -195,15 +247,11 @@ def wd_lowest_barplot(df):
     '''
 
     # Runs df through wd_lowest_access_counts to set up data for visual:
-    wd = df[df.program_type != 'Data Science']
-    active_wd = wd.loc[(wd.accessed >= wd.start_date) & (wd.accessed <= wd.end_date)]
-    hardly_access_wd = active_wd.groupby('user_id').size().sort_values().head(20)
+    hardly_access_wd = wd_lowest_access_counts(df)
 
     #histogram of these users under 20 logged access dates:
-    user_id_count = active_wd.groupby('user_id').size().sort_values()
-    user_id_count = user_id_count[:20]
     plt.figure(figsize=(10,5))
-    sns.barplot(user_id_count.index, user_id_count.values, order=hardly_access_wd.index, palette="viridis")
+    sns.barplot(hardly_access_wd.index, hardly_access_wd.values, order=hardly_access_wd.index, palette="viridis")
     plt.title ('WebDev users with lowest access counts', fontsize=14)
     plt.ylabel('Number of Occurences', fontsize=14)
     plt.xlabel('User Id', fontsize=14)
@@ -212,14 +260,15 @@ def wd_lowest_barplot(df):
 def ds_lowest_access_counts(df):
     '''
     This function pulls the lowest access counts from DS students
+    (df can also be the user cube built in cube.py)
     '''
 
     # Filter dataframe for the time when student were 'active' for each program
     ds = df[df.program_type == 'Data Science']
-    active_ds = ds.loc[(ds.accessed >= ds.start_date) & (ds.accessed <= ds.end_date)]
+    active_ds = active_accesses(ds)
 
     #sorting wd students into group of 20 lowest accessed counts:
-    hardly_access_ds = active_ds.groupby('user_id').size().sort_values().head(20)
+    hardly_access_ds = access_counts(active_ds, 'user_id').sort_values().head(20)
     
     return hardly_access_ds
 
@@ -229,15 +278,11 @@ def ds_lowest_barplot(df):
     '''
 
     # Runs df through ds_lowest_access_counts to set up data for visual:
-    ds = df[df.program_type == 'Data Science']
-    active_ds = ds.loc[(ds.accessed >= ds.start_date) & (ds.accessed <= ds.end_date)]
-    hardly_access_ds = active_ds.groupby('user_id').size().sort_values().head(20)
+    hardly_access_ds = ds_lowest_access_counts(df)
 
     #histogram of these users under 20 logged access dates:
-    user_id_count1 = active_ds.groupby('user_id').size().sort_values()
-    user_id_count1 = user_id_count1[:20]
     plt.figure(figsize=(10,5))
-    sns.barplot(user_id_count1.index, user_id_count1.values, order=hardly_access_ds.index, palette="viridis")
+    sns.barplot(hardly_access_ds.index, hardly_access_ds.values, order=hardly_access_ds.index, palette="viridis")
     plt.title ('DataScience users with lowest access counts', fontsize=14)
     plt.ylabel('Number of Occurences', fontsize=14)
     plt.xlabel('User Id', fontsize=14)
@@ -249,7 +294,7 @@ def user_stacked_plot(columns_to_plot, title, df):
     Parameters: columns_to_plot (list of string): Names of the variables to plot
     '''
 
-    df['is_active'] = (df.accessed >= df.start_date) & (df.accessed <= df.end_date)
+    df['is_active'] = active_mask(df)
     number_of_columns = 2
     number_of_rows = math.ceil(len(columns_to_plot)/2)
 
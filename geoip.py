@@ -0,0 +1,86 @@
+'''
+Contains the offline ip enrichment: looks up the country and ASN of each ip in a local range table
+(start_ip, end_ip, country, asn) instead of querying an online service one ip at a time
+'''
+
+import os
+import pandas as pd
+import numpy as np
+
+# Local range table: csv with start_ip, end_ip, country, asn (ips dotted or as integers)
+ranges_filename = 'ip_ranges.csv'
+
+def ip_to_int(ips):
+    '''
+    Converts dotted IPv4 addresses to integers (-1 for anything that is not an IPv4 address, e.g. IPv6)
+    {Returns : int64 array}
+    '''
+    ips = pd.Series(ips, dtype=object).astype(str)
+    octets = ips.str.extract(r'^(\d{1,3})\.(\d{1,3})\.(\d{1,3})\.(\d{1,3})$').astype(float)
+    valid = octets.notnull().all(axis=1) & (octets <= 255).all(axis=1)
+    values = octets.fillna(0).values.astype(np.int64) @ np.array([1 << 24, 1 << 16, 1 << 8, 1], dtype=np.int64)
+
+    return np.where(valid, values, -1)
+
+def load_ip_ranges(filename=ranges_filename):
+    '''
+    Loads the range table sorted by start_ip, with the ips as integers.  The converted table is cached next to
+    the csv (as parquet, or pickle without pyarrow) and reused until the csv changes.
+    {Returns : dataframe with start_ip, end_ip, country and asn columns}
+    '''
+    from acquire import parquet_available
+    cache_filename = os.path.splitext(filename)[0] + ('.parquet' if parquet_available() else '.pkl')
+
+    # If the converted file exists already (cached) and is newer than the csv, load it
+    if os.path.isfile(cache_filename) and os.path.getmtime(cache_filename) >= os.path.getmtime(filename):
+        return pd.read_parquet(cache_filename) if cache_filename.endswith('.parquet') else pd.read_pickle(cache_filename)
+
+    ranges = pd.read_csv(filename, dtype={'start_ip': str, 'end_ip': str})
+    for col in ['start_ip', 'end_ip']:
+        is_int = ranges[col].str.isdigit()
+        ranges[col] = np.where(is_int, pd.to_numeric(ranges[col].where(is_int), errors='coerce').fillna(-1), ip_to_int(ranges[col]))
+        ranges[col] = ranges[col].astype(np.int64)
+    ranges = ranges[(ranges.start_ip >= 0) & (ranges.end_ip >= ranges.start_ip)].sort_values('start_ip').reset_index(drop=True)
+
+    if cache_filename.endswith('.parquet'):
+        ranges.to_parquet(cache_filename)
+    else:
+        ranges.to_pickle(cache_filename)
+
+    return ranges
+
+def lookup_ips(ips, ranges, columns=('country', 'asn')):
+    '''
+    Finds the range of each ip with one binary search per ip over the sorted range starts
+    {Returns : dataframe of columns (null where no range contains the ip), one row per ip}
+    '''
+    # Without any range, no ip is found (the lookup below needs at least one row to index)
+    if len(ranges) == 0:
+        return pd.DataFrame({col: [None] * len(ips) for col in columns}, dtype=object)
+
+    values = ip_to_int(ips)
+    starts, ends = ranges.start_ip.values, ranges.end_ip.values
+
+    # The last range starting at or before the ip, if it also ends at or after it
+    idx = np.searchsorted(starts, values, side='right') - 1
+    found = (values >= 0) & (idx >= 0) & (values <= ends[np.maximum(idx, 0)])
+
+    result = ranges[list(columns)].iloc[np.maximum(idx, 0)].reset_index(drop=True)
+    return result.where(pd.Series(found), None)
+
+def enrich_ips(df, ranges=None, columns=('country', 'asn')):
+    '''
+    Adds the columns of the range table (country and asn by default) to every access in df: each distinct ip is
+    looked up once and the results are broadcast back through the category codes.  The caller's df is left as it is.
+    {Returns : df with the columns added}
+    '''
+    if ranges is None:
+        ranges = load_ip_ranges()
+
+    ip = df.ip.astype('category')
+    found = lookup_ips(ip.cat.categories, ranges, columns)
+
+    # Code -1 (a null ip) picks the null row added at the end
+    codes = ip.cat.codes.values
+
+    return df.assign(**{col: pd.Categorical(np.append(found[col].values, None)[codes]) for col in columns})
@@ -0,0 +1,370 @@
+'''
+Contains the SQL pushdown of the common aggregations: per-user distinct path, ip, access time, day and hour counts
+(the outlier features of wrangle.user_access_stats), cohort x lesson counts and daily counts are compiled to one
+GROUP BY query each and run inside the database, so only the small result set leaves the server instead of every
+log row.  The same aggregations run in pandas over the cached access data when there is no database to push to,
+and results are cached on disk under the query and the version of the data.  sqlite_standin loads the cached csv
+into a local SQLite file to run the queries against.
+'''
+
+import os
+import sqlite3
+import hashlib
+import warnings
+import numpy as np
+import pandas as pd
+from stage_cache import file_fingerprint, cache_exists, cache_load, cache_save
+
+# Folder holding the cached aggregation results
+pushdown_cache_dir = 'pushdown_cache'
+
+# SQL spelling of the expressions that differ between the database server (MySQL) and the SQLite stand-in
+# (name quotes the column aliases, as count, path and the others can clash with keywords; MySQL strings also take
+# backslash escapes)
+dialects = {'mysql': {'accessed': "CONCAT(logs.date, ' ', logs.time)",
+                      'hour': "CONCAT(logs.date, ' ', HOUR(logs.time))",
+                      'name': '`{}`', 'backslash': True},
+            'sqlite': {'accessed': "logs.date || ' ' || logs.time",
+                       'hour': "logs.date || ' ' || substr(logs.time, 1, 2)",
+                       'name': '"{}"', 'backslash': False}}
+
+# Accesses made while the cohort was in session, as wrangle.active_mask counts them (up to midnight of end_date)
+active_sql = '''CASE WHEN logs.date >= cohorts.start_date AND (logs.date < cohorts.end_date OR
+                          (logs.date = cohorts.end_date AND logs.time = '00:00:00')) THEN 1 ELSE 0 END'''
+
+# Each aggregation: its group by columns (output name, SQL expression) and aggregates (output name, SQL expression)
+aggregations = {'user_stats': {'by': [('user_id', 'logs.user_id')],
+                               'select': [('path', 'COUNT(DISTINCT logs.path)'), ('ip', 'COUNT(DISTINCT logs.ip)'),
+                                          ('accessed', 'COUNT(DISTINCT {accessed})'),
+                                          ('days', 'COUNT(DISTINCT logs.date)'), ('hours', 'COUNT(DISTINCT {hour})'),
+                                          ('hits', 'COUNT(*)')]},
+                'cohort_paths': {'by': [('cohort', 'cohorts.name'), ('program_id', 'cohorts.program_id'),
+                                        ('path', 'logs.path'), ('is_active', active_sql)],
+                                 'select': [('count', 'COUNT(*)')]},
+                'daily': {'by': [('day', 'logs.date')],
+                          'select': [('count', 'COUNT(*)'), ('users', 'COUNT(DISTINCT logs.user_id)')]}}
+
+# Aggregations answered by finishing another one in pandas (on its small result)
+finished_aggregations = {'cohort_lessons': 'cohort_paths'}
+
+def aggregate(name, con=None, engine='auto', cache=True, exclude_staff=True, exclude_non_curriculum=True,
+              start=None, end=None, df=None, cache_dir=pushdown_cache_dir):
+    '''
+    Computes one of the aggregations (name = 'user_stats', 'cohort_paths', 'cohort_lessons' or 'daily') over the
+    raw access logs, leaving out program_id 4 (as initial_drops), Staff if exclude_staff, the non-curriculum paths
+    (wrangle.non_curriculum_rules) if exclude_non_curriculum, and the days outside start to end if given.  These are
+    the raw logs, so the cohort-less accesses the wrangle imputes keep a null cohort (and the outliers are still in).
+    engine = 'sql' runs it in the database of con (a sqlite3 connection, SQLAlchemy connectable or url; the
+    curriculum_logs url from env by default); 'pandas' runs it over df (the cached access data by default);
+    'auto' tries the database and falls back to pandas when the dialect is not supported or the query fails.
+    cache = True reuses the result computed for the same query over the same data (checked with a row count and
+    latest date on the database, or the cache file fingerprint for pandas).
+    {Returns : dataframe (user_stats is indexed by user_id like wrangle.user_access_stats; cohort_lessons has the
+               cohort, program_type, lesson, unit, is_active and count columns of a cube.py cube)}
+    '''
+    base = finished_aggregations.get(name, name)
+    if base not in aggregations:
+        raise ValueError(f"Unknown aggregation '{name}' (use one of {list(aggregations) + list(finished_aggregations)})")
+    if engine not in ['auto', 'sql', 'pandas']:
+        raise ValueError(f"Unknown engine '{engine}' (use 'auto', 'sql' or 'pandas')")
+
+    filters = {'exclude_staff': exclude_staff, 'exclude_non_curriculum': exclude_non_curriculum,
+               'start': start, 'end': end}
+
+    result = None
+    if engine != 'pandas' and df is None:
+        if con is None:
+            from env import get_db_url
+            con = get_db_url('curriculum_logs')
+
+        try:
+            result = sql_aggregate(base, con, cache, cache_dir, **filters)
+        except Exception as error:
+            if engine == 'sql':
+                raise
+            warnings.warn(f'SQL pushdown of {base} failed ({error}), computing it in pandas')
+
+    if result is None:
+        result = pandas_aggregate(base, df, cache, cache_dir, **filters)
+
+    return finish_aggregate(name, result)
+
+def get_dialect(con):
+    '''
+    Tells which SQL dialect a connection or url speaks
+    {Returns : 'sqlite', 'mysql' or None (not supported)}
+    '''
+    if isinstance(con, sqlite3.Connection):
+        return 'sqlite'
+
+    # SQLAlchemy engines and connections carry their dialect, urls start with it
+    name = getattr(getattr(con, 'dialect', None), 'name', None) if not isinstance(con, str) else con.split(':')[0]
+    name = (name or '').split('+')[0]
+
+    return name if name in dialects else None
+
+def compile_query(name, dialect, excluded_paths=(), exclude_staff=True, start=None, end=None):
+    '''
+    Writes the GROUP BY query of an aggregation over logs LEFT JOIN cohorts in dialect, with the filters as a
+    WHERE clause (excluded_paths as a NOT IN list of literals)
+    {Returns : query string}
+    '''
+    spec = aggregations[name]
+    quote = dialects[dialect]
+    by = [f"{expression} AS {quote['name'].format(column)}" for column, expression in spec['by']]
+    select = [f"{expression.format(**quote)} AS {quote['name'].format(column)}" for column, expression in spec['select']]
+
+    where = ['(cohorts.program_id IS NULL OR cohorts.program_id <> 4)']
+    if exclude_staff:
+        where.append("(cohorts.name IS NULL OR cohorts.name <> 'Staff')")
+    if start is not None:
+        where.append(f"logs.date >= {quote_value(pd.Timestamp(start).strftime('%Y-%m-%d'), dialect)}")
+    if end is not None:
+        where.append(f"logs.date <= {quote_value(pd.Timestamp(end).strftime('%Y-%m-%d'), dialect)}")
+    if len(excluded_paths) > 0:
+        paths = ', '.join(quote_value(p, dialect) for p in excluded_paths)
+        where.append(f"(logs.path IS NULL OR logs.path NOT IN ({paths}))")
+
+    columns = ',\n               '.join(by + select)
+    where = ' AND\n                '.join(where)
+
+    # Group by position, so the CASE of is_active does not have to be repeated
+    positions = ', '.join(str(i + 1) for i in range(len(by)))
+
+    return f'''
+            SELECT
+               {columns}
+            FROM
+                logs
+            LEFT JOIN
+                cohorts ON logs.cohort_id = cohorts.id
+            WHERE
+                {where}
+            GROUP BY
+                {positions}
+            '''
+
+def quote_value(value, dialect):
+    '''
+    Writes a string as a SQL literal of dialect, doubling its quotes (and its backslashes for MySQL)
+    {Returns : string}
+    '''
+    value = str(value)
+    if dialects[dialect]['backslash']:
+        value = value.replace('\\', '\\\\')
+
+    return "'" + value.replace("'", "''") + "'"
+
+def sql_aggregate(name, con, cache=True, cache_dir=pushdown_cache_dir, exclude_staff=True,
+                  exclude_non_curriculum=True, start=None, end=None):
+    '''
+    Runs an aggregation inside the database of con.  The non-curriculum paths are found by classifying the
+    distinct paths (a small query) in pandas, then excluded in the aggregation query itself.
+    {Returns : dataframe with the columns of the aggregation}
+    '''
+    from wrangle import classify_paths
+
+    dialect = get_dialect(con)
+    if dialect is None:
+        raise ValueError(f'No SQL dialect for {type(con).__name__} connections')
+
+    version = pd.read_sql('SELECT COUNT(*) AS n, MAX(date) AS latest FROM logs', con).iloc[0].astype(str).tolist()
+
+    excluded_paths = []
+    if exclude_non_curriculum:
+        key = hashlib.sha256(repr(['paths'] + version).encode()).hexdigest()
+        if cache and cache_exists('distinct_paths', key, 'sql', cache_dir):
+            paths = cache_load('distinct_paths', key, 'sql', cache_dir)
+        else:
+            paths = pd.read_sql('SELECT DISTINCT path FROM logs WHERE path IS NOT NULL', con).path
+            if cache:
+                cache_save(paths, 'distinct_paths', key, 'sql', cache_dir)
+        excluded_paths = sorted(paths[pd.notnull(classify_paths(paths.values))])
+
+    query = compile_query(name, dialect, excluded_paths, exclude_staff, start, end)
+    key = hashlib.sha256(repr([query] + version).encode()).hexdigest()
+    if cache and cache_exists(name, key, 'sql', cache_dir):
+        return cache_load(name, key, 'sql', cache_dir)
+
+    result = set_aggregate_dtypes(name, pd.read_sql(query, con))
+    if cache:
+        cache_save(result, name, key, 'sql', cache_dir)
+
+    return result
+
+def pandas_aggregate(name, df=None, cache=True, cache_dir=pushdown_cache_dir, exclude_staff=True,
+                     exclude_non_curriculum=True, start=None, end=None):
+    '''
+    Runs an aggregation in pandas over the raw access data df (as returned by acquire.get_access_data, which is
+    loaded if df is None), giving the same result as sql_aggregate
+    {Returns : dataframe with the columns of the aggregation}
+    '''
+    from acquire import get_access_data, parquet_available, parquet_filename, csv_filename
+    from wrangle import path_reasons
+
+    # Only results computed from the cache file are cached (a frame passed in has no version to check).  The key
+    # comes from the file fingerprint, so a hit is answered without loading the log; a file that does not exist yet
+    # is fingerprinted once get_access_data has written it.
+    key = None
+    if df is None:
+        filename = parquet_filename if parquet_available() else csv_filename
+        key = pandas_key(name, filename, exclude_staff, exclude_non_curriculum, start, end)
+        if cache and key is not None and cache_exists(name, key, 'pandas', cache_dir):
+            return cache_load(name, key, 'pandas', cache_dir)
+        df = get_access_data()
+        if key is None:
+            key = pandas_key(name, filename, exclude_staff, exclude_non_curriculum, start, end)
+
+    accessed = pd.to_datetime(df.date.astype(str)) + pd.to_timedelta(df.time.astype(str))
+    day = accessed.dt.normalize()
+
+    keep = (df.program_id != 4).values
+    if exclude_staff:
+        keep &= (df.name != 'Staff').values
+    if start is not None:
+        keep &= (day >= pd.Timestamp(start).normalize()).values
+    if end is not None:
+        keep &= (day <= pd.Timestamp(end).normalize()).values
+    if exclude_non_curriculum:
+        keep &= path_reasons(df.path).isnull().values
+    df, accessed, day = df[keep], accessed[keep], day[keep]
+
+    if name == 'user_stats':
+        frame = pd.DataFrame({'user_id': df.user_id.values, 'path': df.path.values, 'ip': df.ip.values,
+                              'accessed': accessed.values, 'days': day.values, 'hours': accessed.dt.floor('H').values})
+        result = frame.groupby('user_id').agg(path=('path', 'nunique'), ip=('ip', 'nunique'),
+                                              accessed=('accessed', 'nunique'), days=('days', 'nunique'),
+                                              hours=('hours', 'nunique'), hits=('accessed', 'size')).reset_index()
+    elif name == 'cohort_paths':
+        # As objects: dropna=False keeps the null groups of object columns, but not of the parquet categoricals
+        start_date, end_date = pd.to_datetime(df.start_date), pd.to_datetime(df.end_date)
+        frame = pd.DataFrame({'cohort': df.name.astype(object).values, 'program_id': df.program_id.values,
+                              'path': df.path.astype(object).values,
+                              'is_active': ((accessed >= start_date) & (accessed <= end_date)).astype(int).values})
+        result = frame.groupby(['cohort', 'program_id', 'path', 'is_active'], dropna=False, observed=True).size()
+        result = result.rename('count').reset_index()
+    else:
+        frame = pd.DataFrame({'day': day.values, 'user_id': df.user_id.values})
+        result = frame.groupby('day').agg(count=('user_id', 'size'), users=('user_id', 'nunique')).reset_index()
+
+    result = set_aggregate_dtypes(name, result)
+    if cache and key is not None:
+        cache_save(result, name, key, 'pandas', cache_dir)
+
+    return result
+
+def pandas_key(name, filename, exclude_staff, exclude_non_curriculum, start, end):
+    '''
+    Keys a pandas aggregation on the fingerprint of the access data file it runs over and its filters
+    {Returns : string, or None if the file does not exist}
+    '''
+    fingerprint = file_fingerprint(filename)
+    if fingerprint is None:
+        return None
+
+    return hashlib.sha256(repr([name, fingerprint, exclude_staff, exclude_non_curriculum,
+                                str(start), str(end)]).encode()).hexdigest()
+
+def set_aggregate_dtypes(name, result):
+    '''
+    Gives the results of both engines the same dtypes and row order (the database returns dates as strings or date
+    objects, and groups in no particular order)
+    {Returns : dataframe}
+    '''
+    result = result.copy()
+    by = [column for column, expression in aggregations[name]['by']]
+    for column, expression in aggregations[name]['select']:
+        result[column] = result[column].astype('int64')
+
+    if name == 'user_stats':
+        result['user_id'] = result.user_id.astype('int64')
+    elif name == 'cohort_paths':
+        result['cohort'] = result.cohort.astype(object).where(result.cohort.notnull(), None)
+        result['path'] = result.path.astype(object).where(result.path.notnull(), None)
+        result['program_id'] = result.program_id.astype(float)
+        result['is_active'] = result.is_active.astype(bool)
+    else:
+        result['day'] = pd.to_datetime(result.day.astype(str))
+
+    return result.sort_values(by, na_position='last').reset_index(drop=True)
+
+def finish_aggregate(name, result):
+    '''
+    Shapes the result of an aggregation for the functions that use it: user_stats gets hits_per_hour and the
+    user_id index (ready for wrangle.outlier_users), cohort_lessons sums the cohort_paths counts into the lesson,
+    unit and program_type of each path (split once per distinct path, see wrangle.path_table), daily is indexed by day
+    {Returns : dataframe}
+    '''
+    if name == 'user_stats':
+        result = result.set_index('user_id')
+        result['hits_per_hour'] = result.hits / result.hours
+    elif name == 'cohort_lessons':
+        from wrangle import join_path_table
+
+        result = result[result.cohort.notnull()]
+        splits = join_path_table(result.path, ['lesson', 'unit'])
+        program_type = np.where(result.program_id == 3, 'Data Science',
+                                np.where(result.program_id.isin([1, 2]), 'Web Development', 'Unknown'))
+        result = pd.DataFrame({'cohort': result.cohort.values, 'program_type': program_type,
+                               'lesson': splits.lesson.values, 'unit': splits.unit.values,
+                               'is_active': result.is_active.values, 'count': result['count'].values})
+        result = result.groupby(['cohort', 'program_type', 'lesson', 'unit', 'is_active'], dropna=False,
+                                observed=True)['count'].sum().reset_index()
+    elif name == 'daily':
+        result = result.set_index('day')
+
+    return result
+
+def sqlite_standin(filename='curriculum_logs.db', df=None):
+    '''
+    Builds a local SQLite copy of the curriculum_logs tables the aggregations read (logs and cohorts, with the
+    cohort ids recreated from the distinct cohorts) from the raw access data df (the cached csv by default), to run
+    the pushdown against without the database server.  An existing file is rebuilt.
+    {Returns : sqlite3 connection}
+    '''
+    from acquire import csv_filename
+
+    if df is None:
+        df = pd.read_csv(csv_filename, index_col=0)
+
+    # Dates and times as the 'YYYY-MM-DD' and 'HH:MM:SS' strings the server returns (the parquet cache types them)
+    df = df.copy()
+    for column in ['date', 'start_date', 'end_date']:
+        df[column] = pd.to_datetime(df[column]).dt.strftime('%Y-%m-%d')
+    df['time'] = pd.to_timedelta(df.time.astype(str)).astype('int64') // 10 ** 9
+    df['time'] = (pd.Timestamp(0) + pd.to_timedelta(df.time, unit='s')).dt.strftime('%H:%M:%S')
+
+    cohort_columns = ['name', 'start_date', 'end_date', 'program_id']
+    cohorts = df[cohort_columns].dropna(subset=['name']).drop_duplicates().reset_index(drop=True)
+    cohorts['id'] = np.arange(1, len(cohorts) + 1)
+    logs = df[['date', 'time', 'path', 'user_id', 'ip'] + cohort_columns].merge(cohorts, how='left', on=cohort_columns)
+    logs = logs.rename(columns={'id': 'cohort_id'})[['date', 'time', 'path', 'user_id', 'cohort_id', 'ip']]
+
+    if os.path.isfile(filename):
+        os.remove(filename)
+    con = sqlite3.connect(filename)
+    cohorts[['id'] + cohort_columns].to_sql('cohorts', con, index=False)
+    logs.to_sql('logs', con, index=False)
+    con.execute('CREATE INDEX logs_cohort_id ON logs (cohort_id)')
+    con.commit()
+
+    return con
+
+def compare_engines(con, df=None, **filters):
+    '''
+    Checks that the database and pandas engines agree: runs every aggregation with engine = 'sql' on con (e.g. a
+    sqlite_standin) and engine = 'pandas' on df (the cached access data by default, typed or not), uncached, with
+    the filters of aggregate
+    {Returns : True (raises AssertionError naming the first aggregation that differs)}
+    '''
+    # Both engines run uncached here, so the log is loaded once up front and shared by every aggregation
+    if df is None:
+        from acquire import get_access_data
+        df = get_access_data()
+
+    for name in list(aggregations) + list(finished_aggregations):
+        sql = aggregate(name, con=con, engine='sql', cache=False, **filters)
+        frame = aggregate(name, engine='pandas', cache=False, df=df, **filters)
+        pd.testing.assert_frame_equal(sql, frame, check_dtype=False, obj=name)
+
+    return True
@@ -0,0 +1,376 @@
+'''
+Contains the local query service over the wrangled data: one process acquires and wrangles once, keeps the six
+frames of full_wrangle (compact dtypes) and the cubes of cube.py in memory, and answers the explore.py analyses
+over HTTP as JSON from a pool of threads.  Results are cached per data generation, and a background thread
+re-wrangles when the access cache changes (optionally pulling the new log rows first), swapping the new state in
+without blocking the requests being answered.
+    service = QueryService().start()    # http://127.0.0.1:8050/ lists the endpoints
+    service.stop()
+'''
+
+import json
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qsl
+import pandas as pd
+from acquire import parquet_available, parquet_filename, csv_filename, refresh_access_data
+from stage_cache import file_fingerprint
+
+# Names of the frames returned by full_wrangle, in order
+frame_names = ['df', 'df_staff', 'df_multicohort', 'df_unimputed', 'df_non_curriculum', 'df_outliers']
+
+# Most results kept in the cache (least recently used dropped first)
+result_cache_size = 256
+
+def load_state(cache=True, generation=0):
+    '''
+    Wrangles the cached access data (reusing the stage cache of full_wrangle if cache is True) and builds the cubes
+    the explore functions can answer from
+    {Returns : dict of frames, cube, user_cube, generation, loaded_at and the fingerprint of the access cache read}
+    '''
+    from wrangle import full_wrangle
+    from cube import build_cubes
+
+    # Fingerprint before wrangling, so data written meanwhile is picked up by the next check
+    fingerprint = access_fingerprint()
+    frames = dict(zip(frame_names, full_wrangle(cache=cache)))
+    cube, user_cube = build_cubes(frames['df'])
+
+    return {'frames': frames, 'cube': cube, 'user_cube': user_cube, 'generation': generation,
+            'loaded_at': pd.Timestamp.now().isoformat(timespec='seconds'), 'fingerprint': fingerprint}
+
+def access_fingerprint():
+    '''
+    Fingerprints the access cache full_wrangle reads (see stage_cache.file_fingerprint)
+    {Returns : string, or None if there is no cache}
+    '''
+    return file_fingerprint(parquet_filename if parquet_available() else csv_filename)
+
+# --------------------------------------------------
+# Endpoints: each takes the state and its parameters
+# --------------------------------------------------
+
+def lesson_top_three(state):
+    '''
+    The table of explore.lesson_top_three, without its printed top ten
+    '''
+    from explore import top_n_per_group, top_n_table
+    return top_n_table(top_n_per_group(state['cube'], 'cohort', 'lesson', 3, exclude=['Not Lesson']), 'lesson', 3)
+
+def unit_top_three(state):
+    '''
+    The table of explore.unit_top_three, without its printed top ten
+    '''
+    from explore import top_n_per_group, top_n_table
+    return top_n_table(top_n_per_group(state['cube'], 'cohort', 'unit', 3), 'unit', 3)
+
+def top_lessons(state, by='cohort', n=3, active_only=False):
+    '''
+    The n most accessed lessons of each value of by (e.g. cohort or program_type), in long format
+    '''
+    from explore import top_n_per_group
+    from cube import active_accesses
+
+    cube = active_accesses(state['cube']) if active_only else state['cube']
+    if by not in cube.columns:
+        raise ValueError(f"Unknown column '{by}' (use one of {list(cube.columns[:-1])})")
+
+    return top_n_per_group(cube, by, 'lesson', n, exclude=['Not Lesson'])
+
+def common_lesson_minimum_access(state, program_type='Data Science'):
+    from explore import common_lesson_minimum_access
+
+    cube = state['cube']
+    return common_lesson_minimum_access(cube[cube.program_type == program_type], cube)
+
+def lowest_access(state, program_type='Web Development'):
+    from explore import wd_lowest_access_counts, ds_lowest_access_counts
+
+    if program_type == 'Data Science':
+        return ds_lowest_access_counts(state['user_cube'])
+    if program_type == 'Web Development':
+        return wd_lowest_access_counts(state['user_cube'])
+    raise ValueError(f"Unknown program_type '{program_type}' (use 'Web Development' or 'Data Science')")
+
+def cross_curriculum(state, direction='wd_to_ds'):
+    '''
+    Daily cross-curriculum accesses (see explore.cross_curriculum_access): direction = 'wd_to_ds' or 'ds_to_wd'
+    '''
+    from explore import cross_curriculum_access
+
+    if direction not in ['wd_to_ds', 'ds_to_wd']:
+        raise ValueError(f"Unknown direction '{direction}' (use 'wd_to_ds' or 'ds_to_wd')")
+    daily = cross_curriculum_access(state['frames']['df'], state['frames']['df_outliers'])[0 if direction == 'wd_to_ds' else 1]
+
+    return daily.accessed.rename('count')
+
+def alumni_top_lessons(state, n=3, min_days=0):
+    from explore import alumni_top_lessons
+    return alumni_top_lessons(state['frames']['df'], state['frames']['df_outliers'], n, min_days)
+
+def outliers(state):
+    '''
+    The users removed as outliers, with the rules they broke and their accesses
+    '''
+    df_outliers = state['frames']['df_outliers']
+
+    return df_outliers.groupby('user_id').agg(cohort=('cohort', 'first'), program_type=('program_type', 'first'),
+                                              reason=('reason', 'first'), hits=('accessed', 'size'),
+                                              first=('accessed', 'min'), last=('accessed', 'max'))
+
+def status(state):
+    '''
+    The generation and load time of the data, and the rows and memory of each frame held
+    '''
+    frames = dict(state['frames'], cube=state['cube'], user_cube=state['user_cube'])
+
+    return pd.DataFrame({'rows': {name: len(frame) for name, frame in frames.items()},
+                         'MB': {name: round(frame.memory_usage(deep=True).sum() / 1024 ** 2, 1)
+                                for name, frame in frames.items()}})
+
+# Each endpoint: its function, and the default of every parameter (query string values are cast to its type)
+endpoints = {'lesson_top_three': (lesson_top_three, {}),
+             'unit_top_three': (unit_top_three, {}),
+             'top_lessons': (top_lessons, {'by': 'cohort', 'n': 3, 'active_only': False}),
+             'common_lesson_minimum_access': (common_lesson_minimum_access, {'program_type': 'Data Science'}),
+             'lowest_access': (lowest_access, {'program_type': 'Web Development'}),
+             'cross_curriculum': (cross_curriculum, {'direction': 'wd_to_ds'}),
+             'alumni_top_lessons': (alumni_top_lessons, {'n': 3, 'min_days': 0}),
+             'outliers': (outliers, {}),
+             'status': (status, {})}
+
+def parse_params(name, query):
+    '''
+    Casts the query string parameters of an endpoint to the types of their defaults, filling in the defaults
+    {Returns : dict of parameters}
+    '''
+    defaults = endpoints[name][1]
+    unknown = set(query) - set(defaults)
+    if unknown:
+        raise ValueError(f'Unknown parameters {sorted(unknown)} for {name} (takes {sorted(defaults)})')
+
+    params = dict(defaults)
+    for key, value in query.items():
+        if isinstance(defaults[key], bool):
+            params[key] = value.lower() in ['1', 'true', 'yes']
+        else:
+            params[key] = type(defaults[key])(value)
+
+    return params
+
+def to_json(result):
+    '''
+    Encodes a result (dataframe or series, with its index) as JSON in the 'split' layout of pandas
+    {Returns : bytes}
+    '''
+    if isinstance(result, pd.Series):
+        result = result.to_frame()
+
+    return result.to_json(orient='split', date_format='iso').encode()
+
+class QueryService:
+    '''
+    Holds the wrangled state and the result cache, answers queries against them, and refreshes the state in a
+    background thread: every interval seconds (or when refresh is called) it pulls the new log rows if pull is True,
+    then re-wrangles if the access cache changed.  Requests take the state current when they start, so a swap
+    never mixes two generations in one answer.
+    '''
+
+    def __init__(self, host='127.0.0.1', port=8050, workers=4, interval=60, pull=False, cache=True):
+        self.address = (host, port)
+        self.workers = workers
+        self.interval = interval
+        self.pull = pull
+        self.cache = cache
+        self.state = None
+        self.results = OrderedDict()
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopping = threading.Event()
+        self.server = None
+        self.threads = []
+
+    def start(self):
+        '''
+        Loads the state, then serves and refreshes in background threads
+        {Returns : self}
+        '''
+        if self.state is None:
+            self.state = load_state(self.cache)
+
+        self.server = PooledHTTPServer(self.address, QueryHandler, self.workers)
+        self.server.service = self
+        self.address = self.server.server_address
+        self.stopping.clear()
+        self.threads = [threading.Thread(target=self.server.serve_forever, daemon=True),
+                        threading.Thread(target=self.refresh_loop, daemon=True)]
+        for thread in self.threads:
+            thread.start()
+        print(f'Serving the wrangled data on http://{self.address[0]}:{self.address[1]}/')
+
+        return self
+
+    def serve(self):
+        '''
+        Starts the service and blocks until interrupted
+        '''
+        self.start()
+        try:
+            while not self.stopping.wait(1):
+                pass
+        except KeyboardInterrupt:
+            pass
+        self.stop()
+
+    def stop(self):
+        '''
+        Stops serving and refreshing, letting the requests in progress finish
+        '''
+        self.stopping.set()
+        self.wake.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        for thread in self.threads:
+            thread.join()
+
+    def query(self, name, query=None):
+        '''
+        Answers an endpoint from the result cache, computing it once per generation and parameters: concurrent
+        requests for a result being computed wait for it instead of computing it again.  A request that started on
+        a state replaced meanwhile still answers from it, without caching the result.
+        {Returns : JSON bytes}
+        '''
+        if name not in endpoints:
+            raise ValueError(f'Unknown endpoint {name}')
+        func, defaults = endpoints[name]
+        params = parse_params(name, query or {})
+        state = self.state
+
+        key = (state['generation'], name, tuple(sorted(params.items())))
+        with self.lock:
+            future = self.results.get(key)
+            owner = future is None
+            if owner and key[0] != self.state['generation']:
+                future = Future()
+            elif owner:
+                future = self.results[key] = Future()
+                while len(self.results) > result_cache_size:
+                    self.results.popitem(last=False)
+            else:
+                self.results.move_to_end(key)
+
+        if owner:
+            try:
+                future.set_result(to_json(func(state, **params)))
+            except Exception as error:
+                # Errors are not cached
+                with self.lock:
+                    self.results.pop(key, None)
+                future.set_exception(error)
+
+        return future.result()
+
+    def refresh(self):
+        '''
+        Asks the background thread to check for new data now
+        '''
+        self.wake.set()
+
+    def refresh_loop(self):
+        '''
+        Checks for new data every interval seconds (or when woken) until stopped, swapping in a newly wrangled state
+        when the access cache changed, and dropping the results of older generations
+        '''
+        while not self.stopping.is_set():
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            if self.stopping.is_set():
+                break
+
+            try:
+                if self.pull:
+                    refresh_access_data()
+                if access_fingerprint() == self.state['fingerprint']:
+                    continue
+
+                start = time.time()
+                state = load_state(self.cache, self.state['generation'] + 1)
+                with self.lock:
+                    self.state = state
+                    self.results.clear()
+                print(f"Loaded generation {state['generation']} in {time.time() - start:.1f} seconds")
+            except Exception as error:
+                # Keep serving the current state, and try again next time
+                print(f'Refresh failed ({error})')
+
+class PooledHTTPServer(HTTPServer):
+    '''
+    HTTP server answering each request on one of workers pooled threads (instead of a new thread per request)
+    '''
+
+    def __init__(self, address, handler, workers=4):
+        super().__init__(address, handler)
+        self.pool = ThreadPoolExecutor(workers)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=True)
+
+class QueryHandler(BaseHTTPRequestHandler):
+    '''
+    GET /<endpoint>?param=value answers an endpoint as JSON, GET / lists the endpoints and their parameters,
+    POST /refresh checks for new data
+    '''
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        name = url.path.strip('/')
+        service = self.server.service
+
+        if name == '':
+            body = {'generation': service.state['generation'], 'loaded_at': service.state['loaded_at'],
+                    'endpoints': {name: defaults for name, (func, defaults) in endpoints.items()}}
+            return self.respond(200, json.dumps(body).encode())
+
+        if name not in endpoints:
+            return self.respond(404, json.dumps({'error': f'Unknown endpoint {name}'}).encode())
+
+        try:
+            return self.respond(200, service.query(name, dict(parse_qsl(url.query))))
+        except ValueError as error:
+            return self.respond(400, json.dumps({'error': str(error)}).encode())
+        except Exception as error:
+            return self.respond(500, json.dumps({'error': repr(error)}).encode())
+
+    def do_POST(self):
+        if urlparse(self.path).path.strip('/') != 'refresh':
+            return self.respond(404, json.dumps({'error': 'Only /refresh takes a POST'}).encode())
+
+        self.server.service.refresh()
+        return self.respond(202, json.dumps({'refreshing': True}).encode())
+
+    def respond(self, code, body):
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Requests are not logged to stderr one by one
+        pass
@@ -0,0 +1,117 @@
+'''
+Contains the sessionization of accesses per (user_id, ip) and the bot-likeness scoring of those sessions,
+used to look for web scraping and suspicious ips
+'''
+
+import pandas as pd
+import numpy as np
+from wrangle import join_path_table
+
+# Session features that make a session look automated, and how much each counts toward the bot score
+bot_weights = {'hits_per_minute': 1.0,
+               'regularity': 1.0,
+               'path_coverage': 1.0,
+               'sequential_ratio': 1.0,
+               'hits': 0.5}
+
+def sessionize(df, gap=1800):
+    '''
+    Groups the accesses of each (user_id, ip) into sessions, starting a new session after gap seconds of inactivity.
+    Works on one sort of the accesses rather than per-user loops.
+    {Returns : dataframe of the accesses sorted by user_id, ip and accessed, with session and inter_arrival (seconds
+               since the previous access of the session) columns}
+    '''
+    pairs = df.groupby(['user_id', 'ip'], sort=False, observed=True).ngroup().values
+    seconds = df.accessed.values.astype('datetime64[s]').astype('int64')
+
+    # Sorts by (user_id, ip) pair, then time
+    order = np.lexsort((seconds, pairs))
+    pairs, seconds = pairs[order], seconds[order]
+    df = df.iloc[order]
+
+    # A new session starts at a new pair or after the gap
+    diff = np.diff(seconds, prepend=seconds[:1])
+    new_session = np.ones(len(df), dtype=bool)
+    new_session[1:] = (pairs[1:] != pairs[:-1]) | (diff[1:] > gap)
+
+    return df.assign(session=np.cumsum(new_session) - 1, inter_arrival=np.where(new_session, np.nan, diff))
+
+def session_features(df, gap=1800):
+    '''
+    Sessionizes df (see sessionize) and computes per session: start, end, hits, unique paths, hits per minute,
+    inter-arrival mean/std, regularity (mean over std of the inter-arrivals: high for machine-timed requests),
+    path coverage (share of all distinct paths in df seen in the session) and sequential ratio (share of requests
+    going to the next path of the same unit in alphabetical order, i.e. crawling the lessons in sequence)
+    {Returns : dataframe indexed by session}
+    '''
+    df = sessionize(df, gap)
+    session = df.session.values
+
+    # Codes of the paths in sorted order, so the next lesson of a unit has the next code
+    path = df.path.astype(str)
+    path_codes = pd.Categorical(path, categories=np.sort(path.unique())).codes
+    unit_codes = pd.factorize(join_path_table(path, ['unit']).unit)[0]
+    sequential = np.zeros(len(df), dtype=bool)
+    sequential[1:] = ((session[1:] == session[:-1]) & (unit_codes[1:] == unit_codes[:-1])
+                      & (path_codes[1:] - path_codes[:-1] == 1))
+
+    features = df.assign(path_code=path_codes, sequential=sequential).groupby('session').agg(
+        start=('accessed', 'min'), end=('accessed', 'max'), hits=('accessed', 'count'), paths=('path_code', 'nunique'),
+        inter_arrival_mean=('inter_arrival', 'mean'), inter_arrival_std=('inter_arrival', 'std'),
+        sequential=('sequential', 'sum'))
+
+    # Sessions are numbered in row order, so the user and ip are those of each session's first row (taken by
+    # position: a 'first' aggregation of the categorical ip falls back to a slow per-group path)
+    starts = np.flatnonzero(np.diff(session, prepend=-1) != 0)
+    features.insert(0, 'user_id', df.user_id.values[starts])
+    features.insert(1, 'ip', df.ip.iloc[starts].values)
+
+    minutes = (features.end - features.start).dt.total_seconds() / 60
+    features['hits_per_minute'] = features.hits / np.maximum(minutes, 1)
+    features['regularity'] = features.inter_arrival_mean / (features.inter_arrival_std + 1)
+    features['path_coverage'] = features.paths / len(np.unique(path_codes))
+    features['sequential_ratio'] = features.sequential / np.maximum(features.hits - 1, 1)
+
+    return features.drop(columns='sequential')
+
+def bot_scores(features, weights=None, min_hits=5):
+    '''
+    Scores sessions for bot-likeness: the weighted mean of the robust z-scores (median/MAD of the log1p values,
+    only the high side counted) of the features in weights (default bot_weights).  Sessions with fewer than min_hits
+    hits score 0, since their timing says little.
+    {Returns : features with a bot_score column, most bot-like first}
+    '''
+    if weights is None:
+        weights = bot_weights
+
+    score = pd.Series(0.0, index=features.index)
+    for feature, weight in weights.items():
+        values = np.log1p(features[feature].fillna(0))
+        mad = 1.4826 * (values - values.median()).abs().median()
+        z = (values - values.median()) / (mad if mad > 0 else 1)
+        score += weight * z.clip(lower=0)
+    score = score / sum(weights.values())
+    score[features.hits < min_hits] = 0
+
+    return features.assign(bot_score=score).sort_values('bot_score', ascending=False)
+
+def rank_suspicious(scored, by='ip', top=20):
+    '''
+    Ranks ips (by='ip') or users (by='user_id') by the bot scores of their sessions (from bot_scores)
+    {Returns : dataframe indexed by ip/user_id with sessions, hits, users/ips, max and mean bot score}
+    '''
+    other = 'user_id' if by == 'ip' else 'ip'
+    ranked = scored.groupby(by, observed=True).agg(sessions=('bot_score', 'count'), hits=('hits', 'sum'),
+                                                   **{f'{other}s': (other, 'nunique')},
+                                                   max_bot_score=('bot_score', 'max'), mean_bot_score=('bot_score', 'mean'))
+
+    return ranked.sort_values(['max_bot_score', 'hits'], ascending=False).head(top)
+
+def suspicious_activity(df, gap=1800, top=20):
+    '''
+    Runs the sessionization and scoring on df (e.g. df concatenated with df_outliers) in one call
+    {Returns : scored sessions, top suspicious ips, top suspicious users}
+    '''
+    scored = bot_scores(session_features(df, gap))
+
+    return scored, rank_suspicious(scored, 'ip', top), rank_suspicious(scored, 'user_id', top)
@@ -0,0 +1,108 @@
+'''
+Contains the batch spike detector for daily hits: one dense entity x day count matrix for every lesson, user, ip
+(or any other column) at once, each row scored against its own trailing window (EWMA, Bollinger bands or a robust
+median/MAD band) with array math over all rows together, and every (entity, day) above the threshold returned
+'''
+
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Scale of the MAD that matches the standard deviation of normal data
+mad_scale = 1.4826
+
+def daily_matrix(df, entity='lesson', start=None, end=None):
+    '''
+    Counts the accesses of each value of entity (e.g. 'lesson', 'user_id', 'ip') on each day from start to end
+    (the first and last access day by default), days without accesses included as zeros.  The counts come from one
+    bincount over entity code x day number.
+    {Returns : int32 array of entities x days, entities index, days index}
+    '''
+    day = pd.to_datetime(df.accessed).values.astype('datetime64[D]')
+    start = day.min() if start is None else np.datetime64(pd.Timestamp(start).date(), 'D')
+    end = day.max() if end is None else np.datetime64(pd.Timestamp(end).date(), 'D')
+    keep = (day >= start) & (day <= end) & df[entity].notnull().values
+
+    codes, entities = pd.factorize(df[entity][keep], sort=True)
+    n_days = int((end - start).astype(int)) + 1
+    day_numbers = (day[keep] - start).astype(int)
+
+    counts = np.bincount(codes * n_days + day_numbers, minlength=len(entities) * n_days)
+    days = pd.date_range(pd.Timestamp(start), periods=n_days, freq='D')
+
+    return counts.reshape(len(entities), n_days).astype(np.int32), pd.Index(entities, name=entity), days
+
+def rolling_baseline(matrix, method='mad', window=28, chunk_cells=20000000):
+    '''
+    Scores each day of every row against the window days before it (never the day itself, so a spike does not
+    widen its own band), for all rows at once:
+    method = 'bollinger' uses the mean and standard deviation of the window (from running sums);
+    method = 'ewma' uses an exponentially weighted mean and standard deviation with a span of window days (one
+    step per day over every row together);
+    method = 'mad' uses the median and the MAD (scaled like a standard deviation) of the window, in chunks of rows
+    holding at most chunk_cells window values at a time.
+    The first window days have no baseline (NaN).
+    {Returns : baseline array, scale array (both entities x days)}
+    '''
+    x = matrix.astype(np.float64)
+    n_rows, n_days = x.shape
+    baseline = np.full(x.shape, np.nan)
+    scale = np.full(x.shape, np.nan)
+    if n_days <= window:
+        return baseline, scale
+
+    if method == 'bollinger':
+        # Window sums for day t cover days t - window to t - 1
+        sums = np.concatenate([np.zeros((n_rows, 1)), np.cumsum(x, axis=1)], axis=1)
+        squares = np.concatenate([np.zeros((n_rows, 1)), np.cumsum(x ** 2, axis=1)], axis=1)
+        window_sum = sums[:, window:n_days] - sums[:, :n_days - window]
+        window_squares = squares[:, window:n_days] - squares[:, :n_days - window]
+        mean = window_sum / window
+        baseline[:, window:] = mean
+        scale[:, window:] = np.sqrt(np.maximum(window_squares - window * mean ** 2, 0) / (window - 1))
+    elif method == 'ewma':
+        alpha = 2 / (window + 1)
+        mean, var = x[:, 0].copy(), np.zeros(n_rows)
+        for t in range(1, n_days):
+            if t >= window:
+                baseline[:, t], scale[:, t] = mean, np.sqrt(var)
+            diff = x[:, t] - mean
+            mean += alpha * diff
+            var = (1 - alpha) * (var + alpha * diff ** 2)
+    elif method == 'mad':
+        rows_per_chunk = max(1, chunk_cells // ((n_days - window) * window))
+        for lo in range(0, n_rows, rows_per_chunk):
+            # Windows of days t - window to t - 1 for every day t from window on
+            windows = sliding_window_view(x[lo:lo + rows_per_chunk, :-1], window, axis=1)
+            median = np.median(windows, axis=2)
+            baseline[lo:lo + rows_per_chunk, window:] = median
+            scale[lo:lo + rows_per_chunk, window:] = mad_scale * np.median(np.abs(windows - median[:, :, None]), axis=2)
+    else:
+        raise ValueError(f"Unknown method '{method}' (use 'mad', 'bollinger' or 'ewma')")
+
+    return baseline, scale
+
+def detect_spikes(df, entity='lesson', method='mad', window=28, threshold=3.5, min_count=10, min_scale=1.0,
+                  start=None, end=None):
+    '''
+    Finds the days each value of entity (e.g. 'lesson', 'user_id', 'ip') was accessed far more than in the window
+    days before (see rolling_baseline for the methods), for every value at once: a spike is a day with a score
+    (count - baseline) / scale above threshold and at least min_count accesses.  The scale is floored at min_scale
+    so series that are mostly zeros do not flag every access.
+    {Returns : dataframe of entity, day, count, baseline, scale and score, highest score first}
+    '''
+    matrix, entities, days = daily_matrix(df, entity, start, end)
+
+    # Only rows reaching min_count on some day can spike
+    candidates = matrix.max(axis=1) >= min_count
+    matrix, entities = matrix[candidates], entities[candidates]
+    baseline, scale = rolling_baseline(matrix, method, window)
+
+    with np.errstate(invalid='ignore'):
+        score = (matrix - baseline) / np.maximum(scale, min_scale)
+        rows, cols = np.nonzero((score > threshold) & (matrix >= min_count))
+
+    spikes = pd.DataFrame({entity: entities.values[rows], 'day': days.values[cols], 'count': matrix[rows, cols],
+                           'baseline': baseline[rows, cols], 'scale': scale[rows, cols], 'score': score[rows, cols]})
+
+    return spikes.sort_values(['score', entity, 'day'], ascending=[False, True, True]).reset_index(drop=True)
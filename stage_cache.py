@@ -0,0 +1,145 @@
+'''
+Contains the disk memoization used by full_wrangle(cache=True): each stage's output is pickled under a key chained
+from the input file fingerprint and the code version and parameters of every stage up to it, so only the stages
+downstream of a change re-run.  The cache folder is kept under a size budget by evicting the least recently used
+entries.
+'''
+
+import os
+import types
+import hashlib
+import inspect
+import pandas as pd
+import numpy as np
+
+# Folder holding the cached stage outputs, and its size budget in bytes
+stage_cache_dir = 'wrangle_cache'
+cache_max_bytes = 2 * 1024 ** 3
+
+def file_fingerprint(filename):
+    '''
+    Fingerprints an input file by name, size and modification time (cheap, and changes whenever the file is rewritten)
+    {Returns : string, or None if the file does not exist}
+    '''
+    if not os.path.isfile(filename):
+        return None
+    stat = os.stat(filename)
+
+    return f'{os.path.abspath(filename)}:{stat.st_size}:{stat.st_mtime_ns}'
+
+def code_names(code):
+    '''
+    Collects the global names used by a code object and the code objects nested in it (comprehensions, lambdas)
+    {Returns : set of names}
+    '''
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= code_names(const)
+
+    return names
+
+def code_version(func, seen=None):
+    '''
+    Hashes the source and default parameters of func, plus the source of the functions and the values of the
+    constants of its own module that it uses (recursively), and the pandas/numpy versions
+    {Returns : hex digest}
+    '''
+    top = seen is None
+    if top:
+        seen = set()
+    seen.add(func.__name__)
+
+    parts = [inspect.getsource(func), repr(inspect.signature(func))]
+    for name in sorted(code_names(func.__code__)):
+        value = func.__globals__.get(name)
+        if name in seen or value is None:
+            continue
+        if isinstance(value, types.FunctionType) and value.__module__ == func.__module__:
+            parts.append(code_version(value, seen))
+        elif isinstance(value, (list, tuple, dict, set, str, int, float)):
+            seen.add(name)
+            parts.append(f'{name} = {value!r}')
+    if top:
+        parts += [pd.__version__, np.__version__]
+
+    return hashlib.sha1('\n'.join(parts).encode()).hexdigest()
+
+def chain_key(previous, name, func):
+    '''
+    Keys a stage on the key of the stage before it (or the input fingerprint) and its own name and code version
+    {Returns : hex digest}
+    '''
+    return hashlib.sha1(f'{previous}\n{name}\n{code_version(func)}'.encode()).hexdigest()
+
+def cache_filename(name, key, part, cache_dir=stage_cache_dir):
+    '''
+    Names the file of one part ('df' for the frame passed on, 'side' for the frames split off) of a stage output
+    {Returns : filename}
+    '''
+    return os.path.join(cache_dir, f'{name}-{key[:16]}-{part}.pkl')
+
+def cache_exists(name, key, part, cache_dir=stage_cache_dir):
+    '''
+    Checks whether a stage output part is cached
+    {Returns : bool}
+    '''
+    return os.path.isfile(cache_filename(name, key, part, cache_dir))
+
+def cache_load(name, key, part, cache_dir=stage_cache_dir):
+    '''
+    Loads a cached stage output part, marking it as recently used
+    {Returns : the cached object}
+    '''
+    filename = cache_filename(name, key, part, cache_dir)
+    obj = pd.read_pickle(filename)
+    os.utime(filename)
+
+    return obj
+
+def cache_save(obj, name, key, part, cache_dir=stage_cache_dir, max_bytes=cache_max_bytes):
+    '''
+    Pickles a stage output part, then evicts the least recently used entries beyond max_bytes
+    {Returns : filename}
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    filename = cache_filename(name, key, part, cache_dir)
+    pd.to_pickle(obj, filename)
+    evict(cache_dir, max_bytes, keep=[filename])
+
+    return filename
+
+def evict(cache_dir=stage_cache_dir, max_bytes=cache_max_bytes, keep=()):
+    '''
+    Deletes the least recently used files of cache_dir (oldest modification time first, loads refresh it) until the
+    folder fits in max_bytes, never deleting the files in keep
+    {Returns : list of deleted filenames}
+    '''
+    if not os.path.isdir(cache_dir):
+        return []
+
+    entries = []
+    for filename in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, filename)
+        stat = os.stat(path)
+        entries.append((stat.st_mtime_ns, stat.st_size, path))
+    total = sum(size for mtime, size, path in entries)
+
+    deleted = []
+    for mtime, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path in keep:
+            continue
+        os.remove(path)
+        total -= size
+        deleted.append(path)
+
+    return deleted
+
+def clear_cache(cache_dir=stage_cache_dir):
+    '''
+    Deletes every cached stage output
+    {Returns : list of deleted filenames}
+    '''
+    return evict(cache_dir, max_bytes=-1)
@@ -0,0 +1,123 @@
+'''
+Contains the month-partitioned store of the wrangled accesses, for time-range queries such as cross-curriculum
+access after a cutoff: each month is one file sorted by accessed, with the program-of-path flags precomputed, so a
+query reads only the months it covers and slices them by binary search instead of scanning the whole frame
+'''
+
+import os
+import shutil
+import pandas as pd
+from acquire import parquet_available
+from wrangle import path_program_flags
+
+# Folder holding one month=YYYY-MM folder per month of accesses
+store_dir = 'access_store'
+
+def write_store(df, df_outliers=None, out_dir=store_dir):
+    '''
+    Writes the wrangled df (plus df_outliers, marked by an outlier column and keeping its reason, if given) to
+    out_dir partitioned by month of access, each partition sorted by accessed and carrying the ds_content /
+    wd_content path flags
+    {Returns : list of months written}
+    '''
+    frames = [df.assign(outlier=False)]
+    if df_outliers is not None:
+        frames.append(df_outliers.assign(outlier=True))
+    joint = pd.concat(frames)
+
+    # Flags computed once per distinct path, then every row in time order
+    flags = path_program_flags(joint.path)
+    joint = joint.assign(ds_content=flags.ds_content.values, wd_content=flags.wd_content.values)
+    joint = joint.sort_values('accessed', kind='mergesort')
+
+    shutil.rmtree(out_dir, ignore_errors=True)
+    extension = '.parquet' if parquet_available() else '.pkl'
+    months = joint.accessed.dt.strftime('%Y-%m')
+    for month, part in joint.groupby(months.values, sort=True):
+        folder = os.path.join(out_dir, f'month={month}')
+        os.makedirs(folder)
+        if extension == '.parquet':
+            part.to_parquet(os.path.join(folder, 'part' + extension))
+        else:
+            part.to_pickle(os.path.join(folder, 'part' + extension))
+
+    return sorted(months.unique())
+
+def store_months(out_dir=store_dir):
+    '''
+    Lists the months held in the store
+    {Returns : sorted list of 'YYYY-MM' strings}
+    '''
+    if not os.path.isdir(out_dir):
+        return []
+
+    return sorted(folder.split('=')[1] for folder in os.listdir(out_dir) if folder.startswith('month='))
+
+def read_store(start=None, end=None, columns=None, out_dir=store_dir):
+    '''
+    Reads the accesses between start and end (inclusive; dates or timestamps, None for open-ended), loading only the
+    months in that range and slicing their sorted accessed index by binary search
+    {Returns : dataframe indexed by accessed, in time order}
+    '''
+    start = None if start is None else pd.Timestamp(start)
+    end = None if end is None else pd.Timestamp(end)
+
+    # A date without a time covers the whole day
+    if end is not None and end == end.normalize():
+        end = end + pd.Timedelta(days=1) - pd.Timedelta(1)
+
+    months = [month for month in store_months(out_dir)
+              if (start is None or month >= start.strftime('%Y-%m')) and (end is None or month <= end.strftime('%Y-%m'))]
+    if columns is not None and 'accessed' not in columns:
+        columns = ['accessed'] + list(columns)
+
+    parts = []
+    for month in months:
+        folder = os.path.join(out_dir, f'month={month}')
+        filename = os.listdir(folder)[0]
+        if filename.endswith('.parquet'):
+            parts.append(pd.read_parquet(os.path.join(folder, filename), columns=columns))
+        else:
+            part = pd.read_pickle(os.path.join(folder, filename))
+            parts.append(part if columns is None else part[columns])
+    if len(parts) == 0:
+        return pd.DataFrame(columns=columns)
+
+    df = pd.concat(parts)
+    df = df.set_index(pd.DatetimeIndex(df.accessed, name=None))
+
+    # The index is sorted, so the slice is two binary searches
+    lo = 0 if start is None else df.index.searchsorted(start, side='left')
+    hi = len(df) if end is None else df.index.searchsorted(end, side='right')
+
+    return df.iloc[lo:hi]
+
+def cross_curriculum_query(program_type='Web Development', start='2019-12-31', end=None, outliers=True,
+                           columns=None, out_dir=store_dir):
+    '''
+    Finds the accesses to the other program's content by users of program_type between start and end (e.g. Web
+    Development students on Data Science paths after 2019-12-31), like explore.cross_curriculum_access
+    (user 782 is left out, outliers only if outliers is True)
+    {Returns : dataframe indexed by accessed}
+    '''
+    flag = 'ds_content' if program_type == 'Web Development' else 'wd_content'
+    if columns is not None:
+        columns = list(columns) + [col for col in ['user_id', 'program_type', 'outlier', flag] if col not in columns]
+
+    return cross_curriculum_rows(read_store(start, end, columns, out_dir), program_type, outliers)
+
+def cross_curriculum_rows(df, program_type='Web Development', outliers=True):
+    '''
+    Keeps the rows of a store read (see read_store) where users of program_type access the other program's content
+    (user 782 is left out, outliers only if outliers is True)
+    {Returns : dataframe indexed by accessed}
+    '''
+    if df.shape[0] == 0:
+        return df
+
+    flag = 'ds_content' if program_type == 'Web Development' else 'wd_content'
+    keep = (df.program_type == program_type) & df[flag] & (df.user_id != 782)
+    if not outliers:
+        keep &= ~df.outlier
+
+    return df[keep]
@@ -0,0 +1,229 @@
+'''
+Contains a streaming detector that checks each curriculum access as it arrives (instead of after acquire/wrangle),
+keeping a fixed amount of state per user and per ip, plus a harness to replay the cached access data through it
+'''
+
+import csv
+import math
+import time
+from datetime import datetime
+import pandas as pd
+from acquire import csv_filename
+from wrangle import compile_path_rules, outlier_rules
+
+class DistinctSketch:
+    '''
+    HyperLogLog estimate of the number of distinct values added, in a fixed 256 one-byte registers
+    (about 6.5% error; small counts use the exact-ish linear counting estimate)
+    '''
+    __slots__ = ('registers', 'harmonic_sum', 'zeros')
+    size = 256
+
+    def __init__(self):
+        self.registers = bytearray(self.size)
+        self.harmonic_sum = float(self.size)
+        self.zeros = self.size
+
+    def add(self, value):
+        # hash() of an int is the int itself, so it is mixed (splitmix64) to spread sequential ids over the bits
+        h = (hash(value) + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        h = ((h ^ (h >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+        h = ((h ^ (h >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+        h ^= h >> 31
+
+        # Low 8 bits of the hash pick the register, the rest give the rank (position of the first 1 bit)
+        register = h & 0xFF
+        rank = 57 - (h >> 8).bit_length()
+        old = self.registers[register]
+        if rank > old:
+            self.registers[register] = rank
+            self.harmonic_sum += 2.0 ** -rank - 2.0 ** -old
+            if old == 0:
+                self.zeros -= 1
+
+    def count(self):
+        estimate = 0.7182 * self.size * self.size / self.harmonic_sum
+        if estimate <= 2.5 * self.size and self.zeros > 0:
+            estimate = self.size * math.log(self.size / self.zeros)
+        return estimate
+
+class RateTracker:
+    '''
+    Exponentially weighted moving average of the hit rate (hits per hour) with the given half-life in seconds
+    '''
+    __slots__ = ('rate', 'last', 'decay')
+
+    def __init__(self, half_life=3600):
+        self.rate = 0.0
+        self.last = None
+        self.decay = math.log(2) / half_life
+
+    def add(self, seconds):
+        if self.last is not None and seconds > self.last:
+            self.rate *= math.exp(-self.decay * (seconds - self.last))
+        self.last = seconds if self.last is None else max(seconds, self.last)
+        self.rate += self.decay * 3600
+        return self.rate
+
+class EntityState:
+    '''
+    Running state of a user or ip: hits, sketches of the distinct paths and ips (users only, distinct=True), hit
+    rate and the alerts already raised
+    '''
+    __slots__ = ('hits', 'paths', 'ips', 'rate', 'alerts')
+
+    def __init__(self, half_life, distinct=True):
+        self.hits = 0
+        self.paths = DistinctSketch() if distinct else None
+        self.ips = DistinctSketch() if distinct else None
+        self.rate = RateTracker(half_life)
+        self.alerts = set()
+
+class StreamDetector:
+    '''
+    Checks accesses one at a time (dicts with the columns of the acquired data: date, time, path, user_id, ip,
+    name, program_id) and raises an alert the first time a user or ip crosses each threshold:
+    - the upper bounds of the 'bounds' rules in wrangle.outlier_rules (hits, unique paths and unique ips per user),
+      counted on curriculum accesses of non-staff users like remove_outliers;
+    - cross-curriculum access as in explore.cross_curriculum_access (Web Development users on 'science' paths,
+      Data Science users on 'java' paths) after cross_curriculum_cutoff;
+    - an EWMA hit rate over max_hits_per_hour (users and ips), a scraper-like pace.
+    Unique counts are HyperLogLog estimates, so per-entity state stays fixed however many accesses arrive.
+    '''
+
+    def __init__(self, rules=None, cross_curriculum_cutoff='2019-12-31', max_hits_per_hour=200, half_life=3600):
+        if rules is None:
+            rules = outlier_rules
+
+        # The streamable part of the outlier rules: upper bounds on counts that only grow
+        upper = {feature: param[1] for feature, method, param in rules if method == 'bounds'}
+        self.max_hits = upper.get('accessed')
+        self.max_paths = upper.get('path')
+        self.max_ips = upper.get('ip')
+
+        self.cutoff = datetime.fromisoformat(cross_curriculum_cutoff)
+        self.max_hits_per_hour = max_hits_per_hour
+        self.half_life = half_life
+        self.users = {}
+        self.ips = {}
+        self.curriculum = {}
+        self.non_curriculum_regex = compile_path_rules()[0]
+        self.events = 0
+
+    def process(self, event):
+        '''
+        Updates the state of the event's user and ip
+        {Returns : list of alert dicts (accessed, entity, id, alert, value)}
+        '''
+        self.events += 1
+        accessed = datetime.fromisoformat(f"{event['date']} {event['time']}")
+        seconds = accessed.timestamp()
+        path, user_id, ip = event['path'], event['user_id'], event['ip']
+        alerts = []
+
+        # Staff and non-curriculum accesses (classified once per distinct path) are left out like in the wrangle
+        if event.get('name') == 'Staff' or not self.is_curriculum(path):
+            return alerts
+
+        user = self.users.get(user_id)
+        if user is None:
+            user = self.users[user_id] = EntityState(self.half_life)
+        user.hits += 1
+        user.paths.add(path)
+        user.ips.add(ip)
+        user_rate = user.rate.add(seconds)
+
+        ip_state = self.ips.get(ip)
+        if ip_state is None:
+            ip_state = self.ips[ip] = EntityState(self.half_life, distinct=False)
+        ip_state.hits += 1
+        ip_rate = ip_state.rate.add(seconds)
+
+        self.check(alerts, accessed, 'user', user_id, user, 'accessed', user.hits, self.max_hits)
+        self.check(alerts, accessed, 'user', user_id, user, 'path', user.paths.count(), self.max_paths)
+        self.check(alerts, accessed, 'user', user_id, user, 'ip', user.ips.count(), self.max_ips)
+        self.check(alerts, accessed, 'user', user_id, user, 'hits_per_hour', user_rate, self.max_hits_per_hour)
+        self.check(alerts, accessed, 'ip', ip, ip_state, 'hits_per_hour', ip_rate, self.max_hits_per_hour)
+
+        # Cross-curriculum access after the cutoff
+        if accessed > self.cutoff and isinstance(path, str):
+            program_id = float(event.get('program_id') or 'nan')
+            crossed = (program_id in (1.0, 2.0) and 'science' in path) or (program_id == 3.0 and 'java' in path)
+            if crossed and 'cross_curriculum' not in user.alerts:
+                user.alerts.add('cross_curriculum')
+                alerts.append({'accessed': accessed, 'entity': 'user', 'id': user_id,
+                               'alert': 'cross_curriculum', 'value': path})
+
+        return alerts
+
+    def check(self, alerts, accessed, entity, entity_id, state, feature, value, threshold):
+        '''
+        Adds an alert if value is over threshold and this entity has not been alerted for this feature yet
+        '''
+        if threshold is None or value <= threshold or feature in state.alerts:
+            return
+        state.alerts.add(feature)
+        alerts.append({'accessed': accessed, 'entity': entity, 'id': entity_id,
+                       'alert': f'{feature} > {threshold:g}', 'value': value})
+
+    def is_curriculum(self, path):
+        '''
+        Classifies each distinct path once against wrangle.non_curriculum_rules, with their combined regex compiled
+        once in __init__
+        {Returns : bool}
+        '''
+        curriculum = self.curriculum.get(path)
+        if curriculum is None:
+            match = self.non_curriculum_regex.search(path) if isinstance(path, str) else None
+            curriculum = self.curriculum[path] = match is None
+        return curriculum
+
+def tail_log(filename=csv_filename, follow=False, poll=1.0):
+    '''
+    Reads a csv of accesses (like the cached curriculum_access_data.csv) one row at a time; with follow=True it keeps
+    waiting for rows appended to the file, like tail -f, holding back a line until its newline has been written
+    {Yields : dict per access}
+    '''
+    with open(filename, newline='') as f:
+        header = next(csv.reader([f.readline()]))
+        buffer = ''
+        while True:
+            line = f.readline()
+            if not line:
+                if not follow:
+                    return
+                time.sleep(poll)
+                continue
+
+            # A line without its newline is still being written (unless it is the last line of a finished file)
+            buffer += line
+            if follow and not buffer.endswith('\n'):
+                continue
+            line, buffer = buffer, ''
+            if not line.strip():
+                continue
+
+            row = dict(zip(header, next(csv.reader([line]))))
+            row['user_id'] = int(row['user_id'])
+            yield row
+
+def replay(filename=csv_filename, detector=None, limit=None):
+    '''
+    Feeds the cached access csv through a StreamDetector (a default one if not given) and measures its throughput
+    {Returns : alerts dataframe, events per second}
+    '''
+    if detector is None:
+        detector = StreamDetector()
+
+    # Only the events of this replay count toward its throughput (the detector may have seen others before)
+    alerts = []
+    events = 0
+    start = time.perf_counter()
+    for event in tail_log(filename):
+        if limit is not None and events >= limit:
+            break
+        alerts.extend(detector.process(event))
+        events += 1
+    seconds = time.perf_counter() - start
+
+    return pd.DataFrame(alerts, columns=['accessed', 'entity', 'id', 'alert', 'value']), events / seconds
@@ -0,0 +1,39 @@
+'''
+Contains regression tests for the wrangle, run on synthetic logs from benchmark.generate_access_data (python -m pytest)
+'''
+
+import pandas as pd
+import wrangle
+from benchmark import generate_access_data
+
+def serial_stages(df):
+    '''
+    Runs the stages of wrangle.stage_names one after the other, as full_wrangle does with one worker
+    {Returns : df, df_staff, df_multicohort, df_unimputed, df_non_curriculum, df_outliers}
+    '''
+    side = []
+    for name in wrangle.stage_names:
+        output = getattr(wrangle, name)(df)
+        if isinstance(output, tuple):
+            df, side = output[0], side + list(output[1:])
+        else:
+            df = output
+
+    return [df] + side
+
+def test_staff_free_shards():
+    '''
+    A log with only a few staff users leaves most of the parallel shards without Staff rows: the parallel stages
+    must still equal the serial ones, df_staff must hold exactly the staff rows and all six must take wrangle_schema
+    '''
+    raw = generate_access_data(users=300, cohorts=10, hits=30000, staff_fraction=0.01, seed=0)
+
+    serial = serial_stages(raw)
+    parallel = list(wrangle.parallel_stages(wrangle.initial_drops(raw), 6))
+
+    assert len(serial[1]) == (wrangle.initial_drops(raw).name == 'Staff').sum()
+    for name, a, b in zip(['df', 'df_staff', 'df_multicohort', 'df_unimputed', 'df_non_curriculum', 'df_outliers'],
+                          serial, parallel):
+        assert a.user_id.notnull().all(), f'null user_id rows in {name}'
+        pd.testing.assert_frame_equal(a, b, check_categorical=False, obj=name)
+    wrangle.set_wrangle_dtypes(parallel)
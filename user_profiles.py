@@ -0,0 +1,212 @@
+'''
+Contains the content-mix features of each user: a sparse user x lesson TF-IDF matrix from the wrangled df, a k
+nearest neighbor graph over it computed in blocks of users, density-based outlier scores (LOF) and clusters
+(DBSCAN on the neighbor graph) from that graph, and an index answering "users most similar to user X".
+Everything stays sparse or blockwise, so memory grows with the accesses and the block size, not users x users.
+'''
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sparse
+from scipy.sparse.csgraph import connected_components
+
+def user_lesson_counts(df, column='lesson', exclude=('Not Lesson',)):
+    '''
+    Counts the accesses of each user to each value of column (lesson by default, leaving out the values in
+    exclude) in a sparse matrix, from the codes of the two columns
+    {Returns : csr matrix of users x lessons, users index, lessons index}
+    '''
+    keep = df[column].notnull() & ~df[column].isin(exclude)
+    rows, users = pd.factorize(df.user_id[keep], sort=True)
+    cols, lessons = pd.factorize(df[column][keep], sort=True)
+
+    # Duplicate (row, col) entries are summed into the counts
+    counts = sparse.coo_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)), shape=(len(users), len(lessons)))
+
+    return counts.tocsr(), pd.Index(users, name='user_id'), pd.Index(np.asarray(lessons), name=column)
+
+def tfidf(counts, sublinear=True):
+    '''
+    Weights a users x lessons count matrix by TF-IDF: term frequency 1 + log(count) (the raw count if sublinear is
+    False) times the smoothed inverse document frequency log((1 + users) / (1 + users of the lesson)) + 1, each row
+    scaled to unit length so the dot product of two rows is their cosine similarity
+    {Returns : csr matrix (float32)}
+    '''
+    weights = counts.tocsr(copy=True).astype(np.float32)
+    if sublinear:
+        weights.data = 1 + np.log(weights.data)
+
+    users_per_lesson = np.bincount(weights.indices, minlength=weights.shape[1])
+    idf = np.log((1 + weights.shape[0]) / (1 + users_per_lesson)) + 1
+    weights = weights @ sparse.diags(idf.astype(np.float32))
+
+    norms = np.sqrt(np.asarray(weights.multiply(weights).sum(axis=1)).ravel())
+    weights = sparse.diags(1 / np.where(norms > 0, norms, 1).astype(np.float32)) @ weights
+
+    return weights.tocsr()
+
+def knn_graph(matrix, k=10, block=1000):
+    '''
+    Finds the k most similar other users of every user (cosine similarity of the TF-IDF rows), multiplying block
+    rows at a time by the whole matrix so at most block x users similarities are held at once
+    {Returns : neighbors (users x k positions), similarities (users x k), most similar first}
+    '''
+    n_users = matrix.shape[0]
+    k = min(k, n_users - 1)
+    transposed = matrix.T.tocsc()
+    neighbors = np.empty((n_users, k), dtype=np.int64)
+    similarities = np.empty((n_users, k), dtype=np.float32)
+
+    for lo in range(0, n_users, block):
+        hi = min(lo + block, n_users)
+        sims = (matrix[lo:hi] @ transposed).toarray()
+
+        # A user is not its own neighbor
+        sims[np.arange(hi - lo), np.arange(lo, hi)] = -np.inf
+
+        top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+        top_sims = np.take_along_axis(sims, top, axis=1)
+        order = np.argsort(-top_sims, axis=1, kind='stable')
+        neighbors[lo:hi] = np.take_along_axis(top, order, axis=1)
+        similarities[lo:hi] = np.take_along_axis(top_sims, order, axis=1)
+
+    return neighbors, similarities
+
+def local_outlier_factor(neighbors, similarities):
+    '''
+    Scores each user by the local outlier factor over the neighbor graph (cosine distance = 1 - similarity): the
+    average local density of its neighbors over its own.  Around 1 is a typical content mix; well above 1 is a user
+    whose mix is sparser than that of its nearest peers.
+    {Returns : lof array, k_distance array (distance to the kth neighbor)}
+    '''
+    distances = np.maximum(1 - similarities.astype(np.float64), 0)
+    k_distance = distances[:, -1]
+
+    # Reachability distance to each neighbor, floored at the neighbor's own k-distance
+    reach = np.maximum(distances, k_distance[neighbors])
+    density = 1 / np.maximum(reach.mean(axis=1), 1e-10)
+    lof = density[neighbors].mean(axis=1) / density
+
+    return lof, k_distance
+
+def cluster_graph(neighbors, similarities, eps=None, min_samples=5):
+    '''
+    Clusters the users DBSCAN-style on the neighbor graph: a user with at least min_samples neighbors within
+    cosine distance eps is a core user, core users within eps of each other share a cluster (connected components),
+    and other users join the cluster of their nearest core neighbor within eps.  Only the k neighbors of each user
+    are looked at, so min_samples must be at most k.  eps defaults to the median distance of the users to their
+    min_samples-th neighbor, making about half of them core users.
+    {Returns : cluster label array, -1 for noise}
+    '''
+    n_users = neighbors.shape[0]
+    if eps is None:
+        eps = np.median(1 - similarities[:, min_samples - 1])
+    close = (1 - similarities) <= eps
+    core = close[:, :min_samples].sum(axis=1) >= min_samples
+
+    # Links between core users within eps, then one label per connected group of core users
+    rows = np.repeat(np.arange(n_users), neighbors.shape[1])
+    cols = neighbors.ravel()
+    linked = close.ravel() & core[rows] & core[cols]
+    graph = sparse.coo_matrix((np.ones(linked.sum()), (rows[linked], cols[linked])), shape=(n_users, n_users))
+    components = connected_components(graph, directed=False)[1]
+
+    # Core users get their component (renumbered from 0), border users the component of their nearest close core
+    # neighbor, everyone else is noise
+    labels = np.full(n_users, -1)
+    labels[core] = np.unique(components[core], return_inverse=True)[1]
+    border_core = close & core[neighbors]
+    has_core = ~core & border_core.any(axis=1)
+    first = np.argmax(border_core, axis=1)
+    labels[has_core] = labels[neighbors[has_core, first[has_core]]]
+
+    return labels
+
+def program_similarity(matrix, groups):
+    '''
+    Measures how close each user's content mix is to the mix of its group (e.g. program_type): the cosine
+    similarity of its TF-IDF row to the normalized sum of the rows of the group.  A Web Development student reading
+    mostly Data Science lessons scores low here even when other users share the same mix.
+    {Returns : array of similarities}
+    '''
+    codes, names = pd.factorize(groups)
+    indicator = sparse.csr_matrix((np.ones(len(codes)), (np.where(codes >= 0, codes, 0), np.arange(len(codes)))),
+                                  shape=(len(names), len(codes)))
+    centroids = np.asarray((indicator @ matrix).todense())
+    centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-10)
+
+    # One users x groups product, keeping each user's own group
+    sims = np.asarray(matrix @ centroids.T)
+
+    return np.where(codes >= 0, sims[np.arange(len(codes)), np.maximum(codes, 0)], np.nan)
+
+def user_profiles(df, k=10, eps=None, min_samples=5, block=1000, column='lesson', exclude=('Not Lesson',)):
+    '''
+    Builds the content-mix profile of every user in the wrangled df: the TF-IDF user x lesson matrix, its k nearest
+    neighbor graph, the local outlier factor and the cluster of each user (see cluster_graph), and the similarity
+    of each user's mix to that of its program (see program_similarity)
+    {Returns : dataframe indexed by user_id with cohort, program_type, hits, lessons, cluster, lof, k_distance,
+               nearest (most similar user) and program_similarity, highest lof first; UserIndex over the same matrix}
+    '''
+    counts, users, lessons = user_lesson_counts(df, column, exclude)
+    matrix = tfidf(counts)
+    neighbors, similarities = knn_graph(matrix, k, block)
+    lof, k_distance = local_outlier_factor(neighbors, similarities)
+
+    info = df.groupby('user_id')[['cohort', 'program_type']].first().reindex(users).astype(object)
+    profiles = pd.DataFrame({'cohort': info.cohort.values, 'program_type': info.program_type.values,
+                             'hits': np.asarray(counts.sum(axis=1)).ravel().astype(int),
+                             'lessons': np.diff(counts.indptr),
+                             'cluster': cluster_graph(neighbors, similarities, eps, min(min_samples, neighbors.shape[1])),
+                             'lof': lof, 'k_distance': k_distance, 'nearest': users.values[neighbors[:, 0]],
+                             'program_similarity': program_similarity(matrix, info.program_type.values)},
+                            index=users)
+
+    return profiles.sort_values('lof', ascending=False), UserIndex(matrix, users, lessons)
+
+class UserIndex:
+    '''
+    Nearest neighbor lookup over the TF-IDF user x lesson matrix: a query is one sparse matrix-vector product
+    against every user (milliseconds for tens of thousands of users) and a partial sort of the similarities
+    '''
+
+    def __init__(self, matrix, users, lessons):
+        self.matrix = matrix.tocsr()
+        self.users = users
+        self.lessons = lessons
+        self.positions = pd.Series(np.arange(len(users)), index=users)
+
+    @classmethod
+    def from_frame(cls, df, column='lesson', exclude=('Not Lesson',)):
+        '''
+        Builds the index from the wrangled df
+        {Returns : UserIndex}
+        '''
+        counts, users, lessons = user_lesson_counts(df, column, exclude)
+
+        return cls(tfidf(counts), users, lessons)
+
+    def similar(self, user_id, n=10):
+        '''
+        Finds the n users whose content mix is most like user_id's
+        {Returns : series of cosine similarity indexed by user_id, most similar first}
+        '''
+        position = self.positions[user_id]
+        sims = (self.matrix @ self.matrix[position].T).toarray().ravel()
+        sims[position] = -np.inf
+
+        n = min(n, len(sims) - 1)
+        top = np.argpartition(-sims, n - 1)[:n]
+        top = top[np.argsort(-sims[top], kind='stable')]
+
+        return pd.Series(sims[top], index=self.users[top], name='similarity')
+
+    def top_lessons(self, user_id, n=10):
+        '''
+        Lists the lessons weighing most in user_id's profile
+        {Returns : series of TF-IDF weight indexed by lesson, highest first}
+        '''
+        row = self.matrix[self.positions[user_id]]
+        weights = pd.Series(row.data, index=self.lessons[row.indices], name='weight')
+
+        return weights.nlargest(n)
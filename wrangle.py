@@ -3,76 +3,354 @@ This library consists of the functions which turn the access log SQL query into
 as well as additional dataframes with dropped columns for anomaly detection
 '''
 
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import logging
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
-import scipy.stats as stats
 from acquire import get_access_data
-from IPython.display import display
+from stage_cache import stage_cache_dir, file_fingerprint, chain_key, cache_exists, cache_load, cache_save
 
-def full_wrangle():
+# Users whose visits were partially recorded in a cohort and partially as a Null: cohort, start_date, end_date, program_id
+known_cohorts = {358: ['Bayes', '2019-08-19', '2020-01-30', 3.0],
+                 375: ['Andromeda', '2019-03-18', '2019-07-30', 2.0],
+                 644: ['Ganymede', '2020-03-23', '2020-08-20', 2.0]}
+
+# Accesses not related to the curriculum: (reason, regex searched in the path), the first match wins
+non_curriculum_rules = [('home page', '^/$'),
+                        ('table of contents', '^toc$'),
+                        ('image', 'jpeg|jpg'),
+                        ('json', 'json'),
+                        ('appendix', '[Aa]ppendix')]
+
+# Outlier rules on the per-user stats: (feature, method, param), see get_bounds
+# (bounds we set manually from the IQR of each feature, with minimums because the lower IQR bounds were negative)
+outlier_rules = [('accessed', 'bounds', (50, 2669)),
+                 ('path', 'bounds', (10, 331)),
+                 ('ip', 'bounds', (2, 17))]
+
+# Paths holding each program's content: (flag column, regex searched in the path), see path_program_flags
+program_content_rules = [('ds_content', 'science'),
+                         ('wd_content', 'java')]
+
+# Where an access falls relative to the user's cohort windows (see tag_active_window)
+window_labels = ['pre-start', 'active', 'post-graduation']
+
+# The stages of full_wrangle between get_access_data and the window tags, in order
+stage_names = ['initial_drops', 'add_and_set_columns', 'split_path', 'remove_staff', 'impute_cohorts',
+               'remove_non_curriculum', 'remove_outliers']
+
+# Rules behind the frames each stage splits off df, in the order of its outputs (see run_stage); a 'reason' column
+# in a frame breaks its rule down further
+stage_removals = {'remove_staff': ['staff'],
+                  'impute_cohorts': ['multicohort', 'unimputed'],
+                  'remove_non_curriculum': ['non_curriculum'],
+                  'remove_outliers': ['outlier'],
+                  'parallel_stages': ['staff', 'multicohort', 'unimputed', 'non_curriculum', 'outlier']}
+
+# Columns chunked_wrangle spills to user_id buckets for the outlier stats, with their arrow types
+bucket_columns = {'user_id': 'int64', 'path': 'string', 'ip': 'string', 'accessed': 'timestamp[ns]'}
+
+# Logger the stage records go to as json lines when full_wrangle(log=True)
+stage_logger = logging.getLogger('wrangle')
+
+# Dtypes of the wrangled dataframes; the categories of each categorical are shared by all of them (see set_wrangle_dtypes)
+wrangle_schema = {'accessed': 'datetime64[ns]',
+                  'path': 'category',
+                  'ip': 'category',
+                  'user_id': 'Int32',
+                  'program_id': 'Int8',
+                  'program_type': 'category',
+                  'cohort': 'category',
+                  'start_date': 'datetime64[ns]',
+                  'end_date': 'datetime64[ns]',
+                  'lesson': 'category',
+                  'hour': 'Int8',
+                  'reason': 'category',
+                  'window': pd.CategoricalDtype(window_labels),
+                  'days_since_end': 'Int16'}
+
+# Users listed in more than one cohort
+multi_cohort_users = [25, 64, 88, 118, 120, 143, 268, 346, 419, 522, 663, 707, 752, 895]
+
+def full_wrangle(workers=1, cache=False, cache_dir=stage_cache_dir, memory_report=False, hooks=None, log=False,
+                 report=False):
     '''
     This combines all the wrangling sub-functions found below and is called without an argument (pulls df from acquire)
+    workers = number of processes; above 1 the stages run on user_id shards in parallel (see parallel_stages), with
+    the same output as the serial run
+    cache = if True (serial run only), each stage's output is kept in cache_dir and reused while the cached access
+    data and the code of the stage and the ones before it are unchanged (see cached_stages)
+    memory_report = if True, also displays the memory footprint of each dataframe before and after wrangle_schema
+    hooks = list of functions called with the record of each stage as it finishes (see run_stage)
+    log = if True, the stage records also go to the 'wrangle' logger as json lines (see log_stage)
+    report = if True, the stage records are returned too, after the six dataframes (see stage_report)
     {Returns :  df (fully cleaned dataframe);
                 df_staff (dataframe where accessing cohort == 'Staff);
                 df_multicohort (dataframe of accesses for those listed in more than one cohort);
                 df_unimputed (dataframe with accesses for those whose cohorts were not known nor could not easily be imputed);
                 df_non_curriculum (dataframe for accessess not related to the curriculum, i.e. directories, images);
                 df_outliers (dataframe of accesses with those users meeting outlier conditions)}
-    {Returns : df, df_staff, df_multicohort, df_unimputed, df_non_curriculum, df_outliers}
+    {Returns : df, df_staff, df_multicohort, df_unimputed, df_non_curriculum, df_outliers (and the stage report)}
     '''
+    records = []
+    hooks = list(hooks or []) + ([log_stage] if log else [])
 
-    df = get_access_data()
-    df_raw_cnt = df.shape[0]
+    if cache and workers <= 1:
+        # Each stage comes from the cache while its inputs and code are unchanged
+        df_raw_cnt, df, df_staff, df_multicohort, df_unimputed, df_non_curriculum, df_outliers = cached_stages(cache_dir, records, hooks)
+    else:
+        df = run_stage('get_access_data', get_access_data, (), records, hooks)
+        df_raw_cnt = df.shape[0]
 
-    df = initial_drops(df)
-    df = add_and_set_columns(df)
-    df = split_path(df)
+        df = run_stage('initial_drops', initial_drops, (df,), records, hooks)
 
-    df, df_staff = remove_staff(df)
-    df_staff_cnt = df_staff.shape[0]
+        if workers > 1:
+            df, df_staff, df_multicohort, df_unimputed, df_non_curriculum, df_outliers = run_stage('parallel_stages', parallel_stages, (df, workers), records, hooks)
+        else:
+            df = run_stage('add_and_set_columns', add_and_set_columns, (df,), records, hooks)
+            df = run_stage('split_path', split_path, (df,), records, hooks)
+
+            df, df_staff = run_stage('remove_staff', remove_staff, (df,), records, hooks)
+
+            df, df_multicohort, df_unimputed = run_stage('impute_cohorts', impute_cohorts, (df,), records, hooks)
+
+            df, df_non_curriculum = run_stage('remove_non_curriculum', remove_non_curriculum, (df,), records, hooks)
 
-    df, df_multicohort, df_unimputed = impute_cohorts(df)
+            df, df_outliers = run_stage('remove_outliers', remove_outliers, (df,), records, hooks)
+
+    df_staff_cnt = df_staff.shape[0]
     df_multicohort_cnt = df_multicohort.shape[0]
     df_unimputed_cnt = df_unimputed.shape[0]
-
-    df, df_non_curriculum = remove_non_curriculum(df)
     df_non_curriculum_cnt = df_non_curriculum.shape[0]
-
-    df, df_outliers = remove_outliers(df)
     df_outliers_cnt = df_outliers.shape[0]
-
-    df = null_filler(df)
     df_final_cnt = df.shape[0]
 
+    # Tag every access with its place relative to the user's cohort windows
+    df, df_multicohort, df_outliers = run_stage('tag_active_window', tag_frames, ([df, df_multicohort, df_outliers],), records, hooks)
+
+    # Compact dtypes, with the categories of each column shared by all six dataframes (nulls stay nulls)
+    frames = [df, df_staff, df_multicohort, df_unimputed, df_non_curriculum, df_outliers]
+    typed = run_stage('set_wrangle_dtypes', set_wrangle_dtypes, (frames,), records, hooks)
+    if memory_report:
+        show(wrangle_memory_report(frames, typed))
+    df, df_staff, df_multicohort, df_unimputed, df_non_curriculum, df_outliers = typed
+
     # Display results of wrangle as dataframe
-    fcp = f'{100*(df_final_cnt/df_raw_cnt):.3}%'
-    dfs = f'{100*(df_staff_cnt/df_raw_cnt):.3}%'
-    dfm = f'{100*(df_multicohort_cnt/df_raw_cnt):.3}%'
-    dfu = f'{100*(df_unimputed_cnt/df_raw_cnt):.3}%'
-    dfn = f'{100*(df_non_curriculum_cnt/df_raw_cnt):.3}%'
-    dfo = f'{100*(df_outliers_cnt/df_raw_cnt):.3}%'
-    results = [{'Dataframe': 'df','Description':'Fully cleaned dataframe','Record Count':df_final_cnt,'Percent of Raw df':fcp},
-        {'Dataframe': 'df_staff','Description':'Cohort == Staff','Record Count':df_staff_cnt,'Percent of Raw df':dfs},
-        {'Dataframe': 'df_multicohort','Description':'Users listed in more than one cohort','Record Count':df_multicohort_cnt,'Percent of Raw df':dfm},
-        {'Dataframe': 'df_unimputed','Description':'Users with unknown/unimputable cohorts','Record Count':df_unimputed_cnt,'Percent of Raw df':dfu},
-        {'Dataframe': 'df_non_curriculum','Description':'Accessess not related to the curriculum, i.e. directories, images','Record Count':df_non_curriculum_cnt,'Percent of Raw df':dfn},
-        {'Dataframe': 'df_outliers','Description':'Accesses meeting outlier conditions','Record Count':df_outliers_cnt,'Percent of Raw df':dfo}]
+    counts = {'df':df_final_cnt, 'df_staff':df_staff_cnt, 'df_multicohort':df_multicohort_cnt,
+              'df_unimputed':df_unimputed_cnt, 'df_non_curriculum':df_non_curriculum_cnt, 'df_outliers':df_outliers_cnt}
     pd.set_option('display.max_colwidth',None)
     print('This returned the following dataframes (reassign if you missed any):')
-    display(pd.DataFrame(results).set_index('Dataframe'))
-    
+    show(wrangle_results(df_raw_cnt, counts))
+
+    if report:
+        return df, df_staff, df_multicohort, df_unimputed, df_non_curriculum, df_outliers, stage_report(records)
+
     return df, df_staff, df_multicohort, df_unimputed, df_non_curriculum, df_outliers
 
-def initial_drops(df):
+def wrangle_results(df_raw_cnt, counts):
+    '''
+    Builds the table of record counts (and percent of the raw df) for each dataframe returned by the wrangle
+    {Returns : results dataframe}
+    '''
+    descriptions = {'df':'Fully cleaned dataframe',
+                    'df_staff':'Cohort == Staff',
+                    'df_multicohort':'Users listed in more than one cohort',
+                    'df_unimputed':'Users with unknown/unimputable cohorts',
+                    'df_non_curriculum':'Accessess not related to the curriculum, i.e. directories, images',
+                    'df_outliers':'Accesses meeting outlier conditions'}
+    results = [{'Dataframe': name,'Description':descriptions[name],'Record Count':cnt,'Percent of Raw df':f'{100*(cnt/df_raw_cnt):.3}%'}
+               for name, cnt in counts.items()]
+
+    return pd.DataFrame(results).set_index('Dataframe')
+
+def show(obj):
+    '''
+    Displays obj as rich output when running under IPython / Jupyter (IPython already loaded), printing it otherwise,
+    so the wrangle runs in batch jobs without IPython
+    '''
+    if 'IPython' in sys.modules:
+        from IPython.display import display
+        display(obj)
+    else:
+        print(obj)
+
+def peak_rss_mb():
+    '''
+    Reads the peak resident memory of this process so far
+    {Returns : MB, or None where the resource module is not available (Windows)}
+    '''
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+def n_rows(obj):
+    '''
+    Counts the rows of a dataframe, or of the first dataframe in a tuple/list of them
+    {Returns : int, or None}
+    '''
+    if isinstance(obj, (tuple, list)):
+        return n_rows(obj[0]) if len(obj) > 0 else None
+
+    return int(obj.shape[0]) if hasattr(obj, 'shape') else None
+
+def run_stage(name, func, args, records, hooks=()):
+    '''
+    Runs one wrangle stage, func(*args), and appends its record to records: wall time, how much it raised the peak
+    resident memory of the process, rows in (of the first argument) and out (of df, the first output) and the rows
+    removed by each rule.  Rows go to the frames the stage splits off (named in stage_removals, broken down by
+    their 'reason' column if they have one); rows dropped without a frame count under 'dropped'.  Each hook is then
+    called with the record.
+    {Returns : the stage output}
+    '''
+    rows_in = n_rows(args[0]) if len(args) > 0 else None
+    peak_before = peak_rss_mb()
+    start = time.perf_counter()
+
+    output = func(*args)
+
+    seconds = time.perf_counter() - start
+    peak_after = peak_rss_mb()
+    rows_out = n_rows(output)
+
+    removed = {}
+    side = list(output[1:]) if isinstance(output, tuple) else []
+    for rule, frame in zip(stage_removals.get(name, []), side):
+        if 'reason' in frame.columns:
+            for reason, count in frame.reason.value_counts(sort=False).items():
+                removed[f'{rule}: {reason}'] = int(count)
+        else:
+            removed[rule] = int(frame.shape[0])
+    if rows_in is not None and isinstance(output, (pd.DataFrame, tuple)) and rows_in - rows_out - sum(removed.values()) > 0:
+        removed['dropped'] = rows_in - rows_out - sum(removed.values())
+
+    record = {'stage': name, 'seconds': round(seconds, 6),
+              'peak_rss_mb': None if peak_after is None else round(peak_after, 1),
+              'peak_rss_delta_mb': None if peak_after is None else round(peak_after - peak_before, 1),
+              'rows_in': rows_in, 'rows_out': rows_out, 'removed': removed, 'cached': False}
+    records.append(record)
+    for hook in hooks:
+        hook(record)
+
+    return output
+
+def log_stage(record):
+    '''
+    Logs a stage record on the 'wrangle' logger as one json line (at INFO level; e.g.
+    logging.basicConfig(level=logging.INFO) shows them)
+    '''
+    stage_logger.info(json.dumps(record))
+
+def stage_report(records):
+    '''
+    Lays out the stage records of a wrangle run, one row per stage
+    {Returns : dataframe indexed by stage with seconds, peak_rss_mb, peak_rss_delta_mb, rows_in, rows_out, removed and cached}
+    '''
+    return pd.DataFrame(records, columns=['stage', 'seconds', 'peak_rss_mb', 'peak_rss_delta_mb', 'rows_in', 'rows_out',
+                                          'removed', 'cached']).set_index('stage')
+
+def row_lineage(df_staff, df_multicohort, df_unimputed, df_non_curriculum, df_outliers):
+    '''
+    Lists every access the wrangle removed from df with the stage and rule that removed it (the reason, for the
+    frames that have one).  The rows initial_drops drops are not kept anywhere, so only their count is in the
+    stage records.
+    {Returns : dataframe of user_id, accessed, path, stage and rule}
+    '''
+    sources = [(df_staff, 'remove_staff', 'staff'), (df_multicohort, 'impute_cohorts', 'multicohort'),
+               (df_unimputed, 'impute_cohorts', 'unimputed'),
+               (df_non_curriculum, 'remove_non_curriculum', 'non_curriculum'),
+               (df_outliers, 'remove_outliers', 'outlier')]
+
+    parts = []
+    for frame, stage, rule in sources:
+        rules = (f'{rule}: ' + frame.reason.astype(str)).values if 'reason' in frame.columns else rule
+        parts.append(pd.DataFrame({'user_id': frame.user_id.values, 'accessed': frame.accessed.values,
+                                   'path': frame.path.astype(object).values, 'stage': stage, 'rule': rules}))
+
+    return pd.concat(parts, ignore_index=True).astype({'path': 'category', 'stage': 'category', 'rule': 'category'})
+
+def cached_stages(cache_dir=stage_cache_dir, records=None, hooks=()):
+    '''
+    Runs the stages of full_wrangle from get_access_data to remove_outliers with each stage's output cached in
+    cache_dir.  The key of a stage chains the fingerprint of the cached access data file with the code version and
+    parameters of every stage up to it, so a change re-runs only the stages from the changed one on.  Only the frames
+    split off along the way and the output of the last cached stage are loaded.  Without an access data file (first
+    pull from the database) the stages run uncached.  The stages that run are recorded in records (see run_stage);
+    the ones loaded get a record with cached = True and only the rows of df they pass on.
+    {Returns : df_raw_cnt, df, df_staff, df_multicohort, df_unimputed, df_non_curriculum, df_outliers}
+    '''
+    from acquire import parquet_available, parquet_filename, csv_filename
+
+    # The stages in order; each passes df on and may split off other frames (initial_drops keeps the raw count)
+    stages = [(name, globals()[name]) for name in stage_names]
+
+    fingerprint = file_fingerprint(parquet_filename if parquet_available() and os.path.isfile(parquet_filename) else csv_filename)
+    keys = []
+    for name, func in stages:
+        keys.append(None if fingerprint is None else chain_key(keys[-1] if keys else fingerprint, name, func))
+
+    # The last stage cached along with the frames split off by it and the stages before it
+    start = -1
+    if fingerprint is not None:
+        for i, (name, func) in enumerate(stages):
+            if not cache_exists(name, keys[i], 'side', cache_dir):
+                break
+            if cache_exists(name, keys[i], 'df', cache_dir):
+                start = i
+
+    if records is None:
+        records = []
+
+    side = []
+    for i, (name, func) in enumerate(stages[:start + 1]):
+        side.extend(cache_load(name, keys[i], 'side', cache_dir))
+    if start >= 0:
+        df = cache_load(stages[start][0], keys[start], 'df', cache_dir)
+        for name, func in stages[:start + 1]:
+            record = {'stage': name, 'seconds': None, 'peak_rss_mb': None, 'peak_rss_delta_mb': None, 'rows_in': None,
+                      'rows_out': df.shape[0] if name == stages[start][0] else None, 'removed': {}, 'cached': True}
+            records.append(record)
+            for hook in hooks:
+                hook(record)
+    else:
+        df = run_stage('get_access_data', get_access_data, (), records, hooks)
+
+    for i, (name, func) in enumerate(stages[start + 1:], start + 1):
+        raw_cnt = df.shape[0]
+        output = run_stage(name, func, (df,), records, hooks)
+        df, split = (output[0], list(output[1:])) if isinstance(output, tuple) else (output, [])
+        if name == 'initial_drops':
+            split = [raw_cnt]
+        side.extend(split)
+
+        if fingerprint is not None:
+            cache_save(split, name, keys[i], 'side', cache_dir)
+            cache_save(df, name, keys[i], 'df', cache_dir)
+
+    df_raw_cnt, df_staff, df_multicohort, df_unimputed, df_non_curriculum, df_outliers = side
+
+    return df_raw_cnt, df, df_staff, df_multicohort, df_unimputed, df_non_curriculum, df_outliers
+
+def initial_drops(df, start=0):
     '''
     Drops a row with a bad value in it and drops all 4 rows with program_id = 4
+    start = position of the first row of df in the full access data (for chunks of it)
     {Returns : df}
     '''
 
     # This index has a bad value for path
-    df = df.drop(df.index[506305])
+    bad_row = 506305 - start
+    if 0 <= bad_row < len(df):
+        df = df.drop(df.index[bad_row])
 
     # This program_id seemed to be in error
     df = df[df.program_id != 4]
@@ -94,8 +372,12 @@ def add_and_set_columns(df):
     df['program_type'] = np.where(df.cohort.isin(data_science) == True, 'Data Science', np.where(df.cohort.isin(web_dev) == True, 'Web Development','Unknown'))
 
      # Create DateTime for future index, convert dates to DateTime, add an hour column, drop old date and time
-    df['accessed'] = df['date'] + ' ' + df['time']
-    df.accessed = pd.to_datetime(df.accessed)
+    # (the typed parquet cache already holds date as a datetime and time as a timedelta)
+    if pd.api.types.is_datetime64_any_dtype(df['date']):
+        df['accessed'] = df['date'] + pd.to_timedelta(df['time'])
+    else:
+        df['accessed'] = df['date'] + ' ' + df['time']
+        df.accessed = pd.to_datetime(df.accessed)
     df['hour'] = df['accessed'].dt.hour
     df = df.drop(columns=['date','time'])
 
@@ -106,20 +388,62 @@ def split_path(df):
     This splits the path into 'unit' and 'lesson': the latter is a combination of the first 1-3 elements in the path
     The unit is the first element in the path.  If alone, it does not indicate a lesson has been selected.
     The lesson comes from the 2nd (if two elements only) or 2nd and 3rd (if more than two elements) element of the url path
+    Each distinct path is only split once (see path_table)
     {Returns : df}
     '''
-    # Creates a new dataframe to create the split data to merge into core df later
-    splits = df.path.str.split('/', expand=True)
-    # Create a reference column with number of elements in path
-    splits['row_type'] = 8 - (splits.isnull().sum(axis=1))
-    # Pulls out the academic unit, lesson
-    splits['unit'] = splits[0]
-    splits['lesson'] = np.where(splits.row_type == 2, splits[0]+'.'+splits[1], np.where(splits.row_type == 3, splits[0]+'.'+splits[1]+'.'+splits[2], 'Not Lesson'))
-   
-    splits = splits[['unit','lesson']]
-    df = df.merge(splits, left_index=True, right_index = True)
+    # Looks up the unit and lesson of every access in the parsed distinct paths
+    splits = join_path_table(df.path, ['unit', 'lesson'])
+    df['unit'] = splits.unit
+    df['lesson'] = splits.lesson
+
     return df
 
+def path_table(paths):
+    '''
+    Builds the path dimension: each distinct path split once into its 'unit', 'lesson' (as in split_path) and
+    'depth' (number of elements).  Other functions can join it on path instead of splitting paths again
+    {Returns : dataframe indexed by path}
+    '''
+    paths = pd.Index(pd.Series(paths).dropna().unique(), name='path')
+    splits = paths.str.split('/')
+
+    # Pulls out the number of elements, academic unit and lesson
+    depth = splits.str.len()
+    first, second, third = splits.str[0], splits.str[1], splits.str[2]
+    lesson = np.where(depth == 2, first+'.'+second, np.where(depth == 3, first+'.'+second+'.'+third, 'Not Lesson'))
+
+    return pd.DataFrame({'unit': first, 'lesson': lesson, 'depth': depth}, index=paths)
+
+def join_path_table(path, columns=('unit', 'lesson', 'depth')):
+    '''
+    Looks up columns of the path_table for every value of a path column, parsing each distinct path once and
+    broadcasting the results back through the category codes
+    {Returns : dataframe with the same index as path}
+    '''
+    path = path.astype('category')
+    table = path_table(path.cat.categories).reindex(path.cat.categories)
+
+    # Code -1 (a null path) picks the NaN added at the end
+    codes = path.cat.codes.values
+
+    return pd.DataFrame({col: np.append(table[col].values, np.nan)[codes] for col in columns}, index=path.index)
+
+def path_program_flags(path, rules=None):
+    '''
+    Flags the paths holding each program's content (program_content_rules by default), searching each distinct path
+    once and broadcasting the flags back through the category codes (null paths are not flagged)
+    {Returns : dataframe of boolean flag columns with the same index as path}
+    '''
+    if rules is None:
+        rules = program_content_rules
+
+    path = path.astype('category')
+    categories = path.cat.categories.astype(str).to_series()
+    codes = path.cat.codes.values
+
+    return pd.DataFrame({flag: np.append(categories.str.contains(regex).values, False)[codes] for flag, regex in rules},
+                        index=path.index)
+
 def remove_staff(df):
     '''
     Removes all entries with 'Staff' as cohort and puts them into seperate dataframe
@@ -128,11 +452,12 @@ def remove_staff(df):
     ##Final dataframe layout
     df = df[['accessed','path', 'ip', 'user_id', 'program_id', 'program_type', 'cohort', 'start_date', 'end_date','lesson','hour']]
 
-    # Create the staff dataframe and set time dtypes
-    df_staff = df[df.cohort == 'Staff']
-    df_staff.start_date = pd.to_datetime(df.start_date)
-    df_staff.end_date = pd.to_datetime(df.end_date)
-    df = df[df.cohort != 'Staff']
+    # Create the staff dataframe and set time dtypes (from the staff rows only, so a frame without staff, e.g. a
+    # chunk or shard, gives an empty df_staff)
+    is_staff = df.cohort == 'Staff'
+    df_staff = df[is_staff].assign(start_date=pd.to_datetime(df.start_date[is_staff]),
+                                   end_date=pd.to_datetime(df.end_date[is_staff]))
+    df = df[~is_staff]
     
     return df, df_staff
 
@@ -144,34 +469,8 @@ def impute_cohorts(df):
     and the second where the user's visit were partially recorded in a cohort, and partially as a Null
     {Returns : df, df_multicohort, df_unimputed}
     '''
-    # Create a dataframe of null nohorts
-    no_cohort = df[df['cohort'].isnull()  == True]
-    no_cohort_list = no_cohort.user_id.unique()
-    
-    # Create a non-null dataframe (required for coming for loop)
-    df_X = df.copy()
-    df_X['cohort'] = np.where(df_X.cohort.isnull() == True, 'X',df_X.cohort)
-
-    # Will hold future dataframe object
-    user_list = []
-
-    #loop over each user without a cohort to find previous and next user cohorts
-    for user in no_cohort_list:
-        inlist = {}
-        inlist['prev_user_cohort'] = df_X[df_X.user_id == (user-1)].cohort.max()
-        inlist['prev_user_program'] = df_X[df_X.user_id == (user-1)].program_id.max()
-        inlist['user_id'] = user
-        inlist['next_user_cohort'] = df_X[df_X.user_id == (user+1)].cohort.max()
-        inlist['next_user_program'] = df_X[df_X.user_id == (user+1)].program_id.max()
-        inlist['total_accesses'] = df_X[df_X.user_id == user].accessed.count()
-        user_list.append(inlist)
-    df_no_cohort_user = pd.DataFrame(user_list).set_index('user_id')
-
-    # Ties user_ids to a suggested cohort iff they are surrounded by the same cohort
-    df_no_cohort_user['suggested_cohort'] = np.where(df_no_cohort_user.prev_user_cohort != df_no_cohort_user.next_user_cohort,'Cannot Impute',
-                                                np.where(df_no_cohort_user.prev_user_cohort == 'X', 'Cannot Impute' ,df_no_cohort_user.prev_user_cohort)) 
-    suggested_imputes = df_no_cohort_user[df_no_cohort_user.suggested_cohort != 'Cannot Impute']
-    suggested_imputes = suggested_imputes[['suggested_cohort','prev_user_program']].rename(columns = {'prev_user_program':'program'})
+    # Summarizes every user in one groupby (highest cohort, highest program_id, accesses) instead of scanning df per user
+    users = user_summary(df)
 
     # This creates a dataframe with cohort info
     sd = pd.DataFrame(df.groupby('cohort').start_date.min())
@@ -179,38 +478,44 @@ def impute_cohorts(df):
     pid = pd.DataFrame(df.groupby('cohort').program_id.mean())
     cohort_info = sd.merge(ed, on='cohort').merge(pid, on='cohort')
 
-    # Brings cohort info together with the suggested imputes
-    suggested_imputes = suggested_imputes.merge(cohort_info, left_on='suggested_cohort', right_on='cohort').set_index(suggested_imputes.index)
-    suggested_imputes = suggested_imputes.drop(columns = 'program')
+    # Ties user_ids to a suggested cohort iff the previous and next users are in the same cohort, with its cohort info
+    suggested_imputes = suggest_cohorts(users, cohort_info)
 
     # Merges with main dataframe and replaces the values of imputed rows
-    df = df.merge(suggested_imputes, how='left', on='user_id')
-    df['cohort'] = np.where(df.cohort.isnull()==True, df.suggested_cohort, df.cohort)
-    df['start_date'] = np.where(df.start_date_x.isnull()==True, df.start_date_y, df.start_date_x)
-    df['end_date'] = np.where(df.end_date_x.isnull()==True, df.end_date_y, df.end_date_x)
-    df['program_id'] = np.where(df.program_id_x.isnull()==True, df.program_id_y, df.program_id_x)
-
-    # Removes excess columns
-    df = df.drop(columns = ['start_date_x','end_date_x','program_id_x','suggested_cohort','start_date_y','end_date_y','program_id_y'])
-
-    # Imputes the three users with one set of Null and one set of identified cohorts
-        # For 358
-    df['cohort'] = np.where(df.user_id == 358, 'Bayes', df.cohort)
-    df['start_date'] = np.where(df.user_id == 358, '2019-08-19', df.start_date)
-    df['end_date'] = np.where(df.user_id == 358, '2020-01-30', df.end_date)
-    df['program_id'] = np.where(df.user_id == 358, '3', df.program_id)
-
-        # For 375
-    df['cohort'] = np.where(df.user_id == 375, 'Andromeda', df.cohort)
-    df['start_date'] = np.where(df.user_id == 375, '2019-03-18', df.start_date)
-    df['end_date'] = np.where(df.user_id == 375, '2019-07-30', df.end_date)
-    df['program_id'] = np.where(df.user_id == 375, '2', df.program_id)
-
-        # For 644
-    df['cohort'] = np.where(df.user_id == 644, 'Ganymede', df.cohort)
-    df['start_date'] = np.where(df.user_id == 644, pd.to_datetime('2020-03-23'), df.start_date)
-    df['end_date'] = np.where(df.user_id == 644, pd.to_datetime('2020-08-20'), df.end_date)
-    df['program_id'] = np.where(df.user_id == 644, '2', df.program_id)
+    df = df.reset_index(drop=True)
+    df = fill_cohorts(df, suggested_imputes)
+
+    # Creates multi-user dataframe and drops those multicohort from df
+    df_multicohort = df[df.user_id.isin(multi_cohort_users)]
+    df = df[df.user_id.isin(multi_cohort_users) == False].reset_index(drop=True)
+
+    # Recalculate no cohort list, create dataframe for unimputed values and drop unimputed users
+    no_cohort_list = df[df['cohort'].isnull() == True].user_id.unique()
+    df_unimputed = df[df.user_id.isin(no_cohort_list)]
+    df = df[df.user_id.isin(no_cohort_list) == False].reset_index(drop=True)
+
+    return df, df_multicohort, df_unimputed
+
+def fill_cohorts(df, suggested_imputes, data_science=None, web_dev=None):
+    '''
+    Fills the missing cohort information of df from suggested_imputes (indexed by user_id, with suggested_cohort,
+    start_date, end_date and program_id columns), sets the cohorts of the users in known_cohorts and recalculates
+    program_type.  data_science and web_dev are the cohorts of each program; they are taken from df if not given
+    (the chunked wrangle passes them in, since a chunk does not see every cohort)
+    {Returns : df}
+    '''
+    # Replaces the values of imputed rows
+    df['cohort'] = np.where(df.cohort.isnull()==True, df.user_id.map(suggested_imputes.suggested_cohort), df.cohort)
+    df['start_date'] = df.start_date.fillna(df.user_id.map(suggested_imputes.start_date))
+    df['end_date'] = df.end_date.fillna(df.user_id.map(suggested_imputes.end_date))
+    df['program_id'] = df.program_id.fillna(df.user_id.map(suggested_imputes.program_id))
+
+    # Imputes the users with one set of Null and one set of identified cohorts
+    for user, (cohort, start_date, end_date, program_id) in known_cohorts.items():
+        df['cohort'] = np.where(df.user_id == user, cohort, df.cohort)
+        df['start_date'] = df.start_date.mask(df.user_id == user, pd.to_datetime(start_date))
+        df['end_date'] = df.end_date.mask(df.user_id == user, pd.to_datetime(end_date))
+        df['program_id'] = df.program_id.mask(df.user_id == user, program_id)
 
     # Re-Standardize value types
     df.start_date = pd.to_datetime(df.start_date)
@@ -218,96 +523,689 @@ def impute_cohorts(df):
     df = df.astype({'program_id':'float'})
 
      # Ensure new program_type based on program_id
-    data_science = df[df.program_id == 3.0].cohort.unique()
-    web_dev = df[(df.program_id == 1.0) | (df.program_id == 2.0)].cohort.unique()
+    if data_science is None:
+        data_science = df[df.program_id == 3.0].cohort.unique()
+    if web_dev is None:
+        web_dev = df[(df.program_id == 1.0) | (df.program_id == 2.0)].cohort.unique()
     df['program_type'] = np.where(df.cohort.isin(data_science) == True, 'Data Science', np.where(df.cohort.isin(web_dev) == True, 'Web Development','Unknown'))
 
     # Reorder columns to match previous dfs
     df = df[['accessed','path', 'ip', 'user_id', 'program_id', 'program_type', 'cohort', 'start_date', 'end_date','lesson','hour']]
 
-    # Creates multi-user dataframe
-    multi_cohort_users = [25, 64, 88, 118, 120, 143, 268, 346, 419, 522, 663, 707, 752, 895]
-    df_multicohort = df[df.user_id.isin(multi_cohort_users)]
+    return df
 
-    # Drop those multicohort form df
-    drop_index = df.set_index("user_id")
-    drop_index = drop_index.drop(multi_cohort_users)
-    df = drop_index
-    df = df.reset_index()
-    df = df[['accessed','path', 'ip', 'user_id', 'program_id', 'program_type', 'cohort', 'start_date', 'end_date','lesson','hour']]
+def remove_non_curriculum(df, rules=None):
+    '''
+    Moves all non-curriculum accesses (home page, table of contents, images, json, appendix) into a separate
+    dataframe, with a 'reason' column naming the rule each access matched.  rules defaults to non_curriculum_rules.
+    Each distinct path is classified once (see classify_paths), so an access matching several rules is moved once.
+    {Returns : df, df_non_curriculum}
+    '''
+    reason = path_reasons(df.path, rules)
 
-    # Recalculate no cohort list
-    no_cohort = df[df['cohort'].isnull()  == True]
-    no_cohort_list = no_cohort.user_id.unique()
+    # Creates a dataframe with the rows to remove
+    df_non_curriculum = df[reason.notnull()].assign(reason=reason[reason.notnull()])
 
-    # Create dataframe for unimputed values
-    df_unimputed = df[df.user_id.isin(no_cohort_list)]
+    # Removes those rows from the working dataframe
+    df = df[reason.isnull()]
+
+    return df, df_non_curriculum
 
-    # Drop unimputed users
-    drop_index = df.set_index("user_id")
-    drop_index = drop_index.drop(no_cohort_list)
-    df = drop_index
-    df = df.reset_index()
+def path_reasons(path, rules=None):
+    '''
+    Classifies a column of paths by the first of rules (default non_curriculum_rules) each matches, working on the
+    distinct paths and mapping the result back to every row through the category codes
+    {Returns : series of reasons (null where no rule matched)}
+    '''
+    path = path.astype('category')
+    reasons = classify_paths(path.cat.categories, rules)
 
-    # Resets to standard df format used in this project
-    df = df[['accessed','path', 'ip', 'user_id', 'program_id', 'program_type', 'cohort', 'start_date', 'end_date','lesson','hour']]
+    # Code -1 (a null path) picks the None added at the end
+    reasons = np.append(reasons, None)[path.cat.codes.values]
 
-    return df, df_multicohort, df_unimputed
+    return pd.Series(reasons, index=path.index, dtype='category')
 
-def remove_non_curriculum(df):
+def compile_path_rules(rules=None):
     '''
-    Moves all non
-    {Returns : df, df_non_curriculum}
+    Compiles rules, a list of (reason, regex) pairs (default non_curriculum_rules), into one regex: each rule becomes
+    a lookahead from the start of the path, tried in order, with a group naming the rule.  Callers classifying paths
+    one at a time (e.g. stream.StreamDetector) compile it once and reuse it.
+    {Returns : compiled regex, dict of group name -> reason}
     '''
-    # Creates a dataframe with the rows to remove
-    df_non_curriculum = pd.concat([df[df.path == '/'],
-           df[df.path == 'toc'],
-           df[df.path.str.contains('jpeg') == True],
-           df[df.path.str.contains('json') == True], 
-           df[df.path.str.contains('jpg') == True], 
-           df[df.path.str.contains('appendix') == True], 
-           df[df.path.str.contains('Appendix') == True]])
-    
-    # Removes those rows from the working dataframe
-    df=df[df.path != '/']
-    df=df[df.path != 'toc']
-    df=df[df.path.str.contains('jpeg') != True]
-    df=df[df.path.str.contains('json') != True]
-    df=df[df.path.str.contains('jpg') != True]
-    df=df[df.path.str.contains('appendix') != True]
-    df=df[df.path.str.contains('Appendix') != True]
+    if rules is None:
+        rules = non_curriculum_rules
 
-    return df, df_non_curriculum
+    combined = re.compile('^(?:' + '|'.join(f'(?=.*?(?P<rule{i}>{regex}))' for i, (reason, regex) in enumerate(rules)) + ')')
+    reason_of = {f'rule{i}': reason for i, (reason, regex) in enumerate(rules)}
 
-def remove_outliers(df):
+    return combined, reason_of
+
+def classify_paths(paths, rules=None):
+    '''
+    Classifies distinct paths with one combined regex: rules is a list of (reason, regex) pairs (default
+    non_curriculum_rules), each regex searched anywhere in the path and the first matching rule winning
+    {Returns : array of reasons (None where no rule matched)}
     '''
-    We did this manually
+    combined, reason_of = compile_path_rules(rules)
+
+    matches = [combined.search(p) if isinstance(p, str) else None for p in paths]
+
+    return np.array([reason_of[m.lastgroup] if m else None for m in matches], dtype=object)
+
+def remove_outliers(df, rules=None, combine='or'):
+    '''
+    Moves the accesses of users whose per-user stats (see user_access_stats) break the outlier rules into a separate
+    dataframe, with a 'reason' column listing the rules each user broke.  rules defaults to outlier_rules (the bounds
+    we set manually); combine = 'or' flags users breaking any rule, 'and' only users breaking all of them
     {Returns : df, df_outliers}
     '''
-    
-    new = df.groupby('user_id')['path', 'ip' ,'accessed'].nunique()
-    #reset the index to obtain user_id column
-    new = new.reset_index()
-    
-    #IQR df w/minimums bc of negatives
-    temp_df = new.loc[(new['accessed'] < 50) | (new['accessed'] > 2669)] #access = date + time
-    temp_df = new.loc[(new['path'] < 10) | (new['path'] > 331)]
-    temp_df = new.loc[(new['ip'] < 2) | (new['ip'] > 17)]
-    
-    only_outliers = pd.merge(df, temp_df['user_id'], how = 'inner', on = 'user_id')
-    outliers = only_outliers.groupby('user_id').max().index
+    new = user_access_stats(df)
+    outliers = outlier_users(new, rules, combine)
 
-    df_outliers = df[df.user_id.isin(outliers) == True]
+    df_outliers = df[df.user_id.isin(outliers.index) == True]
+    df_outliers = df_outliers.assign(reason=df_outliers.user_id.map(outliers.reason))
 
-    df = df[df.user_id.isin(outliers) == False]
+    df = df[df.user_id.isin(outliers.index) == False]
     
     return df, df_outliers
 
-def null_filler(df):
+def access_features(df):
+    '''
+    Selects the per-access values the user stats count: path, ip, access time, and the access day and hour
+    {Returns : dataframe with user_id, path, ip, accessed, day and active_hour columns}
+    '''
+    accessed = df.accessed.values
+
+    return pd.DataFrame({'user_id': df.user_id, 'path': df.path, 'ip': df.ip, 'accessed': df.accessed,
+                         'day': accessed.astype('datetime64[D]'), 'active_hour': accessed.astype('datetime64[h]')},
+                        index=df.index)
+
+def user_access_stats(df):
+    '''
+    Computes the outlier features of each user in one groupby: unique paths, ips and access times, active days,
+    active hours, hits and hits per active hour
+    {Returns : dataframe indexed by user_id}
+    '''
+    new = access_features(df).groupby('user_id').agg(path=('path', 'nunique'), ip=('ip', 'nunique'),
+                                                     accessed=('accessed', 'nunique'), days=('day', 'nunique'),
+                                                     hours=('active_hour', 'nunique'), hits=('accessed', 'count'))
+    new['hits_per_hour'] = new.hits / new.hours
+
+    return new
+
+def get_bounds(values, method, param):
+    '''
+    Finds the lower and upper bounds of values for an outlier rule:
+    method = 'bounds' uses param = (lower, upper) as given;
+    method = 'iqr' uses q1 - k * iqr and q3 + k * iqr with param = k;
+    method = 'zscore' uses mean -/+ z * std with param = z
+    {Returns : lower_bound, upper_bound}
+    '''
+    if method == 'bounds':
+        lower_bound, upper_bound = param
+    elif method == 'iqr':
+        #obtain quartiles and iqr range
+        q1, q3 = values.quantile([.25, .75])
+        iqr = q3 - q1
+        lower_bound, upper_bound = q1 - param * iqr, q3 + param * iqr
+    elif method == 'zscore':
+        lower_bound, upper_bound = values.mean() - param * values.std(), values.mean() + param * values.std()
+    else:
+        raise ValueError(f"Unknown outlier method '{method}' (use 'bounds', 'iqr' or 'zscore')")
+
+    return lower_bound, upper_bound
+
+def outlier_users(new, rules=None, combine='or'):
+    '''
+    Flags the users whose stats (from user_access_stats) fall outside the bounds of the rules: a list of
+    (feature, method, param) as taken by get_bounds, defaulting to outlier_rules.  combine = 'or' flags users
+    outside any rule's bounds, 'and' only users outside all of them
+    {Returns : dataframe indexed by user_id of the flagged users, with their 'reason'}
+    '''
+    if rules is None:
+        rules = outlier_rules
+    if combine not in ['or', 'and']:
+        raise ValueError(f"Unknown combine '{combine}' (use 'or' or 'and')")
+    if len(rules) == 0:
+        raise ValueError('No outlier rules given')
+
+    # One column per rule, holding the broken bound (or '' if the user is within it)
+    broken = pd.DataFrame(index=new.index)
+    for i, (feature, method, param) in enumerate(rules):
+        lower_bound, upper_bound = get_bounds(new[feature], method, param)
+        broken[i] = np.where(new[feature] < lower_bound, f'{feature} < {lower_bound:g}',
+                             np.where(new[feature] > upper_bound, f'{feature} > {upper_bound:g}', ''))
+
+    is_broken = broken != ''
+    flagged = is_broken.all(axis=1) if combine == 'and' else is_broken.any(axis=1)
+    reason = broken[flagged].apply(lambda row: '; '.join(r for r in row if r), axis=1)
+
+    return pd.DataFrame({'reason': reason.astype(str)}, index=new.index[flagged])
+
+def set_wrangle_dtypes(frames, schema=None):
+    '''
+    Sets the dtypes of schema (wrangle_schema by default) on the columns each frame has.  Each categorical column
+    gets one category dictionary, the sorted values found across all frames, so the frames concatenate and compare
+    as categoricals.  Nulls stay nulls (NaN/NaT/<NA>).
+    {Returns : list of frames}
+    '''
+    if schema is None:
+        schema = wrangle_schema
+
+    dtypes = {}
+    for col, dtype in schema.items():
+        if dtype == 'category':
+            values = [pd.Series(frame[col].dropna().unique(), dtype=object) for frame in frames if col in frame.columns]
+            dtype = pd.CategoricalDtype(np.sort(pd.concat(values).unique())) if values else dtype
+        dtypes[col] = dtype
+
+    return [frame.astype({col: dtype for col, dtype in dtypes.items() if col in frame.columns}) for frame in frames]
+
+def wrangle_memory_report(before, after, names=('df', 'df_staff', 'df_multicohort', 'df_unimputed',
+                                                'df_non_curriculum', 'df_outliers')):
+    '''
+    Compares the memory footprint (deep, so object strings count) of each dataframe before and after set_wrangle_dtypes
+    {Returns : dataframe indexed by Dataframe with Rows, MB before, MB after and Reduction}
+    '''
+    results = []
+    for name, old, new in zip(names, before, after):
+        old_mb = old.memory_usage(deep=True).sum() / 1024 ** 2
+        new_mb = new.memory_usage(deep=True).sum() / 1024 ** 2
+        results.append({'Dataframe': name, 'Rows': new.shape[0], 'MB before': round(old_mb, 1),
+                        'MB after': round(new_mb, 1), 'Reduction': f'{1 - new_mb / old_mb:.1%}' if old_mb else ''})
+
+    return pd.DataFrame(results).set_index('Dataframe')
+
+def cohort_windows(frames):
+    '''
+    Collects the distinct cohort windows (start_date to end_date) of each user across frames, as int64 seconds
+    {Returns : dataframe of user_id, start and end (the latest end of the user's windows so far), sorted by user_id
+               and start}
+    '''
+    windows = pd.concat([frame[['user_id', 'start_date', 'end_date']] for frame in frames])
+    windows = windows.assign(start=pd.to_datetime(windows.start_date, errors='coerce'),
+                             end=pd.to_datetime(windows.end_date, errors='coerce'))
+    windows = windows[['user_id', 'start', 'end']].dropna().drop_duplicates()
+
+    windows = windows.assign(user_id=windows.user_id.astype('int64'),
+                             start=windows.start.values.astype('datetime64[s]').astype('int64'),
+                             end=windows.end.values.astype('datetime64[s]').astype('int64'))
+    windows = windows.sort_values(['user_id', 'start']).reset_index(drop=True)
+
+    # Overlapping windows: an access is active until the latest end seen so far
+    windows['end'] = windows.groupby('user_id').end.cummax()
+
+    return windows
+
+def tag_frames(frames):
+    '''
+    Tags the accesses of each frame with its place relative to the cohort windows of all of them (see tag_active_window)
+    {Returns : list of frames}
+    '''
+    windows = cohort_windows(frames)
+
+    return [tag_active_window(frame, windows) for frame in frames]
+
+def tag_active_window(df, windows=None):
+    '''
+    Interval-joins every access to the cohort windows of its user (see cohort_windows; the windows of df by default)
+    with one binary search over (user_id, start) keys, adding:
+    window = categorical of window_labels: 'pre-start' (before the user's first window), 'active' (within a window)
+             or 'post-graduation' (after the end of the latest window started); null for users without a window
+    days_since_end = whole days since that end, for post-graduation accesses (null otherwise)
+    {Returns : df}
+    '''
+    if windows is None:
+        windows = cohort_windows([df])
+
+    # Keys sort by user, then time (user_ids well under 2**29, seconds under 2**34)
+    seconds = pd.to_datetime(df.accessed).values.astype('datetime64[s]').astype('int64')
+    users = df.user_id.values.astype('int64')
+    keys = (users << 34) + seconds
+    window_users = windows.user_id.values
+    window_keys = (window_users << 34) + windows.start.values
+
+    # The last window of the same user starting at or before the access
+    idx = np.searchsorted(window_keys, keys, side='right') - 1
+    safe_idx = np.maximum(idx, 0)
+    started = (idx >= 0) & (window_users[safe_idx] == users) if len(windows) > 0 else np.zeros(len(df), dtype=bool)
+    end = windows.end.values[safe_idx] if len(windows) > 0 else np.zeros(len(df), dtype='int64')
+
+    codes = np.where(np.isin(users, window_users), 0, -1)
+    codes = np.where(started, np.where(seconds <= end, 1, 2), codes).astype('int8')
+    days = np.where(codes == 2, (seconds - end) // 86400, 0)
+
+    df = df.copy()
+    df['window'] = pd.Categorical.from_codes(codes, window_labels)
+    df['days_since_end'] = pd.Series(days, index=df.index).astype('Int16').where(codes == 2)
+
+    return df
+
+def active_mask(df):
+    '''
+    Marks the accesses made while the user's cohort was in session, from the window tag if df has one
+    {Returns : boolean series}
+    '''
+    if 'window' in df.columns:
+        return df.window == 'active'
+
+    return (df.accessed >= df.start_date) & (df.accessed <= df.end_date)
+# --------------------------------------------------
+# Parallel wrangle over user_id shards
+# --------------------------------------------------
+
+def parallel_stages(df, workers=4):
     '''
-    Fill nulls with empty space (but counted as string)
+    Runs the stages of full_wrangle from add_and_set_columns to remove_outliers on df (after initial_drops) split into
+    workers shards by a hash of user_id, in a process pool.  Every user lands in one shard, so the row-by-row stages,
+    the per-user summaries and the outlier stats run within shards; only the cross-user steps (neighbor cohort
+    suggestions, outlier bounds) run in the parent on the combined summaries.  Shards go to and from the workers as
+    Arrow IPC files in a temporary folder, which the workers and the parent memory-map (see write_shard; pickle
+    files without pyarrow).  The outputs are put back in the serial row order and renumbered the way
+    impute_cohorts resets the index, so they equal the serial ones.
+    {Returns : df, df_staff, df_multicohort, df_unimputed, df_non_curriculum, df_outliers}
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+    from acquire import parquet_available
+    import tempfile
+
+    shard_of = pd.util.hash_array(df.user_id.values.astype('int64')) % workers
+    extension = '.arrow' if parquet_available() else '.pkl'
+
+    with tempfile.TemporaryDirectory() as tmp_dir, ProcessPoolExecutor(max_workers=workers) as pool:
+        filenames = []
+        for shard in range(workers):
+            filename = os.path.join(tmp_dir, f'shard-{shard:03}{extension}')
+            write_shard(df[shard_of == shard], filename)
+            filenames.append(filename)
+        del df
+
+        # Row-by-row stages, collecting the user and cohort summaries needed for the imputation
+        summaries = list(pool.map(shard_stage_one, filenames))
+        users = combine_user_summaries([users for users, cohorts in summaries])
+        cohorts = combine_cohort_summaries([cohorts for users, cohorts in summaries])
+
+        # Cohort imputation from the combined summaries
+        suggested_imputes = suggest_cohorts(users, cohorts)
+        data_science, web_dev = program_cohorts(cohorts, suggested_imputes)
+        no_cohort_list = users[users.no_cohort].index
+        no_cohort_list = no_cohort_list[~no_cohort_list.isin(suggested_imputes.index) & ~no_cohort_list.isin(list(known_cohorts))]
+
+        # Fills cohorts, splits off multicohort/unimputed users and non-curriculum accesses, and computes the outlier stats
+        stats = list(pool.map(shard_stage_two, filenames, [suggested_imputes] * workers, [data_science] * workers,
+                              [web_dev] * workers, [no_cohort_list] * workers))
+        outliers = outlier_users(pd.concat(stats).sort_index())
+
+        frames = {name: pd.concat([read_shard(shard_filename(f, name)) for f in filenames]).sort_index()
+                  for name in ['df_staff', 'df_multicohort', 'df_unimputed', 'df_non_curriculum', 'df']}
+
+    # Renumbers the rows like the index resets in impute_cohorts: after filling, after dropping multicohort users
+    # and after dropping unimputed users
+    original = {name: frame.index.values for name, frame in frames.items()}
+    labels = np.sort(np.concatenate([original[name] for name in ['df_multicohort', 'df_unimputed', 'df_non_curriculum', 'df']]))
+    for dropped, renumbered in [(None, ['df_multicohort']), ('df_multicohort', ['df_unimputed']),
+                                ('df_unimputed', ['df_non_curriculum', 'df'])]:
+        if dropped is not None:
+            labels = labels[~np.isin(labels, original[dropped])]
+        for name in renumbered:
+            frames[name].index = pd.Index(np.searchsorted(labels, original[name]))
+
+    # Outlier users are split off like in remove_outliers
+    df = frames['df']
+    df_outliers = df[df.user_id.isin(outliers.index) == True]
+    df_outliers = df_outliers.assign(reason=df_outliers.user_id.map(outliers.reason))
+    df = df[df.user_id.isin(outliers.index) == False]
+
+    return df, frames['df_staff'], frames['df_multicohort'], frames['df_unimputed'], frames['df_non_curriculum'], df_outliers
+
+def shard_filename(filename, name):
+    '''
+    Names the file holding one output dataframe of a shard
+    {Returns : filename}
+    '''
+    root, extension = os.path.splitext(filename)
+
+    return f'{root}-{name}{extension}'
+
+def write_shard(df, filename):
+    '''
+    Writes a shard dataframe as an uncompressed Arrow IPC file (a pickle if filename ends in .pkl), so the reader
+    can memory-map it instead of copying it through the pool pipe.  The pandas metadata keeps the index and dtypes.
+    '''
+    if filename.endswith('.pkl'):
+        df.to_pickle(filename)
+        return
+
+    import pyarrow as pa
+
+    # A categorical without categories (e.g. an empty df_staff) would come back as object: give it string values
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    schema = pa.schema([field.with_type(pa.dictionary(field.type.index_type, pa.string()))
+                        if pa.types.is_dictionary(field.type) and pa.types.is_null(field.type.value_type) else field
+                        for field in table.schema], metadata=table.schema.metadata)
+    table = table.cast(schema)
+
+    # An empty table writes no record batch, which would lose the categories: write one empty batch instead
+    batches = table.to_batches() or [pa.RecordBatch.from_arrays([column.combine_chunks() for column in table.columns],
+                                                                 schema=table.schema)]
+    with pa.OSFile(filename, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        for batch in batches:
+            writer.write_batch(batch)
+
+def read_shard(filename):
+    '''
+    Reads a shard dataframe written by write_shard, memory-mapping the Arrow IPC file
     {Returns : df}
     '''
-    df = df.fillna('')
+    if filename.endswith('.pkl'):
+        return pd.read_pickle(filename)
+
+    import pyarrow as pa
+
+    with pa.memory_map(filename) as source:
+        return pa.ipc.open_file(source).read_all().to_pandas()
+
+def shard_stage_one(filename):
+    '''
+    Runs add_and_set_columns, split_path and remove_staff on a shard file, writing df_staff and the staged df next to it
+    {Returns : user_summary, cohort_summary of the shard}
+    '''
+    df = read_shard(filename)
+    df = add_and_set_columns(df)
+    df = split_path(df)
+    df, df_staff = remove_staff(df)
+
+    write_shard(df_staff, shard_filename(filename, 'df_staff'))
+    write_shard(df, shard_filename(filename, 'staged'))
+
+    return user_summary(df), cohort_summary(df)
+
+def shard_stage_two(filename, suggested_imputes, data_science, web_dev, no_cohort_list):
+    '''
+    Fills the cohorts of a staged shard and splits off its multicohort users, unimputed users and non-curriculum
+    accesses, writing each dataframe next to the shard file
+    {Returns : user_access_stats of the shard's curriculum accesses}
+    '''
+    df = read_shard(shard_filename(filename, 'staged'))
+    df = fill_cohorts(df, suggested_imputes, data_science, web_dev)
+
+    df_multicohort = df[df.user_id.isin(multi_cohort_users)]
+    df = df[df.user_id.isin(multi_cohort_users) == False]
+    df_unimputed = df[df.user_id.isin(no_cohort_list)]
+    df = df[df.user_id.isin(no_cohort_list) == False]
+    df, df_non_curriculum = remove_non_curriculum(df)
+
+    for name, frame in [('df_multicohort', df_multicohort), ('df_unimputed', df_unimputed),
+                        ('df_non_curriculum', df_non_curriculum), ('df', df)]:
+        write_shard(frame, shard_filename(filename, name))
+
+    return user_access_stats(df)
+
+# --------------------------------------------------
+# Chunked wrangle for logs larger than memory
+# --------------------------------------------------
+
+def chunked_wrangle(chunksize=250000, out_dir='wrangled', cache='parquet'):
+    '''
+    Runs the same wrangle as full_wrangle on the cached access data chunksize rows at a time, writing each of the
+    six dataframes to out_dir as a folder of parquet parts (load them with read_wrangled).  The row-by-row stages run
+    on each chunk; cohort imputation and the outlier bounds only need the per-user / per-cohort summaries collected
+    along the way.  The distinct counts behind the outlier stats are exact: the curriculum accesses are spilled to
+    buckets by user_id (about one chunk of rows per bucket, one file each) and each bucket is reduced on its own, so
+    at most one chunk or bucket (plus the summaries) is held in memory.  The access data is streamed from whichever
+    cache exists (see acquire.iter_access_data), never loaded whole.  The parts carry the row labels and columns of
+    the full_wrangle frames, so read_wrangled gives the same dataframes.
+    {Returns : dict of dataframe name -> folder with its parquet parts}
+    '''
+    from acquire import iter_access_data
+
+    folders = {name: os.path.join(out_dir, name) for name in ['df', 'df_staff', 'df_multicohort', 'df_unimputed',
+                                                              'df_non_curriculum', 'df_outliers']}
+    for folder in list(folders.values()) + [os.path.join(out_dir, name) for name in ['_staged', '_curriculum', '_buckets']]:
+        shutil.rmtree(folder, ignore_errors=True)
+    counts = {name: 0 for name in folders}
+
+    # First pass: row-by-row stages, collecting the user and cohort summaries needed for the imputation
+    df_raw_cnt = 0
+    user_parts, cohort_parts = [], []
+    for part, df in enumerate(iter_access_data(chunksize, cache=cache)):
+        start = df_raw_cnt
+        df_raw_cnt += df.shape[0]
+        df = initial_drops(df, start=start)
+        df = add_and_set_columns(df)
+        df = split_path(df)
+        df, df_staff = remove_staff(df)
+
+        counts['df_staff'] += write_part(df_staff, folders['df_staff'], part)
+        write_part(df, os.path.join(out_dir, '_staged'), part)
+        user_parts.append(user_summary(df))
+        cohort_parts.append(cohort_summary(df))
+
+    # Cohort imputation from the combined summaries
+    users = combine_user_summaries(user_parts)
+    cohorts = combine_cohort_summaries(cohort_parts)
+    suggested_imputes = suggest_cohorts(users, cohorts)
+    data_science, web_dev = program_cohorts(cohorts, suggested_imputes)
+    no_cohort_list = users[users.no_cohort].index
+    no_cohort_list = no_cohort_list[~no_cohort_list.isin(suggested_imputes.index) & ~no_cohort_list.isin(list(known_cohorts))]
+
+    # Second pass: fill cohorts, split off multicohort/unimputed users and non-curriculum accesses, spilling the
+    # columns the outlier stats need to user_id buckets of about chunksize rows each.  impute_cohorts resets the
+    # index after each split, so the parts are relabeled with the running row count of each reset.
+    n_buckets = max(1, -(-df_raw_cnt // chunksize))
+    spill = BucketSpill(os.path.join(out_dir, '_buckets'), bucket_columns)
+    offsets = [0, 0, 0]
+    window_parts = []
+    for part, df in enumerate(iter_parts(os.path.join(out_dir, '_staged'))):
+        df = fill_cohorts(relabel(df, offsets, 0), suggested_imputes, data_science, web_dev)
+
+        df_multicohort = df[df.user_id.isin(multi_cohort_users)]
+        df = relabel(df[df.user_id.isin(multi_cohort_users) == False], offsets, 1)
+        df_unimputed = df[df.user_id.isin(no_cohort_list)]
+        df = relabel(df[df.user_id.isin(no_cohort_list) == False], offsets, 2)
+        df, df_non_curriculum = remove_non_curriculum(df)
+
+        counts['df_multicohort'] += write_part(df_multicohort, folders['df_multicohort'], part)
+        counts['df_unimputed'] += write_part(df_unimputed, folders['df_unimputed'], part)
+        counts['df_non_curriculum'] += write_part(df_non_curriculum, folders['df_non_curriculum'], part)
+        write_part(df, os.path.join(out_dir, '_curriculum'), part)
+        for frame in [df, df_multicohort]:
+            window_parts.append(frame[['user_id', 'start_date', 'end_date']].drop_duplicates())
+
+        # Every access of a user lands in the same bucket, appended to the bucket's one open file
+        bucket = df.user_id.values % n_buckets
+        for b in np.unique(bucket):
+            spill.write(b, df.loc[bucket == b, ['user_id', 'path', 'ip', 'accessed']])
+    spill.close()
+    shutil.rmtree(os.path.join(out_dir, '_staged'))
+
+    # Outlier users from the stats of each bucket (each user's stats come from one bucket, so they are exact)
+    stats = [user_access_stats(pd.read_parquet(filename)) for filename in spill.filenames()]
+    shutil.rmtree(os.path.join(out_dir, '_buckets'))
+    outliers = outlier_users(pd.concat(stats).sort_index())
+    windows = cohort_windows(window_parts)
+
+    # Third pass: split off the outlier users, tagging the accesses with their cohort windows
+    for part, df in enumerate(iter_parts(os.path.join(out_dir, '_curriculum'))):
+        df_outliers = df[df.user_id.isin(outliers.index) == True]
+        df_outliers = tag_active_window(df_outliers.assign(reason=df_outliers.user_id.map(outliers.reason)), windows)
+        df = tag_active_window(df, windows)
+        counts['df_outliers'] += write_part(df_outliers, folders['df_outliers'], part)
+        counts['df'] += write_part(df[df.user_id.isin(outliers.index) == False], folders['df'], part)
+    shutil.rmtree(os.path.join(out_dir, '_curriculum'))
+
+    # The multicohort parts are tagged once all the windows are known
+    for part, df in enumerate(iter_parts(folders['df_multicohort'])):
+        write_part(tag_active_window(df, windows), folders['df_multicohort'], part)
+
+    # Display results of wrangle as dataframe
+    counts = {name: counts[name] for name in ['df', 'df_staff', 'df_multicohort', 'df_unimputed', 'df_non_curriculum', 'df_outliers']}
+    pd.set_option('display.max_colwidth',None)
+    print(f'This wrote the following dataframes to {out_dir} (load them with read_wrangled):')
+    show(wrangle_results(df_raw_cnt, counts))
+
+    return folders
+
+class BucketSpill:
+    '''
+    Appends the chunks of each bucket to one parquet file per bucket in folder, keeping a pyarrow ParquetWriter
+    open per bucket (so the spill makes one file per bucket, not one per chunk and bucket).  Every chunk is
+    written with the arrow types of columns (name -> type alias), whatever dtypes (e.g. per-chunk categoricals)
+    it comes in.
+    '''
+    def __init__(self, folder, columns):
+        import pyarrow as pa
+
+        self.folder = folder
+        self.schema = pa.schema([(name, pa.type_for_alias(alias)) for name, alias in columns.items()])
+        self.writers = {}
+
+    def write(self, bucket, df):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if bucket not in self.writers:
+            os.makedirs(self.folder, exist_ok=True)
+            self.writers[bucket] = pq.ParquetWriter(os.path.join(self.folder, f'bucket-{bucket:05}.parquet'), self.schema)
+        columns = {field.name: df[field.name].astype(object) if field.type == 'string' else df[field.name]
+                   for field in self.schema}
+        self.writers[bucket].write_table(pa.Table.from_pandas(pd.DataFrame(columns), schema=self.schema,
+                                                              preserve_index=False))
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+
+    def filenames(self):
+        '''
+        {Returns : list of the bucket files, in bucket order}
+        '''
+        return [os.path.join(self.folder, f'bucket-{bucket:05}.parquet') for bucket in sorted(self.writers)]
+
+def relabel(df, offsets, i):
+    '''
+    Gives a chunk the row labels a reset_index over the whole dataframe would: offsets[i] is the number of rows
+    relabeled before it, and is moved past the chunk
+    {Returns : df}
+    '''
+    start = offsets[i]
+    offsets[i] += df.shape[0]
+
+    return df.set_axis(pd.RangeIndex(start, offsets[i]))
+
+def read_wrangled(name, out_dir='wrangled', columns=None):
+    '''
+    Loads one of the dataframes written by chunked_wrangle, e.g. read_wrangled('df_staff'), optionally only some columns,
+    with the dtypes of wrangle_schema.  The parts are read one by one, as a part whose column is all null (e.g. an
+    empty chunk) stores it with a null type the others do not cast to.
+    {Returns : df}
+    '''
+    return set_wrangle_dtypes([pd.concat(list(iter_parts(os.path.join(out_dir, name), columns)))])[0]
+
+def write_part(df, folder, part):
+    '''
+    Writes a chunk of a dataframe as one parquet part of folder
+    {Returns : number of rows written}
+    '''
+    os.makedirs(folder, exist_ok=True)
+    df.to_parquet(os.path.join(folder, f'part-{part:05}.parquet'))
+
+    return df.shape[0]
+
+def iter_parts(folder, columns=None):
+    '''
+    Reads the parquet parts of folder back one at a time, in order, optionally only some columns
+    {Yields : df chunk}
+    '''
+    for filename in sorted(os.listdir(folder)):
+        yield pd.read_parquet(os.path.join(folder, filename), columns=columns)
+
+def user_summary(df):
+    '''
+    Summarizes each user for the cohort imputation: the highest cohort (no cohort counted as 'X'), highest program_id,
+    number of accesses and whether any access has no cohort.  Summaries of chunks combine with combine_user_summaries
+    {Returns : dataframe indexed by user_id}
+    '''
+    df_X = pd.DataFrame({'user_id': df.user_id,
+                         'cohort': np.where(df.cohort.isnull() == True, 'X', df.cohort),
+                         'program_id': df.program_id,
+                         'accessed': df.accessed,
+                         'no_cohort': df.cohort.isnull()})
+
+    return df_X.groupby('user_id').agg(cohort=('cohort', 'max'), program_id=('program_id', 'max'),
+                                       total_accesses=('accessed', 'count'), no_cohort=('no_cohort', 'any'))
+
+def combine_user_summaries(user_parts):
+    '''
+    Combines the user_summary of several chunks into the summary of all of them
+    {Returns : dataframe indexed by user_id}
+    '''
+    users = pd.concat(user_parts)
+
+    return users.groupby(level=0).agg({'cohort':'max', 'program_id':'max', 'total_accesses':'sum', 'no_cohort':'any'})
+
+def cohort_summary(df):
+    '''
+    Summarizes each cohort: first start_date, last end_date, the program_id sum and count (for the mean) and whether
+    it has Data Science / Web Development accesses (not counting the users in known_cohorts, whose cohort gets replaced)
+    {Returns : dataframe indexed by cohort}
+    '''
+    df = df[df.cohort.isnull() == False]
+    kept = df.user_id.isin(list(known_cohorts)) == False
+    df_info = pd.DataFrame({'cohort': df.cohort.astype(object),
+                            'start_date': df.start_date,
+                            'end_date': df.end_date,
+                            'program_id': df.program_id,
+                            'data_science': kept & (df.program_id == 3.0),
+                            'web_dev': kept & ((df.program_id == 1.0) | (df.program_id == 2.0))})
+
+    return df_info.groupby('cohort').agg(start_date=('start_date', 'min'), end_date=('end_date', 'max'),
+                                         program_sum=('program_id', 'sum'), program_count=('program_id', 'count'),
+                                         data_science=('data_science', 'any'), web_dev=('web_dev', 'any'))
+
+def combine_cohort_summaries(cohort_parts):
+    '''
+    Combines the cohort_summary of several chunks and adds the mean program_id of each cohort
+    {Returns : dataframe indexed by cohort}
+    '''
+    cohorts = pd.concat(cohort_parts).groupby(level=0).agg({'start_date':'min', 'end_date':'max', 'program_sum':'sum',
+                                                            'program_count':'sum', 'data_science':'any', 'web_dev':'any'})
+    cohorts['program_id'] = cohorts.program_sum / cohorts.program_count
+
+    return cohorts
+
+def suggest_cohorts(users, cohorts):
+    '''
+    Suggests a cohort for each user without one iff the previous and next user_ids are in the same cohort,
+    looking the neighbors up in the user summary instead of scanning the accesses
+    {Returns : suggested_imputes dataframe indexed by user_id (suggested_cohort, start_date, end_date, program_id)}
+    '''
+    no_cohort_list = users[users.no_cohort].index
+    prev_user_cohort = users.cohort.reindex(no_cohort_list - 1).values
+    next_user_cohort = users.cohort.reindex(no_cohort_list + 1).values
+
+    # Ties user_ids to a suggested cohort iff they are surrounded by the same cohort
+    suggested_cohort = pd.Series(np.where(prev_user_cohort != next_user_cohort, 'Cannot Impute',
+                                          np.where(prev_user_cohort == 'X', 'Cannot Impute', prev_user_cohort)),
+                                 index=no_cohort_list, name='suggested_cohort')
+    suggested_cohort = suggested_cohort[(suggested_cohort != 'Cannot Impute') & suggested_cohort.isin(cohorts.index)]
+
+    # Brings cohort info together with the suggested imputes
+    cohort_info = cohorts[['start_date', 'end_date', 'program_id']].loc[suggested_cohort.values]
+    cohort_info.index = suggested_cohort.index
+    suggested_imputes = pd.concat([suggested_cohort, cohort_info], axis=1)
+
+    return suggested_imputes
+
+def program_cohorts(cohorts, suggested_imputes):
+    '''
+    Lists the Data Science and Web Development cohorts after imputation, from the cohort summary
+    {Returns : data_science, web_dev}
+    '''
+    known = pd.DataFrame(known_cohorts, index=['cohort', 'start_date', 'end_date', 'program_id']).T
+    imputed = pd.concat([suggested_imputes.rename(columns={'suggested_cohort':'cohort'}), known])
+
+    data_science = set(cohorts[cohorts.data_science].index) | set(imputed[imputed.program_id == 3.0].cohort)
+    web_dev = set(cohorts[cohorts.web_dev].index) | set(imputed[imputed.program_id.isin([1.0, 2.0])].cohort)
 
-    return df
\ No newline at end of file
+    return list(data_science), list(web_dev)